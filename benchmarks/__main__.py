@@ -0,0 +1,115 @@
+"""
+Performance benchmarks, runnable offline:
+
+    python -m benchmarks all
+    python -m benchmarks censor --sizes 100B 1KB 100KB
+    python -m benchmarks replay --trace trace.jsonl --rate 200
+    python -m benchmarks workers --rows 2000
+
+Results are compared with benchmarks/baseline.json when it exists, and the
+run fails if any metric is worse than the baseline by more than the
+tolerance. ``--save-baseline`` records the results as the new baseline.
+"""
+
+import argparse
+import sys
+from pathlib import Path
+
+from benchmarks.harness import (
+    DEFAULT_BASELINE,
+    SIZES,
+    ElasticsearchStub,
+    Report,
+    benchmark_database,
+    setup_django,
+)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog='python -m benchmarks')
+    parser.add_argument(
+        'suite',
+        choices=['censor', 'replay', 'workers', 'all'],
+        default='all',
+        nargs='?',
+    )
+    parser.add_argument('--baseline', type=Path, default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument(
+        '--tolerance',
+        type=float,
+        default=0.2,
+        help='allowed relative regression per metric (default: 0.2)',
+    )
+    parser.add_argument(
+        '--sizes',
+        nargs='+',
+        choices=list(SIZES),
+        default=list(SIZES),
+        help='censor: text sizes to blur',
+    )
+    parser.add_argument('--trace', type=Path, help='replay: JSON lines trace')
+    parser.add_argument(
+        '--requests',
+        type=int,
+        default=2000,
+        help='replay: length of the generated trace when --trace is not given',
+    )
+    parser.add_argument(
+        '--rate', type=float, default=100, help='replay: requests per second'
+    )
+    parser.add_argument(
+        '--url', help='replay: a running deployment instead of the app in this process'
+    )
+    parser.add_argument(
+        '--rows', type=int, default=1000, help='workers: submissions per task'
+    )
+    parser.add_argument(
+        '--row-size', type=int, default=1024, help='workers: characters per submission'
+    )
+    return parser.parse_args()
+
+
+def main() -> int:
+    args = parse_args()
+    setup_django()
+
+    from django.conf import settings
+
+    from benchmarks import censor, replay, workers
+
+    suites = ['censor', 'replay', 'workers'] if args.suite == 'all' else [args.suite]
+    report = Report()
+
+    if 'censor' in suites:
+        censor.run(report, args.sizes)
+
+    if 'replay' in suites or 'workers' in suites:
+        with ElasticsearchStub(settings.BENCHMARK_ES_PORT), benchmark_database():
+            if 'replay' in suites:
+                trace = (
+                    replay.load_trace(args.trace)
+                    if args.trace
+                    else replay.generate_trace(args.requests)
+                )
+                replay.run(report, trace, args.rate, args.url)
+            if 'workers' in suites:
+                workers.run(report, args.rows, args.row_size)
+
+    if args.save_baseline:
+        report.save(args.baseline)
+        print(f'Saved the baseline to {args.baseline}')
+        return 0
+
+    if not args.baseline.exists():
+        print(f'No baseline at {args.baseline}, nothing to compare with')
+        return 0
+
+    regressions = report.compare(args.baseline, args.tolerance)
+    for regression in regressions:
+        print(f'REGRESSION {regression}', file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
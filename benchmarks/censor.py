@@ -0,0 +1,27 @@
+from time import perf_counter
+
+from benchmarks.harness import SIZES, Report, make_text, percentiles, peak_rss_mb
+
+# runs per size, large texts take seconds each
+REPEATS = {'100B': 500, '1KB': 200, '10KB': 50, '100KB': 10, '1MB': 3, '10MB': 1}
+
+
+def run(report: Report, sizes: list[str]):
+    """blur_text over generated texts, a new one every run so the sentence cache stays cold."""
+    from core.tasks import blur_text
+
+    for name in sizes:
+        size = SIZES[name]
+        timings = []
+        for seed in range(REPEATS[name]):
+            text = make_text(size, seed)
+            start = perf_counter()
+            blur_text(text)
+            timings.append(perf_counter() - start)
+
+        report.add(
+            f'censor.blur_text.{name}',
+            **percentiles(timings),
+            mb_per_s=size * len(timings) / sum(timings) / 1024 / 1024,
+            peak_rss_mb=peak_rss_mb(),
+        )
@@ -0,0 +1,258 @@
+import json
+import os
+import random
+import re
+import resource
+import threading
+from collections.abc import Iterator
+from contextlib import contextmanager
+from functools import cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from statistics import quantiles
+
+from better_profanity.utils import read_wordlist
+
+from core.censor import CHARS_MAPPING, DEFAULT_WORDLIST
+
+SIZES = {
+    '100B': 100,
+    '1KB': 1024,
+    '10KB': 10 * 1024,
+    '100KB': 100 * 1024,
+    '1MB': 1024 * 1024,
+    '10MB': 10 * 1024 * 1024,
+}
+
+# Everyday words the profanity is mixed into
+VOCABULARY = (
+    'the of and to in is you that it he was for on are as with his they at be '
+    'this have from or one had by word but not what all were we when your can '
+    'said there use an each which she do how their if will up other about out '
+    'many then them these so some her would make like him into time has look '
+    'two more write go see number no way could people my than first water been '
+    'call who oil its now find long down day did get come made may part over '
+    'new sound take only little work know place year live me back give most '
+    'very after thing our just name good sentence man think say great where '
+    'help through much before line right too mean old any same tell boy follow'
+).split()
+
+DEFAULT_BASELINE = Path(__file__).with_name('baseline.json')
+
+
+def setup_django():
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'benchmarks.settings')
+    import django
+
+    django.setup()
+
+
+@contextmanager
+def benchmark_database() -> Iterator[None]:
+    # created from the migrations and dropped afterwards, like the test database
+    from django.test.utils import setup_databases, teardown_databases
+
+    old_config = setup_databases(verbosity=0, interactive=False)
+    try:
+        yield
+    finally:
+        teardown_databases(old_config, verbosity=0)
+
+
+@cache
+def _bad_words() -> list[str]:
+    return sorted(read_wordlist(DEFAULT_WORDLIST))
+
+
+def make_text(size: int, seed: int, profanity_rate: float = 0.03) -> str:
+    """
+    Chat-like text of ``size`` characters: sentences of everyday words with
+    ``profanity_rate`` of the words taken from the censor wordlist, some of
+    them in leetspeak or with separators, the way users dodge filters.
+    """
+    rng = random.Random(seed)
+    bad_words = _bad_words()
+    words = []
+    length = 0
+    while length < size:
+        if rng.random() < profanity_rate:
+            word = rng.choice(bad_words)
+            if rng.random() < 0.3:
+                word = ''.join(
+                    rng.choice(CHARS_MAPPING[char])
+                    if char in CHARS_MAPPING and rng.random() < 0.5
+                    else char
+                    for char in word
+                )
+            if rng.random() < 0.1:
+                word = '.'.join(word)
+        else:
+            word = rng.choice(VOCABULARY)
+        if rng.random() < 0.08:
+            word += rng.choice('.!?') + ('\n' if rng.random() < 0.3 else '')
+        words.append(word)
+        length += len(word) + 1
+    return ' '.join(words)[:size]
+
+
+def percentiles(samples: list[float]) -> dict:
+    # latencies in ms
+    if not samples:
+        return {'p50_ms': 0.0, 'p99_ms': 0.0}
+    if len(samples) == 1:
+        return {'p50_ms': samples[0] * 1000, 'p99_ms': samples[0] * 1000}
+    cuts = quantiles(samples, n=100, method='inclusive')
+    return {'p50_ms': cuts[49] * 1000, 'p99_ms': cuts[98] * 1000}
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in KB on Linux, forked censor processes count as children
+    self_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children_peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(self_peak, children_peak) / 1024
+
+
+class ElasticsearchStub:
+    """
+    Answers the few Elasticsearch calls the app makes, keeping indexed
+    documents in memory. Search matches any query word against the text.
+    """
+
+    def __init__(self, port: int):
+        self.documents: dict[str, dict] = {}
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), self._handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def bulk(self, body: bytes) -> dict:
+        lines = [json.loads(line) for line in body.splitlines() if line.strip()]
+        items = []
+        with self.lock:
+            for action, source in zip(lines[::2], lines[1::2]):
+                doc_id = action['index']['_id']
+                self.documents[doc_id] = source
+                items.append({'index': {'_id': doc_id, 'status': 201}})
+        return {'took': 1, 'errors': False, 'items': items}
+
+    def search(self, body: dict) -> dict:
+        query = body['query']['match']['original_text']['query']
+        terms = set(re.findall(r'\w+', query.lower()))
+        with self.lock:
+            matches = [
+                source
+                for source in self.documents.values()
+                if terms & set(re.findall(r'\w+', source['original_text'].lower()))
+            ]
+        start = body.get('from', 0)
+        page = matches[start : start + body.get('size', 10)]
+        return {
+            'took': 1,
+            'hits': {
+                'total': {'value': len(matches), 'relation': 'eq'},
+                'hits': [
+                    {'_source': source, 'sort': [1.0, source['text_hash'], position]}
+                    for position, source in enumerate(page, start)
+                ],
+            },
+            'pit_id': body['pit']['id'],
+        }
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def _reply(self, payload: dict | None = None, status: int = 200):
+                body = b'' if payload is None else json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('X-Elastic-Product', 'Elasticsearch')
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if self.command != 'HEAD':
+                    self.wfile.write(body)
+
+            def _body(self) -> bytes:
+                return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+            def do_HEAD(self):
+                self._reply()
+
+            def do_POST(self):
+                body = self._body()
+                path = self.path.split('?')[0]
+                if path.endswith('/_bulk'):
+                    self._reply(stub.bulk(body))
+                elif path.endswith('/_search'):
+                    self._reply(stub.search(json.loads(body)))
+                elif path.endswith('/_pit'):
+                    # every search runs in a point in time, the stub has one
+                    self._reply({'id': 'stub'})
+                elif self.command == 'PUT':
+                    # index creation
+                    self._reply({'acknowledged': True})
+                else:
+                    self._reply({'error': f'not stubbed: {path}'}, status=400)
+
+            # the client sends bulk requests as PUT
+            do_PUT = do_POST
+
+        return Handler
+
+
+class Report:
+    """
+    Benchmark results keyed by name, compared metric by metric with a
+    stored baseline. Metrics ending in ``_per_s`` are better when higher,
+    all others (latencies, memory) when lower.
+    """
+
+    def __init__(self):
+        self.results: dict[str, dict[str, float]] = {}
+
+    def add(self, name: str, **metrics: float):
+        self.results[name] = {key: round(value, 3) for key, value in metrics.items()}
+        print(
+            f'{name}: ' + ', '.join(f'{k}={v:g}' for k, v in self.results[name].items())
+        )
+
+    def save(self, path: Path):
+        # results of suites that did not run are kept
+        baseline = json.loads(path.read_text()) if path.exists() else {}
+        baseline.update(self.results)
+        path.write_text(json.dumps(baseline, indent=2, sort_keys=True) + '\n')
+
+    def compare(self, path: Path, tolerance: float) -> list[str]:
+        baseline = json.loads(path.read_text())
+        regressions = []
+        for name, metrics in self.results.items():
+            for key, value in metrics.items():
+                reference = baseline.get(name, {}).get(key)
+                if reference is None:
+                    continue
+                if reference == 0:
+                    # no relative change from zero, any rise of a metric that
+                    # is better when lower (errors, rejections) is a regression
+                    if value > 0 and not key.endswith('_per_s'):
+                        regressions.append(f'{name} {key}: {value:g} vs 0')
+                    continue
+                if key.endswith('_per_s'):
+                    change = (reference - value) / reference
+                else:
+                    change = (value - reference) / reference
+                if change > tolerance:
+                    regressions.append(
+                        f'{name} {key}: {value:g} vs {reference:g} ({change:+.0%} worse)'
+                    )
+        return regressions
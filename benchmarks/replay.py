@@ -0,0 +1,189 @@
+"""
+Replays a JSON lines trace against the API at a fixed request rate. Every
+line is one request:
+
+    {"op": "submit", "text": "..."}
+    {"op": "result", "text": "..."}   the result of a text submitted earlier
+    {"op": "search", "query": "..."}
+
+Lines without an "op" submit their "text" or "body", so a requests.jsonl
+file replays as is.
+"""
+
+import asyncio
+import json
+import random
+from collections import defaultdict
+from hashlib import sha256
+from pathlib import Path
+from urllib.parse import urlencode
+
+from benchmarks.harness import VOCABULARY, Report, make_text, peak_rss_mb, percentiles
+
+
+def load_trace(path: Path) -> list[dict]:
+    trace = []
+    for line in path.read_text().splitlines():
+        if not line.strip():
+            continue
+        item = json.loads(line)
+        if 'op' not in item:
+            item = {'op': 'submit', 'text': item.get('text') or item['body']}
+        trace.append(item)
+    return trace
+
+
+def generate_trace(count: int, seed: int = 0) -> list[dict]:
+    # mostly chat-sized submissions with the odd long one, clients polling
+    # for results of what they sent and some searches
+    rng = random.Random(seed)
+    submitted = []
+    trace = []
+    for i in range(count):
+        roll = rng.random()
+        if roll < 0.3 and submitted:
+            trace.append({'op': 'result', 'text': rng.choice(submitted)})
+        elif roll < 0.4:
+            trace.append({'op': 'search', 'query': rng.choice(VOCABULARY)})
+        else:
+            size = 50 * 1024 if rng.random() < 0.02 else rng.randint(20, 2000)
+            text = make_text(size, seed * count + i)
+            submitted.append(text)
+            trace.append({'op': 'submit', 'text': text})
+    return trace
+
+
+def request_for(item: dict) -> tuple[str, str, dict | None]:
+    # method, path and JSON body of a trace item
+    if item['op'] == 'submit':
+        return 'POST', '/api/submit/', {'text': item['text']}
+    if item['op'] == 'result':
+        text_id = sha256(item['text'].encode()).hexdigest()
+        return 'GET', f'/api/result/{text_id}/', None
+    return 'GET', '/api/search/?' + urlencode({'query': item['query']}), None
+
+
+class InProcessClient:
+    # the app in this process, tasks go to a worker thread
+    def __init__(self):
+        from django.test import AsyncClient
+
+        self.client = AsyncClient()
+
+    async def start(self):
+        from core import lifespan
+
+        await lifespan.startup()
+
+    async def send(self, method: str, path: str, body: dict | None) -> int:
+        if method == 'POST':
+            response = await self.client.post(
+                path, body, content_type='application/json'
+            )
+        else:
+            response = await self.client.get(path)
+        return response.status_code
+
+    async def close(self):
+        from asgiref.sync import sync_to_async
+        from django.db import connections
+
+        from core import lifespan
+        from core.batcher import processing_batcher
+
+        processing_batcher.flush()
+        await lifespan.shutdown()
+        # the benchmark database cannot be dropped while the ORM thread holds
+        # a connection to it
+        await sync_to_async(connections.close_all)()
+
+
+class HttpClient:
+    # a running deployment
+    def __init__(self, base_url: str):
+        import aiohttp
+
+        self.base_url = base_url.rstrip('/')
+        self.session = aiohttp.ClientSession()
+
+    async def start(self):
+        pass
+
+    async def send(self, method: str, path: str, body: dict | None) -> int:
+        async with self.session.request(
+            method, self.base_url + path, json=body
+        ) as response:
+            await response.read()
+            return response.status
+
+    async def close(self):
+        await self.session.close()
+
+
+async def replay(trace: list[dict], rate: float, client) -> dict:
+    """
+    Sends request i at i / rate seconds whether or not earlier ones are
+    done, and measures latency from that scheduled time, so a slow server
+    cannot hide its queueing by slowing the driver down.
+    """
+    loop = asyncio.get_running_loop()
+    latencies = defaultdict(list)
+    statuses = defaultdict(lambda: defaultdict(int))
+    start = loop.time()
+
+    async def fire(index: int, item: dict):
+        scheduled = start + index / rate
+        await asyncio.sleep(max(scheduled - loop.time(), 0))
+        try:
+            status = await client.send(*request_for(item))
+        except Exception:
+            status = 0
+        latencies[item['op']].append(loop.time() - scheduled)
+        statuses[item['op']][status] += 1
+
+    await asyncio.gather(*(fire(index, item) for index, item in enumerate(trace)))
+    elapsed = loop.time() - start
+    return {
+        op: (timings, dict(statuses[op]), len(timings) / elapsed)
+        for op, timings in latencies.items()
+    }
+
+
+def run(report: Report, trace: list[dict], rate: float, url: str | None = None):
+    async def main():
+        client = HttpClient(url) if url else InProcessClient()
+        await client.start()
+        try:
+            return await replay(trace, rate, client)
+        finally:
+            await client.close()
+
+    if url:
+        results = asyncio.run(main())
+    else:
+        from celery.contrib.testing.worker import start_worker
+
+        from blurifier.celery import app as celery_app
+
+        with start_worker(
+            celery_app,
+            pool='solo',
+            perform_ping_check=False,
+            queues=['interactive', 'backfill'],
+        ):
+            results = asyncio.run(main())
+
+    for op, (timings, statuses, throughput) in sorted(results.items()):
+        report.add(
+            f'replay.{op}',
+            **percentiles(timings),
+            requests_per_s=throughput,
+            # 404s are results asked for before their submission landed
+            errors=sum(
+                count
+                for status, count in statuses.items()
+                if not status or status >= 500
+            ),
+            rejected=statuses.get(429, 0),
+            peak_rss_mb=peak_rss_mb(),
+        )
@@ -0,0 +1,20 @@
+# Offline stand-ins for every service the app talks to: fakeredis and the
+# in-memory Celery broker from the test settings, a stub Elasticsearch
+# (benchmarks.harness.ElasticsearchStub) and a throwaway database on the
+# local Postgres.
+
+from blurifier.settings.settings_test import *  # noqa: F403
+
+BENCHMARK_ES_PORT = 9202
+
+ELASTICSEARCH = {
+    'default': {'hosts': f'http://127.0.0.1:{BENCHMARK_ES_PORT}'},
+}
+
+DATABASES['default']['TEST'] = {'NAME': 'blurifier_benchmark'}  # noqa: F405
+
+# Tasks go through the broker to a worker thread, like in production
+CELERY_TASK_ALWAYS_EAGER = False
+PROCESS_BATCH_SIZE = settings.process_batch_size  # noqa: F405
+
+EXISTENCE_FILTER = True
@@ -0,0 +1,71 @@
+from itertools import batched
+from time import perf_counter
+
+from benchmarks.harness import Report, make_text, peak_rss_mb
+
+
+def _create_unprocessed(count: int, size: int, seed: int) -> list[str]:
+    from core.models import TextSubmission, hash_text, submission_text
+
+    texts = [submission_text(make_text(size, seed + i)) for i in range(count)]
+    TextSubmission.objects.bulk_create(
+        [
+            TextSubmission(original_text=text, text_hash=hash_text(text))
+            for text in texts
+        ]
+    )
+    return [hash_text(text) for text in texts]
+
+
+def _timed(report: Report, name: str, rows: int, func):
+    start = perf_counter()
+    func()
+    elapsed = perf_counter() - start
+    report.add(
+        f'workers.{name}',
+        rows_per_s=rows / elapsed,
+        seconds=elapsed,
+        peak_rss_mb=peak_rss_mb(),
+    )
+
+
+def run(report: Report, rows: int, size: int):
+    """
+    Task bodies run in this process with ``apply``, against the benchmark
+    database, fakeredis and the Elasticsearch stub.
+    """
+    from django.conf import settings
+
+    from core.models import TextSubmission
+    from core.tasks import (
+        index_unindexed_texts,
+        process_text,
+        process_texts,
+        process_unprocessed_texts,
+    )
+
+    single = max(rows // 10, 1)
+    text_hashes = _create_unprocessed(single, size, seed=0)
+    _timed(
+        report,
+        'process_text',
+        single,
+        lambda: [process_text.apply(args=[text_hash]) for text_hash in text_hashes],
+    )
+
+    text_hashes = _create_unprocessed(rows, size, seed=single)
+    _timed(
+        report,
+        'process_texts',
+        rows,
+        lambda: [
+            process_texts.apply(args=[list(chunk)])
+            for chunk in batched(text_hashes, settings.SUBMIT_BATCH_CHUNK_SIZE)
+        ],
+    )
+
+    _create_unprocessed(rows, size, seed=single + rows)
+    _timed(report, 'process_unprocessed_texts', rows, process_unprocessed_texts.apply)
+
+    unindexed = TextSubmission.objects.filter(indexed_at__isnull=True).count()
+    _timed(report, 'index_unindexed_texts', unindexed, index_unindexed_texts.apply)
@@ -8,9 +8,32 @@ https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 """
 
 import os
+from time import perf_counter
 
-from django.core.asgi import get_asgi_application
+# cold start of the worker process, see lifespan.startup
+started_at = perf_counter()
+
+from django.core.asgi import get_asgi_application  # noqa: E402 (timed)
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'blurifier.settings.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from core import lifespan  # noqa: E402 (needs the apps to be loaded)
+
+
+async def application(scope, receive, send):
+    # Django does not handle the lifespan protocol, used here to open and
+    # close long-lived resources together with the worker
+    if scope['type'] != 'lifespan':
+        return await django_application(scope, receive, send)
+
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await lifespan.startup(started_at)
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await lifespan.shutdown()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
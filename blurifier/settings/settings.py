@@ -1,6 +1,8 @@
 import os
+from ipaddress import ip_network
 from pathlib import Path
 
+from kombu import Queue
 from pydantic_settings import BaseSettings
 from pydantic.types import SecretStr
 
@@ -34,6 +36,96 @@ class AppSettings(BaseSettings):
     elasticsearch_port: int = 9200
     elasticsearch_index_name: str = 'text_submissions'
 
+    # Deduplicate texts on their canonical form
+    canonical_text_hash: bool = True
+
+    # Bloom filter of stored texts in front of the submit dedup query,
+    # 2**27 bits (16 MB) keep false positives under 1% up to ~10M texts
+    existence_filter: bool = True
+    existence_filter_bits: int = 2**27
+    existence_filter_hashes: int = 7
+
+    # Batch submission
+    submit_batch_max_size: int = 1000
+    submit_batch_chunk_size: int = 100
+
+    # Texts up to this size are censored inside submit_text
+    inline_censor_max_bytes: int = 512
+
+    # Micro-batching of single submissions into process_texts messages
+    process_batch_size: int = 50
+    process_batch_window: float = 0.05  # seconds
+
+    # Texts longer than censor_chunk_size characters are censored in chunks
+    # across up to censor_processes child processes
+    censor_chunk_size: int = 256 * 1024
+    censor_processes: int = 4
+
+    # Sentence-level censor cache
+    censor_cache_min_length: int = 1024
+    censor_cache_local_max_bytes: int = 32 * 1024 * 1024
+    censor_cache_ttl: int = 24 * 60 * 60  # seconds
+    censor_cache_redis_slots: int = 1 << 20
+
+    # Wordlist profiles: compiled wordlists kept per process, and how long
+    # the web processes keep using a profile version after it changed
+    censor_engine_cache_size: int = 32
+    wordlist_profile_ttl: float = 10.0  # seconds
+
+    # Rows loaded and committed at once by the backfill tasks
+    backfill_chunk_size: int = 500
+
+    # Elasticsearch client pool
+    es_connections_per_node: int = 10
+    es_request_timeout: float = 10.0  # seconds
+    es_max_retries: int = 3
+
+    # Elasticsearch bulk requests
+    es_bulk_chunk_size: int = 500
+    es_bulk_max_bytes: int = 10 * 1024 * 1024
+
+    # In-process result cache in front of Redis
+    result_cache_local_max_bytes: int = 64 * 1024 * 1024
+    result_cache_local_ttl: float = 60.0  # seconds
+    result_cache_pending_ttl: float = 2.0  # seconds
+
+    # Admission control on submit, 0 turns a threshold off
+    admission_check_interval: float = 5.0  # seconds
+    admission_defer_queue_depth: int = 1000  # messages
+    admission_reject_queue_depth: int = 5000
+    admission_defer_lag: float = 60.0  # seconds
+    admission_reject_lag: float = 600.0
+    admission_retry_after: float = 30.0  # seconds
+
+    # Per-client token bucket on submitted texts, 0 turns it off
+    submit_rate_limit: float = 100.0  # texts per second
+    submit_rate_burst: int = 1000
+    # Addresses or networks of the reverse proxies allowed to set X-Real-IP,
+    # e.g. TRUSTED_PROXIES='["172.28.0.10"]'
+    trusted_proxies: list[str] = []
+
+    # Max text_ids accepted by /api/results/
+    results_batch_max_size: int = 1000
+
+    # Priority of /api/submit/batch/ chunks on the interactive queue, single
+    # submissions get CELERY_TASK_DEFAULT_PRIORITY
+    submit_batch_priority: int = 3
+
+    # Port of the Celery worker metrics, served when PROMETHEUS_MULTIPROC_DIR is set
+    celery_metrics_port: int = 9808
+
+    # Processing tasks taking longer than this log their stages, 0 turns it off
+    pipeline_slow_seconds: float = 5.0
+
+    # Background logging, see LOGGING
+    log_queue_size: int = 10_000  # records
+    log_rate_limit: float = 10.0  # records per second per message
+    log_rate_burst: int = 100
+
+    # Server push for results
+    result_wait_max: float = 30.0  # seconds
+    result_stream_timeout: float = 300.0  # seconds
+
     @property
     def celery_broker_url(self) -> str:
         return f'amqp://{self.rabbitmq_user}:{self.rabbitmq_pass.get_secret_value()}@{self.rabbitmq_host}:{self.rabbitmq_port}//'
@@ -96,6 +188,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django_prometheus.middleware.PrometheusBeforeMiddleware',
+    'core.tracing.TraceIdMiddleware',
     'debug_toolbar.middleware.DebugToolbarMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -188,8 +281,29 @@ CELERY_TASK_TIME_LIMIT = 28 * 60
 CELERY_TASK_SOFT_TIME_LIMIT = 2 * 60
 
 CELERY_TASK_TRACK_STARTED = True
+# workers log through LOGGING like the web processes, with the trace id
+CELERY_WORKER_HIJACK_ROOT_LOGGER = False
 CELERY_TASK_SEND_SENT_EVENT = True
 
+# User-facing processing and the beat backfills run on separate queues and
+# workers, so a long backfill never sits in front of a submission. Messages
+# on the interactive queue are prioritized, batches below single texts.
+CELERY_TASK_QUEUES = (
+    Queue('interactive', routing_key='interactive', max_priority=10),
+    Queue('backfill', routing_key='backfill'),
+)
+CELERY_TASK_DEFAULT_QUEUE = 'interactive'
+CELERY_TASK_ROUTES = {
+    'core.tasks.process_unprocessed_texts': {'queue': 'backfill'},
+    'core.tasks.index_unindexed_texts': {'queue': 'backfill'},
+}
+CELERY_TASK_DEFAULT_PRIORITY = 5
+SUBMIT_BATCH_PRIORITY = settings.submit_batch_priority
+CELERY_METRICS_PORT = settings.celery_metrics_port
+# process_text / process_texts runs slower than this, queue wait included,
+# log how long every stage took, with the trace id of the submit request
+PIPELINE_SLOW_SECONDS = settings.pipeline_slow_seconds
+
 CELERY_BEAT_SCHEDULE = {
     'process_unprocessed_texts': {
         'task': 'core.tasks.process_unprocessed_texts',
@@ -208,14 +322,33 @@ CACHES = {
     }
 }
 
+# Records are put in a bounded queue and written by a background thread, the
+# request and task code never waits for log I/O. The file is JSON lines for
+# logstash. Every message template is rate limited to LOG_RATE_LIMIT records
+# per second in bursts of LOG_RATE_BURST, 0 turns that off.
+LOG_QUEUE_SIZE = settings.log_queue_size
+LOG_RATE_LIMIT = settings.log_rate_limit
+LOG_RATE_BURST = settings.log_rate_burst
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
     'formatters': {
         'custom': {
-            'format': '[%(asctime)s] [%(process)d] [%(name)s] [%(levelname)s] %(message)s',
+            'format': '[%(asctime)s] [%(process)d] [%(trace_id)s] [%(name)s] [%(levelname)s] %(message)s',
             'datefmt': '%Y-%m-%d %H:%M:%S',
         },
+        'json': {
+            '()': 'core.log.JsonFormatter',
+        },
+    },
+    'filters': {
+        'trace_id': {'()': 'core.tracing.TraceIdFilter'},
+        'rate_limit': {
+            '()': 'core.log.RateLimitFilter',
+            'rate': LOG_RATE_LIMIT,
+            'burst': LOG_RATE_BURST,
+        },
     },
     'handlers': {
         'console': {
@@ -225,11 +358,19 @@ LOGGING = {
         'file': {
             'class': 'logging.FileHandler',
             'filename': 'logs/django.log',
-            'formatter': 'custom',
+            'formatter': 'json',
+        },
+        # filters run in the thread that logs, where the trace id is bound
+        'background': {
+            'class': 'core.log.BackgroundHandler',
+            'handlers': ['console', 'file'],
+            'queue': {'()': 'queue.Queue', 'maxsize': LOG_QUEUE_SIZE},
+            'listener': 'core.log.BackgroundListener',
+            'filters': ['trace_id', 'rate_limit'],
         },
     },
     'root': {
-        'handlers': ['console', 'file'],
+        'handlers': ['background'],
         'level': 'INFO',
     },
 }
@@ -248,5 +389,91 @@ ELASTICSEARCH = {
     'default': {'hosts': settings.elasticsearch_url},
 }
 ELASTICSEARCH_INDEX_NAME = 'text_submissions'
+# Pool of keep-alive connections of every long-lived client
+ES_CONNECTIONS_PER_NODE = settings.es_connections_per_node
+ES_REQUEST_TIMEOUT = settings.es_request_timeout
+ES_MAX_RETRIES = settings.es_max_retries
+# Max documents / bytes per bulk request
+ES_BULK_CHUNK_SIZE = settings.es_bulk_chunk_size
+ES_BULK_MAX_BYTES = settings.es_bulk_max_bytes
 
 NINJA_PAGINATION_MAX_LIMIT = 100
+
+# Texts differing only by whitespace, line endings or Unicode normalization
+# share one submission, see core.models.canonical_text
+CANONICAL_TEXT_HASH = settings.canonical_text_hash
+
+# Submissions the existence filter reports as new are inserted without
+# looking them up first, see core.cache.ExistenceFilter
+EXISTENCE_FILTER = settings.existence_filter
+EXISTENCE_FILTER_BITS = settings.existence_filter_bits
+EXISTENCE_FILTER_HASHES = settings.existence_filter_hashes
+
+# Max texts accepted by /api/submit/batch/ and texts sent per Celery message
+SUBMIT_BATCH_MAX_SIZE = settings.submit_batch_max_size
+SUBMIT_BATCH_CHUNK_SIZE = settings.submit_batch_chunk_size
+
+# Single submissions of at most INLINE_CENSOR_MAX_BYTES are censored in the
+# request, larger ones go to Celery
+INLINE_CENSOR_MAX_BYTES = settings.inline_censor_max_bytes
+
+# Single submissions are sent to Celery in batches of up to PROCESS_BATCH_SIZE
+# hashes, or after PROCESS_BATCH_WINDOW seconds, whichever comes first
+PROCESS_BATCH_SIZE = settings.process_batch_size
+PROCESS_BATCH_WINDOW = settings.process_batch_window
+
+# Texts longer than CENSOR_CHUNK_SIZE characters are split into chunks censored
+# in up to CENSOR_PROCESSES child processes forked by the worker. 1 turns it off.
+CENSOR_CHUNK_SIZE = settings.censor_chunk_size
+CENSOR_PROCESSES = settings.censor_processes
+
+# Texts of at least CENSOR_CACHE_MIN_LENGTH characters are censored sentence by
+# sentence, with the results cached in the workers and in Redis. Redis shares
+# its memory with the results and the rate limiter, the sentences never take
+# more than CENSOR_CACHE_REDIS_SLOTS keys of it
+CENSOR_CACHE_MIN_LENGTH = settings.censor_cache_min_length
+CENSOR_CACHE_LOCAL_MAX_BYTES = settings.censor_cache_local_max_bytes
+CENSOR_CACHE_TTL = settings.censor_cache_ttl
+CENSOR_CACHE_REDIS_SLOTS = settings.censor_cache_redis_slots
+
+# Every process keeps the compiled wordlists of up to CENSOR_ENGINE_CACHE_SIZE
+# wordlist profile versions. Web processes look up the current version of a
+# profile at most every WORDLIST_PROFILE_TTL seconds.
+CENSOR_ENGINE_CACHE_SIZE = settings.censor_engine_cache_size
+WORDLIST_PROFILE_TTL = settings.wordlist_profile_ttl
+
+# Rows loaded and committed at once by the backfill tasks
+BACKFILL_CHUNK_SIZE = settings.backfill_chunk_size
+
+# Per-process LRU in front of the Redis result cache, pending results are
+# only kept for RESULT_CACHE_PENDING_TTL seconds
+RESULT_CACHE_LOCAL_MAX_BYTES = settings.result_cache_local_max_bytes
+RESULT_CACHE_LOCAL_TTL = settings.result_cache_local_ttl
+RESULT_CACHE_PENDING_TTL = settings.result_cache_pending_ttl
+
+# Submissions are stored but not sent to Celery once the interactive queue
+# holds ADMISSION_DEFER_QUEUE_DEPTH messages or the oldest unprocessed text is
+# ADMISSION_DEFER_LAG seconds old, process_unprocessed_texts catches up on
+# them. Past the REJECT thresholds submit answers 429 with Retry-After.
+ADMISSION_CHECK_INTERVAL = settings.admission_check_interval
+ADMISSION_DEFER_QUEUE_DEPTH = settings.admission_defer_queue_depth
+ADMISSION_REJECT_QUEUE_DEPTH = settings.admission_reject_queue_depth
+ADMISSION_DEFER_LAG = settings.admission_defer_lag
+ADMISSION_REJECT_LAG = settings.admission_reject_lag
+ADMISSION_RETRY_AFTER = settings.admission_retry_after
+
+# Every client may submit SUBMIT_RATE_LIMIT texts per second on average, in
+# bursts of up to SUBMIT_RATE_BURST, tracked in Redis by client address
+SUBMIT_RATE_LIMIT = settings.submit_rate_limit
+SUBMIT_RATE_BURST = settings.submit_rate_burst
+
+# The client address is taken from X-Real-IP only on requests coming from one
+# of TRUSTED_PROXIES, anything else is limited by its own REMOTE_ADDR
+TRUSTED_PROXIES = [ip_network(proxy) for proxy in settings.trusted_proxies]
+
+# Max text_ids accepted by /api/results/
+RESULTS_BATCH_MAX_SIZE = settings.results_batch_max_size
+
+# Longest ?wait= accepted by /api/result/ and lifetime of a result event stream
+RESULT_WAIT_MAX = settings.result_wait_max
+RESULT_STREAM_TIMEOUT = settings.result_stream_timeout
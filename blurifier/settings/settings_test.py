@@ -29,6 +29,19 @@ CELERY_TASK_EAGER_PROPAGATES = True  # makes task exceptions propagate up to you
 CELERY_BROKER_URL = 'memory://'
 CELERY_RESULT_BACKEND = 'cache+memory://'  # instead of redis, use memory for results
 
+# The tests that need them turn them on
+EXISTENCE_FILTER = False
+SUBMIT_RATE_LIMIT = 0
+
+PROCESS_BATCH_SIZE = 1  # send every submission right away instead of batching
+
+# Nothing listens on this port, indexing and search fail fast instead of
+# reaching a real cluster
+ELASTICSEARCH = {
+    'default': {'hosts': 'http://127.0.0.1:9201'},
+}
+ES_MAX_RETRIES = 0
+
 DEBUG = False
 
 try:
@@ -3,12 +3,20 @@ from django.http import JsonResponse
 from django.urls import path, include
 from django.conf import settings
 from ninja import NinjaAPI
+from core.admission import Overloaded
 from core.api import router as core_router
 
 api = NinjaAPI()
 api.add_router('/', core_router)
 
 
+@api.exception_handler(Overloaded)
+def overloaded(request, exc):
+    response = api.create_response(request, {'detail': str(exc)}, status=429)
+    response['Retry-After'] = str(exc.retry_after)
+    return response
+
+
 def ping(request):
     return JsonResponse({'ping': 'pong'})
 
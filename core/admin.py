@@ -1,5 +1,13 @@
 from django.contrib import admin
-from core.models import TextSubmission
+from core.models import TextSubmission, TextVariant, WordlistProfile, WordlistVersion
+
+
+class TextVariantInline(admin.TabularInline):
+    model = TextVariant
+    fields = ('text_hash', 'original_text', 'created_at')
+    readonly_fields = fields
+    extra = 0
+    can_delete = False
 
 
 @admin.register(TextSubmission)
@@ -8,8 +16,28 @@ class TextSubmissionAdmin(admin.ModelAdmin):
         'id',
         'original_text',
         'processed_text',
+        'status',
         'created_at',
         'updated_at',
         'text_hash',
     )
-    readonly_fields = ('text_hash',)
+    list_filter = ('status',)
+    readonly_fields = ('text_hash', 'processed_text', 'wordlist')
+    exclude = ('censor_spans',)
+    inlines = (TextVariantInline,)
+
+
+class WordlistVersionInline(admin.TabularInline):
+    model = WordlistVersion
+    fields = ('number', 'words', 'allowed', 'include_default', 'created_at')
+    readonly_fields = fields
+    extra = 0
+    can_delete = False
+    ordering = ('-number',)
+
+
+@admin.register(WordlistProfile)
+class WordlistProfileAdmin(admin.ModelAdmin):
+    list_display = ('name', 'include_default', 'created_at', 'updated_at')
+    search_fields = ('name',)
+    inlines = (WordlistVersionInline,)
@@ -0,0 +1,216 @@
+import logging
+import math
+from datetime import datetime, UTC
+from enum import StrEnum
+from ipaddress import ip_address
+from time import monotonic, time
+
+import redis
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from blurifier.celery import app as celery_app
+from core.cache import loop_redis_client
+from core.metrics import (
+    ADMISSION_DECISIONS,
+    PIPELINE_QUEUE_DEPTH,
+    PIPELINE_UNPROCESSED_AGE,
+)
+from core.models import ProcessingStatus, TextSubmission
+
+logger = logging.getLogger(__name__)
+
+# KEYS[1] bucket, ARGV rate (tokens/s), burst, now, cost. Returns 0 when the
+# tokens were taken, otherwise the seconds until enough are available.
+# Stripped, the fakeredis server of the tests strips every argument it reads.
+TOKEN_BUCKET_SCRIPT = """
+local rate, burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+local now, cost = tonumber(ARGV[3]), tonumber(ARGV[4])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+local tokens = tonumber(bucket[1]) or burst
+local updated_at = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(now - updated_at, 0) * rate)
+local wait = 0
+if tokens >= cost then
+    tokens = tokens - cost
+else
+    wait = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated_at', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+""".strip()
+
+
+class Admission(StrEnum):
+    ACCEPT = 'accept'
+    # stored without a Celery message, process_unprocessed_texts picks it up
+    DEFER = 'defer'
+    REJECT = 'reject'
+
+
+class Overloaded(Exception):
+    """Answered with 429 and a Retry-After header."""
+
+    def __init__(self, detail: str, retry_after: float):
+        super().__init__(detail)
+        self.retry_after = max(math.ceil(retry_after), 1)
+
+
+class PipelineLag:
+    """
+    Depth of the interactive Celery queue and age of the oldest submission
+    still waiting for a worker, measured at most every ``interval`` seconds
+    per process. Requests arriving while a measurement runs use the last one.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.reset()
+
+    def reset(self):
+        # forgets the last measurement, the next request takes a new one
+        self.queue_depth = 0
+        self.unprocessed_age = 0.0
+        self._measured_at = -math.inf
+
+    @staticmethod
+    def _queue_depth() -> int:
+        with celery_app.connection_for_read() as connection:
+            return connection.default_channel.queue_declare(
+                queue=settings.CELERY_TASK_DEFAULT_QUEUE, passive=True
+            ).message_count
+
+    async def _unprocessed_age(self) -> float:
+        # failed rows are retried by the backfill, they do not hold others back
+        created_at = await (
+            TextSubmission.objects.filter(censor_spans__isnull=True)
+            .exclude(status=ProcessingStatus.FAILURE)
+            .order_by('id')
+            .values_list('created_at', flat=True)
+            .afirst()
+        )
+        if created_at is None:
+            return 0.0
+        return max((datetime.now(UTC) - created_at).total_seconds(), 0.0)
+
+    async def measure(self):
+        if monotonic() - self._measured_at < self.interval:
+            return
+        self._measured_at = monotonic()
+
+        try:
+            self.queue_depth = await sync_to_async(
+                self._queue_depth, thread_sensitive=False
+            )()
+        except Exception as e:
+            logger.error('Failed to read the Celery queue depth: %s', e)
+        self.unprocessed_age = await self._unprocessed_age()
+
+        PIPELINE_QUEUE_DEPTH.set(self.queue_depth)
+        PIPELINE_UNPROCESSED_AGE.set(self.unprocessed_age)
+
+    async def admission(self) -> Admission:
+        await self.measure()
+        if _crossed(self.queue_depth, settings.ADMISSION_REJECT_QUEUE_DEPTH) or (
+            _crossed(self.unprocessed_age, settings.ADMISSION_REJECT_LAG)
+        ):
+            return Admission.REJECT
+        if _crossed(self.queue_depth, settings.ADMISSION_DEFER_QUEUE_DEPTH) or (
+            _crossed(self.unprocessed_age, settings.ADMISSION_DEFER_LAG)
+        ):
+            return Admission.DEFER
+        return Admission.ACCEPT
+
+
+def _crossed(value: float, threshold: float) -> bool:
+    # a threshold of 0 turns the check off
+    return bool(threshold) and value >= threshold
+
+
+class RateLimiter:
+    """
+    Token buckets in Redis, refilled at ``rate`` tokens per second up to
+    ``burst``. Shared by all web processes, and lets requests through
+    when Redis is unavailable.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._sha = None
+
+    async def acquire(self, client_id: str, cost: int = 1) -> float:
+        # seconds until the client may retry, 0 when the tokens were taken
+        client = loop_redis_client()
+        keys_and_args = (
+            f'ratelimit:{client_id}',
+            self.rate,
+            self.burst,
+            time(),
+            min(cost, self.burst),
+        )
+        try:
+            if self._sha is None:
+                self._sha = await client.script_load(TOKEN_BUCKET_SCRIPT)
+            try:
+                wait = await client.evalsha(self._sha, 1, *keys_and_args)
+            except redis.exceptions.NoScriptError:
+                # the script cache was flushed, EVAL loads the script again
+                wait = await client.eval(TOKEN_BUCKET_SCRIPT, 1, *keys_and_args)
+        except redis.RedisError as e:
+            logger.error('Rate limiter failed: %s', e)
+            return 0.0
+        return float(wait)
+
+
+def is_trusted_proxy(address: str) -> bool:
+    try:
+        ip = ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in network for network in settings.TRUSTED_PROXIES)
+
+
+def client_id(request) -> str:
+    # nginx passes the client address in X-Real-IP. Anyone reaching the app
+    # directly could send any, so it is only believed from a trusted proxy.
+    remote_addr = request.META.get('REMOTE_ADDR', '')
+    real_ip = request.headers.get('X-Real-IP')
+    if real_ip and is_trusted_proxy(remote_addr):
+        return real_ip
+    return remote_addr
+
+
+async def rate_limit(request, cost: int = 1):
+    # raises Overloaded once the client used up its submissions
+    if settings.SUBMIT_RATE_LIMIT:
+        wait = await rate_limiter.acquire(client_id(request), cost)
+        if wait:
+            ADMISSION_DECISIONS.labels('rate_limited').inc()
+            raise Overloaded('Rate limit exceeded', wait)
+
+
+async def shed_load() -> Admission:
+    # for submissions left to the workers, raises Overloaded when they are too
+    # far behind to take more
+    admission = await pipeline_lag.admission()
+    ADMISSION_DECISIONS.labels(admission).inc()
+    if admission == Admission.REJECT:
+        raise Overloaded(
+            'Processing is behind, try again later', settings.ADMISSION_RETRY_AFTER
+        )
+    return admission
+
+
+async def admit(request, cost: int = 1) -> Admission:
+    """
+    Rate limits the client, then sheds load while the workers are behind.
+    Raises Overloaded for requests that should be retried later.
+    """
+    await rate_limit(request, cost)
+    return await shed_load()
+
+
+pipeline_lag = PipelineLag(settings.ADMISSION_CHECK_INTERVAL)
+rate_limiter = RateLimiter(settings.SUBMIT_RATE_LIMIT, settings.SUBMIT_RATE_BURST)
@@ -1,101 +1,567 @@
+import asyncio
+import contextlib
+import json
 import logging
 from enum import StrEnum
-from hashlib import sha256
+from itertools import batched
+from time import perf_counter
 
-from celery.result import AsyncResult
-from django.core.cache import cache
-from django.shortcuts import aget_object_or_404
-from ninja import Router
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import IntegrityError
+from django.http import Http404, StreamingHttpResponse
+from ninja import Query, Router
 from ninja.errors import HttpError
-from ninja.pagination import paginate, LimitOffsetPagination
+from pydantic import ValidationError
 
-from core.elk import es_service
-from core.models import TextSubmission
+from core.admission import Admission, admit, rate_limit, shed_load
+from core.batcher import processing_batcher
+from core.cache import (
+    ENTRY_OVERHEAD,
+    censor_engines,
+    existence_filter,
+    publish_invalidations,
+    result_cache,
+    wordlist_profiles,
+)
+from core.censor import censor_engine, mask, unpack_spans
+from core.elk import (
+    MAX_RESULT_WINDOW,
+    InvalidCursor,
+    SearchCursor,
+    SearchUnavailable,
+    es_service,
+)
+from core.metrics import (
+    EXISTENCE_FILTER_LOOKUPS,
+    PIPELINE_STAGE_SECONDS,
+    SUBMIT_QUERIES_SAVED,
+    size_bucket,
+)
+from core.models import (
+    ProcessingStatus,
+    TextSubmission,
+    TextVariant,
+    WordlistVersion,
+    submission_text,
+    hash_text,
+    variant_spans,
+)
 from core.schemas import (
-    SearchResponseSchema,
+    SearchPageSchema,
+    SubmitBatchResponseSchema,
     SubmitResponseSchema,
     SubmitTextSchema,
+    ResultItemSchema,
     ResultResponseSchema,
+    ResultsRequestSchema,
+    ResultsResponseSchema,
     ErrorResponseSchema,
 )
-from core.tasks import process_text
+from core.tasks import blur_spans, process_texts
 
 logger = logging.getLogger(__name__)
 router = Router()
 
-CACHE_TTL = 3600  # 1 hour in seconds
+FINAL_STATUSES = (ProcessingStatus.SUCCESS, ProcessingStatus.FAILURE)
+STREAM_KEEPALIVE = 15  # seconds between SSE comments on an idle stream
+NOT_FOUND = 'NOT_FOUND'  # status of unknown text_ids in /api/results/
+CURSOR_START = 'start'  # ?cursor= of the first page of a cursor walk
 
 
-class TaskStatus(StrEnum):
-    SUCCESS = 'SUCCESS'
-    FAILURE = 'FAILURE'
+def build_result(result_data: dict) -> ResultResponseSchema:
+    # only the packed spans are cached, the processed text is rebuilt on read.
+    # result_data may be shared with the in-process cache, so it is not modified.
+    # When the caller sent a variant, the stored spans point into the canonical
+    # text: it is the one processed, and the spans are mapped onto the variant
+    fields = {
+        key: value
+        for key, value in result_data.items()
+        if key not in ('censor_spans', 'canonical')
+    }
+    packed_spans = result_data.get('censor_spans')
+    if packed_spans is not None:
+        spans = unpack_spans(packed_spans)
+        canonical = result_data.get('canonical')
+        if canonical is None:
+            fields['spans'] = spans
+            fields['processed'] = mask(fields['original'], spans)
+        else:
+            fields['spans'] = variant_spans(fields['original'], spans)
+            fields['processed'] = mask(canonical, spans)
+    return ResultResponseSchema(**fields)
+
+
+def submission_result(obj: TextSubmission, original: str | None = None) -> dict:
+    # original is the text of the variant the result was requested for
+    return {
+        'status': obj.status,
+        'original': obj.original_text if original is None else original,
+        'canonical': None if original is None else obj.original_text,
+        'censor_spans': None if obj.censor_spans is None else bytes(obj.censor_spans),
+        'processed_dt': obj.updated_at,
+        'detail': obj.status_detail,
+    }
 
 
-@router.post('/submit/', response=SubmitResponseSchema)
+async def get_or_create_submission(
+    text_hash: str, defaults: dict, prepare=None
+) -> tuple[TextSubmission, bool]:
+    # Most submitted texts are new, the filter lets them skip the SELECT and
+    # go straight to the INSERT. prepare() is only awaited for a new row,
+    # right before the INSERT, and returns more of its fields.
+    filtered = settings.EXISTENCE_FILTER
+    maybe_stored = not filtered or await existence_filter.might_contain(text_hash)
+    if maybe_stored:
+        try:
+            obj = await TextSubmission.objects.aget(text_hash=text_hash)
+        except TextSubmission.DoesNotExist:
+            pass
+        else:
+            if filtered:
+                EXISTENCE_FILTER_LOOKUPS.labels('present').inc()
+            return obj, False
+
+    if prepare is not None:
+        defaults = {**defaults, **await prepare()}
+    try:
+        obj = await TextSubmission.objects.acreate(text_hash=text_hash, **defaults)
+    except IntegrityError:
+        # stored by a concurrent request, or before the filter was rebuilt
+        if filtered and not maybe_stored:
+            EXISTENCE_FILTER_LOOKUPS.labels('false_negative').inc()
+        obj, created = await TextSubmission.objects.aget(text_hash=text_hash), False
+    else:
+        if filtered and maybe_stored:
+            EXISTENCE_FILTER_LOOKUPS.labels('false_positive').inc()
+        elif filtered:
+            EXISTENCE_FILTER_LOOKUPS.labels('new').inc()
+            SUBMIT_QUERIES_SAVED.inc()
+        created = True
+    if filtered:
+        await existence_filter.add([text_hash])
+    return obj, created
+
+
+async def current_wordlist(profile: str | None) -> WordlistVersion | None:
+    """
+    The version of the wordlist profile new submissions are censored with,
+    None for the default wordlist. Looked up at most every
+    WORDLIST_PROFILE_TTL seconds per profile, a changed profile is picked
+    up within that time. A version compiling to the default wordlist is
+    treated as the default, so its texts share the default results.
+    """
+    if profile is None:
+        return None
+
+    key = f'profile:{profile}'
+    wordlist = wordlist_profiles.get(key)
+    if wordlist is None:
+        wordlist = (
+            await WordlistVersion.objects.filter(profile__name=profile)
+            .order_by('-number')
+            .afirst()
+        )
+        if wordlist is None:
+            raise HttpError(400, f'Unknown wordlist profile {profile}')
+        wordlist_profiles.set(
+            key,
+            wordlist,
+            ENTRY_OVERHEAD + len(wordlist.words) + len(wordlist.allowed),
+        )
+
+    if wordlist.fingerprint == censor_engine.fingerprint:
+        return None
+    return wordlist
+
+
+@router.post(
+    '/submit/',
+    response={
+        200: SubmitResponseSchema,
+        400: ErrorResponseSchema,
+        429: ErrorResponseSchema,
+    },
+)
 async def submit_text(request, payload: SubmitTextSchema):
-    text_hash = sha256(payload.text.encode()).hexdigest()
+    wordlist = await current_wordlist(payload.profile)
+    await rate_limit(request)
+
+    # the caller gets the hash of what they sent, the submission is stored
+    # and processed under the hash of its canonical form. Both include the
+    # wordlist, the same text censored with another one is another submission.
+    fingerprint = wordlist.fingerprint if wordlist else None
+    text_id = hash_text(payload.text, fingerprint)
+    text = submission_text(payload.text)
+    text_hash = hash_text(text, fingerprint)
+    defaults = {'original_text': text, 'wordlist': wordlist}
+
+    # Small texts are censored right here, a round trip through Celery costs
+    # far more than the censor itself, and the workers' lag does not hold them
+    # back. Only new or unprocessed rows are censored, indexing is left to
+    # index_unindexed_texts.
+    async def censor() -> dict:
+        start = perf_counter()
+        engine = censor_engines.get(wordlist.id if wordlist else None)
+        if engine is None:
+            engine = await sync_to_async(
+                censor_engines.compile, thread_sensitive=False
+            )(wordlist)
+        spans = await sync_to_async(blur_spans, thread_sensitive=False)(text, engine)
+        PIPELINE_STAGE_SECONDS.labels(
+            'submit_text', 'censor', size_bucket(len(text))
+        ).observe(perf_counter() - start)
+        return {'spans': spans, 'status': ProcessingStatus.SUCCESS}
+
+    if len(text.encode()) <= settings.INLINE_CENSOR_MAX_BYTES:
+        admission = None
+        obj, created = await get_or_create_submission(text_hash, defaults, censor)
+        if obj.censor_spans is None:
+            # stored earlier and still waiting for a worker
+            obj.spans = (await censor())['spans']
+            obj.status = ProcessingStatus.SUCCESS
+            obj.status_detail = ''
+            await obj.asave(
+                update_fields=['censor_spans', 'status', 'status_detail', 'updated_at']
+            )
+            await sync_to_async(publish_invalidations, thread_sensitive=False)(
+                [text_hash]
+            )
+    else:
+        admission = await shed_load()
+        obj, created = await get_or_create_submission(text_hash, defaults)
+
+    original = None
+    if text_id != text_hash:
+        original = payload.text
+        # a variant maps to one submission for good, an existing row needs no SELECT
+        await TextVariant.objects.abulk_create(
+            [TextVariant(text_hash=text_id, submission=obj, original_text=original)],
+            ignore_conflicts=True,
+        )
+
+    if created and admission == Admission.ACCEPT:
+        processing_batcher.add(text_hash)
+
+    result = None
+    if obj.status == ProcessingStatus.SUCCESS:
+        result = build_result(submission_result(obj, original))
+
+    return SubmitResponseSchema(text_id=text_id, result=result)
+
+
+def parse_batch(request) -> list[SubmitTextSchema]:
+    # JSON array of {"text": ..., "profile": ...} objects or NDJSON with one
+    # object per line
+    try:
+        if request.content_type == 'application/x-ndjson':
+            items = [
+                json.loads(line) for line in request.body.splitlines() if line.strip()
+            ]
+        else:
+            items = json.loads(request.body)
+    except ValueError:
+        raise HttpError(400, 'Invalid JSON payload')
+
+    if not isinstance(items, list) or not items:
+        raise HttpError(400, 'Expected a non-empty list of texts')
+    if len(items) > settings.SUBMIT_BATCH_MAX_SIZE:
+        raise HttpError(
+            413,
+            f'Batch cannot contain more than {settings.SUBMIT_BATCH_MAX_SIZE} texts',
+        )
+
+    try:
+        return [SubmitTextSchema.model_validate(item) for item in items]
+    except ValidationError:
+        raise HttpError(400, 'Each item must be an object with a text field')
+
+
+@router.post(
+    '/submit/batch/',
+    response={
+        200: SubmitBatchResponseSchema,
+        400: ErrorResponseSchema,
+        413: ErrorResponseSchema,
+        429: ErrorResponseSchema,
+    },
+)
+async def submit_batch(request):
+    items = parse_batch(request)
+    wordlists = {
+        profile: await current_wordlist(profile)
+        for profile in {item.profile for item in items}
+    }
+    admission = await admit(request, cost=len(items))
+
+    texts = [item.text for item in items]
+    item_wordlists = [wordlists[item.profile] for item in items]
+    fingerprints = [
+        wordlist.fingerprint if wordlist else None for wordlist in item_wordlists
+    ]
+    text_ids = [
+        hash_text(text, fingerprint) for text, fingerprint in zip(texts, fingerprints)
+    ]
+    canonical_texts = [submission_text(text) for text in texts]
+    text_hashes = [
+        hash_text(text, fingerprint)
+        for text, fingerprint in zip(canonical_texts, fingerprints)
+    ]
+    texts_by_hash = dict(zip(text_hashes, canonical_texts))
+    wordlists_by_hash = dict(zip(text_hashes, item_wordlists))
+
+    existing = {
+        text_hash
+        async for text_hash in TextSubmission.objects.filter(
+            text_hash__in=list(texts_by_hash)
+        ).values_list('text_hash', flat=True)
+    }
+    new_hashes = [text_hash for text_hash in texts_by_hash if text_hash not in existing]
+
+    if new_hashes:
+        await TextSubmission.objects.abulk_create(
+            [
+                TextSubmission(
+                    text_hash=text_hash,
+                    original_text=texts_by_hash[text_hash],
+                    wordlist=wordlists_by_hash[text_hash],
+                )
+                for text_hash in new_hashes
+            ],
+            ignore_conflicts=True,
+        )
+        if settings.EXISTENCE_FILTER:
+            await existence_filter.add(new_hashes)
+        if admission == Admission.ACCEPT:
+            for chunk in batched(new_hashes, settings.SUBMIT_BATCH_CHUNK_SIZE):
+                process_texts.apply_async(
+                    args=[list(chunk)], priority=settings.SUBMIT_BATCH_PRIORITY
+                )
+
+    variants = {
+        text_id: (text_hash, text)
+        for text_id, text_hash, text in zip(text_ids, text_hashes, texts)
+        if text_id != text_hash
+    }
+    if variants:
+        submission_ids = {
+            text_hash: submission_id
+            async for text_hash, submission_id in TextSubmission.objects.filter(
+                text_hash__in={text_hash for text_hash, _ in variants.values()}
+            ).values_list('text_hash', 'id')
+        }
+        await TextVariant.objects.abulk_create(
+            [
+                TextVariant(
+                    text_hash=text_id,
+                    submission_id=submission_ids[text_hash],
+                    original_text=text,
+                )
+                for text_id, (text_hash, text) in variants.items()
+            ],
+            ignore_conflicts=True,
+        )
+
+    return SubmitBatchResponseSchema(text_ids=text_ids)
+
+
+async def fetch_results(text_hashes: list[str]) -> dict[str, dict]:
+    # text_hashes are text_ids returned on submit, either the hash of a
+    # canonical text or of a variant of it. One query for the submissions,
+    # and one for the variants among the rest
+    results = {
+        obj.text_hash: submission_result(obj)
+        async for obj in TextSubmission.objects.filter(text_hash__in=text_hashes)
+    }
+    missing = [text_hash for text_hash in text_hashes if text_hash not in results]
+    if missing:
+        async for variant in TextVariant.objects.select_related('submission').filter(
+            text_hash__in=missing
+        ):
+            results[variant.text_hash] = submission_result(
+                variant.submission, variant.original_text
+            )
+    return results
+
 
-    obj, created = await TextSubmission.objects.aget_or_create(
-        text_hash=text_hash, defaults={'original_text': payload.text}
+async def cache_results(results: dict[str, dict]):
+    await result_cache.set_many(
+        {
+            text_hash: result_data
+            for text_hash, result_data in results.items()
+            if result_data['status'] == ProcessingStatus.SUCCESS
+        }
     )
+    for text_hash, result_data in results.items():
+        if result_data['status'] != ProcessingStatus.SUCCESS:
+            # absorbs clients polling for a pending result, dropped by the
+            # invalidation listener as soon as a worker saves it
+            result_cache.set_pending(text_hash, result_data)
 
-    if created and not obj.processed_text:
-        process_text.apply_async(args=[text_hash], task_id=text_hash)
 
-    return SubmitResponseSchema(text_id=text_hash)
+async def load_result(text_hash: str) -> dict:
+    # hits are counted in blurifier_result_cache_lookups_total
+    if cached_result := await result_cache.get(text_hash):
+        return cached_result
+
+    results = await fetch_results([text_hash])
+    if text_hash not in results:
+        raise Http404('No TextSubmission matches the given query.')
+    await cache_results(results)
+    return results[text_hash]
 
 
 @router.get(
     '/result/{text_hash}/',
     response={200: ResultResponseSchema, 404: ErrorResponseSchema},
 )
-async def get_result(request, text_hash: str):
-    cache_key = f'result:{text_hash}'
-    if cached_result := cache.get(cache_key):
-        logger.info('Cache hit for text hash: %s', text_hash)
-        return ResultResponseSchema(**cached_result)
+async def get_result(
+    request,
+    text_hash: str,
+    wait: float = Query(0, ge=0, le=settings.RESULT_WAIT_MAX),
+):
+    # ?wait=seconds holds the request until the result is final or the
+    # time is up, instead of the client polling
+    with result_cache.waiter(text_hash) as done:
+        result_data = await load_result(text_hash)
+        if wait and result_data['status'] not in FINAL_STATUSES:
+            with contextlib.suppress(TimeoutError):
+                await asyncio.wait_for(done.wait(), wait)
+            result_data = await load_result(text_hash)
 
-    obj = await aget_object_or_404(TextSubmission, text_hash=text_hash)
+    return build_result(result_data)
 
-    task_result = AsyncResult(text_hash)
-    status = task_result.status
 
-    if obj.processed_text:
-        status = TaskStatus.SUCCESS
+async def result_events(text_hash: str, result_data: dict):
+    # an event for every status change, the stream ends with the final one
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + settings.RESULT_STREAM_TIMEOUT
+    with result_cache.waiter(text_hash) as changed:
+        # a change notified before the waiter was registered would be missed
+        if result_data['status'] not in FINAL_STATUSES:
+            result_data = await load_result(text_hash)
+        status = None
+        while True:
+            if result_data['status'] != status:
+                status = result_data['status']
+                yield f'event: result\ndata: {build_result(result_data).model_dump_json()}\n\n'
+            if status in FINAL_STATUSES or loop.time() >= deadline:
+                return
 
-    result_data = {
-        'status': status,
-        'original': obj.original_text,
-        'processed': obj.processed_text,
-        'processed_dt': obj.updated_at,
-        'detail': task_result.info if status == TaskStatus.FAILURE else '',
-    }
+            try:
+                await asyncio.wait_for(
+                    changed.wait(), min(STREAM_KEEPALIVE, deadline - loop.time())
+                )
+            except TimeoutError:
+                yield ': keepalive\n\n'
+            # cleared before the lookup, a change during it sets it again
+            changed.clear()
+            result_data = await load_result(text_hash)
+
+
+@router.get(
+    '/result/{text_hash}/events/',
+    response={404: ErrorResponseSchema},
+)
+async def stream_result(request, text_hash: str):
+    # the first lookup happens before streaming so unknown hashes get a 404
+    result_data = await load_result(text_hash)
+    response = StreamingHttpResponse(
+        result_events(text_hash, result_data), content_type='text/event-stream'
+    )
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
 
-    if status == TaskStatus.SUCCESS:
-        cache.set(cache_key, result_data, timeout=CACHE_TTL)
 
-    return ResultResponseSchema(**result_data)
+@router.post(
+    '/results/',
+    response={200: ResultsResponseSchema, 413: ErrorResponseSchema},
+)
+async def get_results(request, payload: ResultsRequestSchema):
+    # results of many texts at once, e.g. after /api/submit/batch/: one MGET
+    # for the cached ones, one query for the rest and one pipeline to cache them
+    if len(payload.text_ids) > settings.RESULTS_BATCH_MAX_SIZE:
+        raise HttpError(
+            413,
+            f'Cannot request more than {settings.RESULTS_BATCH_MAX_SIZE} results',
+        )
+
+    text_hashes = list(dict.fromkeys(payload.text_ids))
+    results = await result_cache.get_many(text_hashes)
+    if missing := [text_hash for text_hash in text_hashes if text_hash not in results]:
+        fetched = await fetch_results(missing)
+        await cache_results(fetched)
+        results.update(fetched)
+
+    items = []
+    for text_id in payload.text_ids:
+        if (result_data := results.get(text_id)) is None:
+            items.append(ResultItemSchema(text_id=text_id, status=NOT_FOUND))
+        else:
+            items.append(
+                ResultItemSchema(
+                    text_id=text_id,
+                    status=result_data['status'],
+                    result=build_result(result_data),
+                )
+            )
+    return ResultsResponseSchema(items=items)
+
+
+class SearchFields(StrEnum):
+    ALL = 'all'
+    PROCESSED = 'processed'
 
 
 @router.get(
     '/search/',
     response={
-        200: list[SearchResponseSchema],
+        200: SearchPageSchema,
         400: ErrorResponseSchema,
         404: ErrorResponseSchema,
-        500: ErrorResponseSchema,
+        503: ErrorResponseSchema,
     },
 )
-@paginate(LimitOffsetPagination)
-async def search_texts(request, query: str):
-    created = await es_service.create_index()
-    if not created:
-        raise HttpError(500, 'Failed to create Elasticsearch index')
-
+async def search_texts(
+    request,
+    query: str,
+    limit: int = Query(10, ge=1, le=settings.NINJA_PAGINATION_MAX_LIMIT),
+    offset: int = Query(0, ge=0),
+    cursor: str | None = None,
+    fields: SearchFields = SearchFields.ALL,
+):
     if not query.strip():
         raise HttpError(400, 'Query parameter cannot be empty')
 
-    # probably better to paginate this at the Elasticsearch level but for learning purposes we will paginate here
-    results = await es_service.search_text(query)
+    # ?cursor=start asks for cursor paging from this offset page on, the
+    # next_cursor of every page leads to the next one
+    search_cursor = None
+    if cursor and cursor != CURSOR_START:
+        try:
+            search_cursor = SearchCursor.decode(cursor)
+        except InvalidCursor as e:
+            raise HttpError(400, str(e))
+    elif offset + limit > MAX_RESULT_WINDOW:
+        raise HttpError(
+            400, f'Use cursor paging to go past {MAX_RESULT_WINDOW} results'
+        )
 
-    return results
+    # the index is created on startup, this only hits ES if that failed
+    # or the index was deleted since
+    if not await es_service.ensure_index():
+        raise HttpError(503, 'Failed to create Elasticsearch index')
+
+    try:
+        return await es_service.search_text(
+            query,
+            limit,
+            offset=offset,
+            cursor=search_cursor,
+            start_cursor=cursor == CURSOR_START,
+            include_original=fields == SearchFields.ALL,
+        )
+    except InvalidCursor as e:
+        raise HttpError(400, str(e))
+    except SearchUnavailable as e:
+        raise HttpError(503, str(e))
@@ -0,0 +1,51 @@
+import asyncio
+import atexit
+
+from django.conf import settings
+
+from core.tasks import process_texts
+from core.tracing import trace_id_var
+
+
+class ProcessingBatcher:
+    """
+    Merges text hashes submitted to this process into ``process_texts``
+    messages, sent once ``max_size`` hashes are pending or ``max_delay``
+    seconds after the first pending one. Hashes lost with the process
+    are picked up by ``process_unprocessed_texts``. A message carries the
+    trace id of the request that started its batch.
+    """
+
+    def __init__(self, max_size: int, max_delay: float):
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self._pending: list[str] = []
+        self._trace_id: str | None = None
+        self._flush_handle: asyncio.TimerHandle | None = None
+
+    def add(self, text_hash: str):
+        if not self._pending:
+            self._trace_id = trace_id_var.get()
+        self._pending.append(text_hash)
+
+        if len(self._pending) >= self.max_size or self.max_delay <= 0:
+            self.flush()
+        elif self._flush_handle is None:
+            loop = asyncio.get_running_loop()
+            self._flush_handle = loop.call_later(self.max_delay, self.flush)
+
+    def flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        text_hashes, self._pending = self._pending, []
+        if text_hashes:
+            headers = {'trace_id': self._trace_id} if self._trace_id else None
+            process_texts.apply_async(args=[text_hashes], headers=headers)
+
+
+processing_batcher = ProcessingBatcher(
+    settings.PROCESS_BATCH_SIZE, settings.PROCESS_BATCH_WINDOW
+)
+atexit.register(processing_batcher.flush)
@@ -0,0 +1,495 @@
+import asyncio
+import logging
+import pickle
+import weakref
+from hashlib import sha256
+from collections import OrderedDict
+from collections.abc import Iterable, Iterator
+from itertools import batched
+from contextlib import contextmanager
+from threading import Lock
+from time import monotonic
+from typing import TYPE_CHECKING
+
+import redis
+import redis.asyncio
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.cache.backends.redis import RedisCache
+
+from core.censor import CensorEngine, censor_engine, scan_chunk
+from core.metrics import (
+    CENSOR_CACHE_CHUNKS,
+    CENSOR_ENGINE_LOOKUPS,
+    RESULT_CACHE_LOOKUPS,
+)
+
+if TYPE_CHECKING:
+    from core.models import WordlistVersion
+
+logger = logging.getLogger(__name__)
+
+CACHE_TTL = 3600  # 1 hour in seconds
+INVALIDATION_CHANNEL = 'result-invalidations'
+ENTRY_OVERHEAD = 256  # rough size of the dict, datetime and status of a result
+
+
+class LocalLRUCache:
+    """
+    Bounded in-process cache. Entries expire after their TTL, and the least
+    recently used ones are evicted once the total size exceeds ``max_bytes``.
+    Not thread-safe, it is only used from the event loop.
+    """
+
+    def __init__(self, max_bytes: int, ttl: float):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self._entries: OrderedDict[str, tuple[float, int, object]] = OrderedDict()
+
+    def get(self, key: str):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        expires_at, _, value = entry
+        if expires_at <= monotonic():
+            self.delete(key)
+            return None
+
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: str, value, size: int, ttl: float | None = None):
+        self.delete(key)
+        if size > self.max_bytes:
+            return
+
+        expires_at = monotonic() + (self.ttl if ttl is None else ttl)
+        self._entries[key] = (expires_at, size, value)
+        self.size += size
+
+        while self.size > self.max_bytes:
+            _, (_, evicted_size, _) = self._entries.popitem(last=False)
+            self.size -= evicted_size
+
+    def delete(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+
+def _cache_connection_pool() -> redis.ConnectionPool:
+    # the cache backend's pool, django-redis in production and Django's own
+    # RedisCache in tests
+    backend = caches['default']
+    client = backend._cache if isinstance(backend, RedisCache) else backend.client
+    return client.get_client(write=True).connection_pool
+
+
+def redis_client() -> redis.Redis:
+    # dedicated client with the same server and connection options as the cache
+    pool = _cache_connection_pool()
+    return redis.Redis(
+        connection_pool=type(pool)(
+            connection_class=pool.connection_class, **pool.connection_kwargs
+        )
+    )
+
+
+def async_redis_client() -> redis.asyncio.Redis:
+    # the parser class of the sync pool does not work with asyncio connections
+    options = _cache_connection_pool().connection_kwargs
+    return redis.asyncio.Redis(
+        **{key: value for key, value in options.items() if key != 'parser_class'}
+    )
+
+
+# redis.asyncio connections are bound to the loop that opened them
+_loop_clients: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+def loop_redis_client() -> redis.asyncio.Redis:
+    # shared by the request path of everything running in this event loop
+    loop = asyncio.get_running_loop()
+    client = _loop_clients.get(loop)
+    if client is None:
+        client = async_redis_client()
+        _loop_clients[loop] = client
+    return client
+
+
+async def close_loop_redis_client():
+    client = _loop_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+
+def result_key(text_hash: str) -> str:
+    return f'result:{text_hash}'
+
+
+def result_size(result_data: dict) -> int:
+    return (
+        ENTRY_OVERHEAD
+        + len(result_data['original'])
+        + len(result_data.get('canonical') or '')
+        + len(result_data.get('censor_spans') or b'')
+        + len(result_data.get('detail') or '')
+    )
+
+
+class ResultCache:
+    """
+    Results served by get_result, kept in a per-process LRU in front of
+    Redis, read and written with the event loop's asyncio client. Pending
+    results are only cached locally for a short time, workers publish the
+    processed hashes so every web process drops them as soon as a final
+    result exists, and wakes up the requests waiting for them. Redis errors
+    are logged and treated as misses.
+    """
+
+    def __init__(self):
+        self.local = LocalLRUCache(
+            settings.RESULT_CACHE_LOCAL_MAX_BYTES, settings.RESULT_CACHE_LOCAL_TTL
+        )
+        self._waiters: dict[str, set[asyncio.Event]] = {}
+
+    async def get(self, text_hash: str) -> dict | None:
+        key = result_key(text_hash)
+        if (result_data := self.local.get(key)) is not None:
+            RESULT_CACHE_LOOKUPS.labels('local_hit').inc()
+            return result_data
+
+        try:
+            data = await loop_redis_client().get(key)
+        except redis.RedisError as e:
+            logger.error('Result cache lookup failed: %s', e)
+            data = None
+
+        if data is None:
+            RESULT_CACHE_LOOKUPS.labels('miss').inc()
+            return None
+        RESULT_CACHE_LOOKUPS.labels('redis_hit').inc()
+        result_data = pickle.loads(data)
+        self.local.set(key, result_data, result_size(result_data))
+        return result_data
+
+    async def set(self, text_hash: str, result_data: dict):
+        key = result_key(text_hash)
+        self.local.set(key, result_data, result_size(result_data))
+        try:
+            await loop_redis_client().set(
+                key, pickle.dumps(result_data, pickle.HIGHEST_PROTOCOL), ex=CACHE_TTL
+            )
+        except redis.RedisError as e:
+            logger.error('Result cache update failed: %s', e)
+
+    async def get_many(self, text_hashes: list[str]) -> dict[str, dict]:
+        # one MGET for everything missing from the local tier
+        found = {}
+        missing = {}
+        for text_hash in text_hashes:
+            key = result_key(text_hash)
+            if (result_data := self.local.get(key)) is not None:
+                found[text_hash] = result_data
+            else:
+                missing[key] = text_hash
+
+        local_hits = len(found)
+        if missing:
+            try:
+                values = await loop_redis_client().mget(list(missing))
+            except redis.RedisError as e:
+                logger.error('Result cache lookup failed: %s', e)
+                values = [None] * len(missing)
+            for key, data in zip(missing, values):
+                if data is not None:
+                    result_data = pickle.loads(data)
+                    self.local.set(key, result_data, result_size(result_data))
+                    found[missing[key]] = result_data
+
+        RESULT_CACHE_LOOKUPS.labels('local_hit').inc(local_hits)
+        RESULT_CACHE_LOOKUPS.labels('redis_hit').inc(len(found) - local_hits)
+        RESULT_CACHE_LOOKUPS.labels('miss').inc(len(text_hashes) - len(found))
+        return found
+
+    async def set_many(self, results: dict[str, dict]):
+        # pipelined SETs in one round trip
+        if not results:
+            return
+        try:
+            async with loop_redis_client().pipeline(transaction=False) as pipe:
+                for text_hash, result_data in results.items():
+                    key = result_key(text_hash)
+                    self.local.set(key, result_data, result_size(result_data))
+                    pipe.set(
+                        key,
+                        pickle.dumps(result_data, pickle.HIGHEST_PROTOCOL),
+                        ex=CACHE_TTL,
+                    )
+                await pipe.execute()
+        except redis.RedisError as e:
+            logger.error('Result cache update failed: %s', e)
+
+    def set_pending(self, text_hash: str, result_data: dict):
+        self.local.set(
+            result_key(text_hash),
+            result_data,
+            result_size(result_data),
+            ttl=settings.RESULT_CACHE_PENDING_TTL,
+        )
+
+    def invalidate(self, text_hashes: Iterable[str]):
+        for text_hash in text_hashes:
+            self.local.delete(result_key(text_hash))
+            for event in self._waiters.get(text_hash, ()):
+                event.set()
+
+    @contextmanager
+    def waiter(self, text_hash: str) -> Iterator[asyncio.Event]:
+        # register before reading the result, so a notification published
+        # in between is not missed
+        event = asyncio.Event()
+        self._waiters.setdefault(text_hash, set()).add(event)
+        try:
+            yield event
+        finally:
+            waiters = self._waiters[text_hash]
+            waiters.discard(event)
+            if not waiters:
+                del self._waiters[text_hash]
+
+    async def listen_for_invalidations(self):
+        # runs for the lifetime of the ASGI worker, reconnects if Redis goes away
+        client = async_redis_client()
+        while True:
+            try:
+                async with client.pubsub() as pubsub:
+                    await pubsub.subscribe(INVALIDATION_CHANNEL)
+                    # anything cached while we were not subscribed may be stale
+                    self.local.clear()
+                    async for message in pubsub.listen():
+                        if message['type'] == 'message':
+                            self.invalidate(message['data'].decode().split(','))
+            except asyncio.CancelledError:
+                await client.aclose()
+                raise
+            except redis.RedisError as e:
+                logger.error('Result invalidation listener failed: %s', e)
+                await asyncio.sleep(1)
+
+
+_publisher: redis.Redis | None = None
+
+
+def publish_invalidations(text_hashes: list[str]):
+    # called by the workers once the submissions are saved
+    global _publisher
+    if not text_hashes:
+        return
+    if _publisher is None:
+        _publisher = redis_client()
+    try:
+        _publisher.publish(INVALIDATION_CHANNEL, ','.join(text_hashes))
+    except redis.RedisError as e:
+        # local entries still expire after RESULT_CACHE_PENDING_TTL
+        logger.error('Failed to publish result invalidations: %s', e)
+
+
+def close_publisher():
+    global _publisher
+    if _publisher is not None:
+        _publisher.connection_pool.disconnect()
+        _publisher = None
+
+
+def chunk_key(job) -> str:
+    engine, text, stop, at_end = job
+    digest = sha256(f'{stop}:{at_end:d}:{text}'.encode()).hexdigest()
+    return f'censor:{engine.fingerprint[:16]}:{digest}'
+
+
+def chunk_slot(key: str) -> str:
+    # the Redis tier is CENSOR_CACHE_REDIS_SLOTS keys, a sentence takes the
+    # slot of whatever other sentence was cached there
+    return f'censor:slot:{int(key[-16:], 16) % settings.CENSOR_CACHE_REDIS_SLOTS}'
+
+
+def chunk_size(result) -> int:
+    spans, _, visited = result
+    return ENTRY_OVERHEAD + 16 * len(spans) + 8 * len(visited)
+
+
+class CensorChunkCache:
+    """
+    Scan results of sentence chunks (see ``CensorEngine.spans_chunked``),
+    kept in a per-process LRU in front of Redis. Templated and forwarded
+    texts share most of their sentences, only the missing ones are scanned.
+    In Redis every result is stored with its key in one of a fixed number of
+    slots, so backfills cannot grow it past that. Used from the Celery
+    workers, so the cache calls are sync.
+    """
+
+    def __init__(self):
+        self.local = LocalLRUCache(
+            settings.CENSOR_CACHE_LOCAL_MAX_BYTES, settings.CENSOR_CACHE_TTL
+        )
+
+    def scan(self, jobs: list) -> list:
+        keys = [chunk_key(job) for job in jobs]
+        results = [self.local.get(key) for key in keys]
+        local_hits = sum(result is not None for result in results)
+
+        slots = {
+            key: chunk_slot(key) for key, result in zip(keys, results) if result is None
+        }
+        stored = cache.get_many(set(slots.values())) if slots else {}
+        found = {}
+        for key, slot in slots.items():
+            if slot in stored and stored[slot][0] == key:
+                found[key] = stored[slot][1]
+
+        scanned = {}
+        redis_hits = 0
+        for index, key in enumerate(keys):
+            if results[index] is not None:
+                continue
+            if key in found:
+                results[index] = found[key]
+                redis_hits += 1
+            else:
+                # a sentence repeated in the same text is only scanned once
+                if key not in scanned:
+                    scanned[key] = scan_chunk(jobs[index])
+                results[index] = scanned[key]
+            self.local.set(key, results[index], chunk_size(results[index]))
+
+        if scanned:
+            cache.set_many(
+                {chunk_slot(key): (key, result) for key, result in scanned.items()},
+                timeout=settings.CENSOR_CACHE_TTL,
+            )
+
+        CENSOR_CACHE_CHUNKS.labels('local_hit').inc(local_hits)
+        CENSOR_CACHE_CHUNKS.labels('redis_hit').inc(redis_hits)
+        CENSOR_CACHE_CHUNKS.labels('miss').inc(len(jobs) - local_hits - redis_hits)
+        return results
+
+
+class CensorEngineCache:
+    """
+    Compiled CensorEngines of wordlist profile versions, the least recently
+    used dropped past ``max_size``. Versions never change, so an engine
+    never goes stale. Used from the workers and from the threads submit
+    censors in, hence the lock.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._engines: OrderedDict[int, CensorEngine] = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, wordlist_id: int | None) -> CensorEngine | None:
+        if wordlist_id is None:
+            return censor_engine
+        with self._lock:
+            engine = self._engines.get(wordlist_id)
+            if engine is not None:
+                self._engines.move_to_end(wordlist_id)
+        CENSOR_ENGINE_LOOKUPS.labels('hit' if engine else 'miss').inc()
+        return engine
+
+    def compile(self, wordlist: 'WordlistVersion') -> CensorEngine:
+        # outside the lock, two threads may compile the same version at once
+        engine = wordlist.engine()
+        with self._lock:
+            self._engines[wordlist.id] = engine
+            self._engines.move_to_end(wordlist.id)
+            while len(self._engines) > self.max_size:
+                self._engines.popitem(last=False)
+        return engine
+
+    def clear(self):
+        with self._lock:
+            self._engines.clear()
+
+
+class ExistenceFilter:
+    """
+    Bloom filter of the stored text hashes, a Redis bitmap of ``bits`` bits
+    with ``hashes`` bits set per text. A miss means the text is definitely
+    new, so submit can insert it without looking it up first. Texts it
+    wrongly reports as new only cost a failed INSERT, so it can be rebuilt
+    with ``rebuild_existence_filter`` at any time.
+    """
+
+    key = 'texts:exist'
+
+    def __init__(self, bits: int, hashes: int):
+        self.bits = bits
+        self.hashes = hashes
+
+    def offsets(self, text_hash: str) -> list[int]:
+        # text_hash is already a sha256, two 64 bit halves of it are enough
+        # for double hashing
+        first, second = int(text_hash[:16], 16), int(text_hash[16:32], 16) | 1
+        return [(first + i * second) % self.bits for i in range(self.hashes)]
+
+    async def might_contain(self, text_hash: str) -> bool:
+        try:
+            async with loop_redis_client().pipeline(transaction=False) as pipe:
+                for offset in self.offsets(text_hash):
+                    pipe.getbit(self.key, offset)
+                return all(await pipe.execute())
+        except redis.RedisError as e:
+            logger.error('Existence filter lookup failed: %s', e)
+            return True
+
+    async def add(self, text_hashes: Iterable[str]):
+        try:
+            async with loop_redis_client().pipeline(transaction=False) as pipe:
+                for text_hash in text_hashes:
+                    for offset in self.offsets(text_hash):
+                        pipe.setbit(self.key, offset, 1)
+                await pipe.execute()
+        except redis.RedisError as e:
+            # the text is looked up in the DB until the next rebuild
+            logger.error('Existence filter update failed: %s', e)
+
+    def rebuild(self, text_hashes: Iterable[str], batch_size: int = 10_000) -> int:
+        # filled under a temporary key and swapped in, so submit never sees
+        # a partial filter
+        client = redis_client()
+        staging_key = f'{self.key}:rebuild'
+        total = 0
+        try:
+            client.delete(staging_key)
+            for batch in batched(text_hashes, batch_size):
+                with client.pipeline(transaction=False) as pipe:
+                    for text_hash in batch:
+                        for offset in self.offsets(text_hash):
+                            pipe.setbit(staging_key, offset, 1)
+                    pipe.execute()
+                total += len(batch)
+            if total:
+                client.rename(staging_key, self.key)
+            else:
+                client.delete(self.key)
+        finally:
+            client.connection_pool.disconnect()
+        return total
+
+
+result_cache = ResultCache()
+censor_chunk_cache = CensorChunkCache()
+censor_engines = CensorEngineCache(settings.CENSOR_ENGINE_CACHE_SIZE)
+# current WordlistVersion of every profile submitted with, see api.current_wordlist
+wordlist_profiles = LocalLRUCache(1024 * 1024, settings.WORDLIST_PROFILE_TTL)
+existence_filter = ExistenceFilter(
+    settings.EXISTENCE_FILTER_BITS, settings.EXISTENCE_FILTER_HASHES
+)
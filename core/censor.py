@@ -0,0 +1,383 @@
+import re
+import struct
+from bisect import bisect_left
+from collections.abc import Iterable, Sequence
+from functools import partial
+from hashlib import sha256
+from operator import itemgetter
+
+import billiard
+from better_profanity.constants import ALLOWED_CHARACTERS
+from better_profanity.utils import get_complete_path_of_file, read_wordlist
+
+# Same leetspeak substitutions better_profanity expands every wordlist entry with
+CHARS_MAPPING = {
+    'a': ('a', '@', '*', '4'),
+    'i': ('i', '*', 'l', '1'),
+    'o': ('o', '*', '0', '@'),
+    'u': ('u', '*', 'v'),
+    'v': ('v', '*', 'u'),
+    'l': ('l', '1'),
+    'e': ('e', '*', '3'),
+    's': ('s', '$', '5'),
+    't': ('t', '7'),
+}
+
+DEFAULT_WORDLIST = get_complete_path_of_file('profanity_wordlist.txt')
+
+_TERMINAL = ''  # never a real character, so it is safe to use as a trie key
+
+# leetspeak, separators and glued words, every branch of the scan
+WARM_UP_TEXT = 'Warming up, sh1t. F.u.c.k that blow job! B1tch, done.'
+
+
+def _build_reverse_mapping() -> dict[str, tuple[str, ...]]:
+    # text character -> wordlist characters it may stand for
+    reverse: dict[str, set[str]] = {}
+    for char, substitutes in CHARS_MAPPING.items():
+        for substitute in substitutes:
+            reverse.setdefault(substitute, {substitute}).add(char)
+    return {char: tuple(chars) for char, chars in reverse.items()}
+
+
+_REVERSE_MAPPING = _build_reverse_mapping()
+
+Span = tuple[int, int]
+
+
+def mask(text: str, spans: Iterable[Span], censor_char: str = '*') -> str:
+    # better_profanity replaces a censored word with 4 censor chars whatever its length
+    replacement = str(censor_char) * 4
+    parts = []
+    position = 0
+    for start, end in spans:
+        parts.append(text[position:start])
+        parts.append(replacement)
+        position = end
+    parts.append(text[position:])
+    return ''.join(parts)
+
+
+def pack_spans(spans: Sequence[Span]) -> bytes:
+    # little-endian uint32 (start, end) pairs, 8 bytes per censored word
+    return struct.pack(
+        f'<{2 * len(spans)}I', *(offset for span in spans for offset in span)
+    )
+
+
+def unpack_spans(data: bytes | memoryview) -> list[Span]:
+    offsets = struct.unpack(f'<{len(data) // 4}I', data)
+    return list(zip(offsets[::2], offsets[1::2]))
+
+
+class CensorEngine:
+    """
+    Drop-in replacement for ``better_profanity.profanity.censor``.
+
+    Instead of comparing every token against every expanded wordlist entry,
+    the wordlist is compiled once into a trie walked with the reverse
+    leetspeak mapping, and the text is scanned in a single pass.
+    """
+
+    def __init__(
+        self,
+        words: Iterable[str] | None = None,
+        whitelist: Iterable[str] = (),
+    ):
+        if words is None:
+            words = read_wordlist(DEFAULT_WORDLIST)
+
+        whitelist = {word.lower() for word in whitelist}
+
+        self.trie: dict = {}
+        # how many following words may be glued to the current one,
+        # better_profanity derives it from the separators inside wordlist entries
+        self.max_next_words = 1
+
+        compiled = set()
+        for word in set(words):
+            word = word.lower()
+            if word in whitelist:
+                continue
+            compiled.add(word)
+
+            separators = sum(char not in ALLOWED_CHARACTERS for char in word)
+            self.max_next_words = max(self.max_next_words, separators)
+
+            node = self.trie
+            for char in word:
+                node = node.setdefault(char, {})
+            node[_TERMINAL] = True
+
+        # identifies the compiled wordlist, e.g. in cache keys
+        self.fingerprint = sha256('\n'.join(sorted(compiled)).encode()).hexdigest()
+
+        allowed = ''.join(re.escape(char) for char in sorted(ALLOWED_CHARACTERS))
+        self._word_re = re.compile('[%s]+' % allowed)
+        self._separator_re = re.compile('[^%s]' % allowed)
+        self._sentence_end_re = re.compile(r'[.!?\n]')
+
+    def warm_up(self):
+        # scans once when a process starts, so the first text it gets does
+        # not pay for the interpreter specializing the scan
+        self.spans(WARM_UP_TEXT)
+        self.spans_chunked(
+            WARM_UP_TEXT,
+            self.sentence_cuts(WARM_UP_TEXT),
+            lambda jobs: [scan_chunk(job) for job in jobs],
+        )
+
+    def censor(self, text: str, censor_char: str = '*') -> str:
+        if not isinstance(text, str):
+            text = str(text)
+        return mask(text, self.spans(text), censor_char)
+
+    def spans(self, text: str) -> list[Span]:
+        words, lookahead = self._words(text)
+        return self._scan(text, words, lookahead, 0, len(words))[0]
+
+    def spans_parallel(self, text: str, chunk_size: int, processes: int) -> list[Span]:
+        # same result as spans, for very large texts: chunks of about
+        # chunk_size characters are scanned in parallel child processes
+        return self.spans_chunked(
+            text,
+            self.size_cuts(text, chunk_size),
+            partial(fork_map, scan_chunk, processes=processes),
+        )
+
+    def spans_chunked(self, text: str, cuts: list[int], scan) -> list[Span]:
+        """
+        Same result as ``spans``, with the text cut at the word starts in
+        ``cuts`` and every chunk scanned on its own: ``scan`` gets the list of
+        chunk jobs and returns what ``scan_chunk`` returns for each of them.
+
+        Every chunk also gets the words a match may glue to past its end, so
+        its scan only depends on the job. A match can still straddle two
+        chunks and move the position the next chunk should start scanning
+        from. The chunk's own scan is only kept from the point where it
+        reaches that position, otherwise the chunk is rescanned from there.
+        """
+        if len(cuts) < 2:
+            return self.spans(text)
+
+        size = len(text)
+        jobs = []
+        for start, stop in zip(cuts, cuts[1:] + [size]):
+            # the words a match starting in the chunk may glue to
+            end = size
+            for index, word in enumerate(self._word_re.finditer(text, stop)):
+                if index == self.max_next_words:
+                    end = word.start()
+                    break
+            jobs.append((self, text[start:end], stop - start, end == size))
+
+        spans = []
+        position = cuts[0]
+        results = scan(jobs)
+        for start, job, (chunk_spans, landed, visited) in zip(cuts, jobs, results):
+            _, chunk, stop, at_end = job
+            if position - start in visited:
+                spans.extend(
+                    (span_start + start, span_end + start)
+                    for span_start, span_end in chunk_spans
+                    if span_start + start >= position
+                )
+                position = landed + start
+            elif position < start + stop:
+                offset = position - start
+                chunk_spans, landed, _ = scan_chunk(
+                    (self, chunk[offset:], stop - offset, at_end)
+                )
+                spans.extend(
+                    (span_start + position, span_end + position)
+                    for span_start, span_end in chunk_spans
+                )
+                position += landed
+            # otherwise a match glued the whole chunk to the previous one
+
+        return spans
+
+    def size_cuts(self, text: str, chunk_size: int) -> list[int]:
+        # word starts about chunk_size characters apart
+        cuts = self._first_cut(text)
+        while cuts and cuts[-1] + chunk_size < len(text):
+            separator = self._separator_re.search(text, cuts[-1] + chunk_size)
+            word = separator and self._word_re.search(text, separator.end())
+            if not word:
+                break
+            cuts.append(word.start())
+        return cuts
+
+    def sentence_cuts(self, text: str) -> list[int]:
+        # the first word of every sentence, cut on content rather than
+        # position so an edit only moves the cuts around it
+        cuts = self._first_cut(text)
+        if not cuts:
+            return cuts
+        for sentence_end in self._sentence_end_re.finditer(text, cuts[0]):
+            if sentence_end.start() < cuts[-1]:
+                # more punctuation before the sentence already found
+                continue
+            word = self._word_re.search(text, sentence_end.end())
+            if not word:
+                break
+            cuts.append(word.start())
+        return cuts
+
+    def _first_cut(self, text: str) -> list[int]:
+        # same early exit as _words, without tokenizing the whole text
+        first = self._word_re.search(text)
+        if first is None or first.start() >= len(text) - 1:
+            return []
+        return [first.start()]
+
+    def _words(self, text: str) -> tuple[list[Span], int]:
+        # (start, end) of every word, and how many of them may be glued to a
+        # previous one
+        size = len(text)
+        words = [match.span() for match in self._word_re.finditer(text)]
+
+        # better_profanity leaves texts without at least two characters
+        # after the leading separators untouched
+        if not words or words[0][0] >= size - 1:
+            return [], 0
+
+        # a single trailing character is not considered a "next word"
+        lookahead = len(words)
+        if words[-1][0] >= size - 1:
+            lookahead -= 1
+        return words, lookahead
+
+    def _scan(
+        self,
+        text: str,
+        words: list[Span],
+        lookahead: int,
+        index: int,
+        stop: int,
+        track: int = 0,
+    ) -> tuple[list[Span], int, list[int]]:
+        # Scans the words from index until it gets to stop or past it. Returns
+        # the spans, the index it stopped at, and the indexes below track a
+        # scan step started from.
+        size = len(text)
+        spans = []
+        visited = []
+        while index < stop:
+            if index < track:
+                visited.append(index)
+            start, end = words[index]
+            nodes = self._walk([self.trie], text[start:end].lower())
+
+            # words followed by a separator may be glued with the next ones,
+            # either as is ("blowjob") or with the separators ("blow job")
+            matched_until = None
+            if end < size:
+                joined, separated = nodes, nodes
+                last = min(index + self.max_next_words, lookahead - 1)
+                for next_index in range(index + 1, last + 1):
+                    previous_end = words[next_index - 1][1]
+                    next_start, next_end = words[next_index]
+                    joined = self._walk(joined, text[next_start:next_end].lower())
+                    separated = self._walk(
+                        separated, text[previous_end:next_end].lower()
+                    )
+                    if self._is_match(joined) or self._is_match(separated):
+                        matched_until = next_index
+                        break
+                    if not joined and not separated:
+                        break
+
+            if matched_until is not None:
+                spans.append((start, words[matched_until][1]))
+                index = matched_until + 1
+                continue
+
+            if self._is_match(nodes):
+                spans.append((start, end))
+            index += 1
+
+        return spans, index, visited
+
+    def _walk(self, nodes: list[dict], chars: str) -> list[dict]:
+        for char in chars:
+            if not nodes:
+                break
+            nodes = [
+                child
+                for node in nodes
+                for key in _REVERSE_MAPPING.get(char, char)
+                if (child := node.get(key)) is not None
+            ]
+        return nodes
+
+    @staticmethod
+    def _is_match(nodes: list[dict]) -> bool:
+        return any(_TERMINAL in node for node in nodes)
+
+
+def fork_map(func, items: list, processes: int) -> list:
+    """
+    ``[func(item) for item in items]`` split across up to ``processes``
+    forked children, which inherit ``func`` and ``items`` and only send the
+    results back. Children are started per call and exit on their own, there
+    is no pool to keep alive or shut down. billiard, unlike multiprocessing,
+    can fork from daemonic Celery pool workers.
+    """
+    size = -(-len(items) // max(processes, 1))
+    children = []
+    for start in range(0, len(items), size):
+        reader, writer = billiard.Pipe(duplex=False)
+        child = billiard.Process(
+            target=_map_slice, args=(func, items[start : start + size], writer)
+        )
+        child.start()
+        writer.close()
+        children.append((child, reader))
+
+    results = []
+    try:
+        for child, reader in children:
+            try:
+                result = reader.recv()
+            except EOFError:
+                raise RuntimeError(f'Child process {child.pid} died') from None
+            if isinstance(result, BaseException):
+                raise result
+            results.extend(result)
+    finally:
+        for child, reader in children:
+            reader.close()
+            child.join()
+    return results
+
+
+def _map_slice(func, items: list, writer):
+    try:
+        writer.send([func(item) for item in items])
+    except Exception as e:
+        writer.send(e)
+    finally:
+        writer.close()
+
+
+def scan_chunk(job) -> tuple[list[Span], int, list[int]]:
+    # The chunk starts at a word and is scanned up to the word at offset stop. Offsets are returned instead
+    # of word indexes: the end of the scan and the starts of the first words
+    # it went through, which spans_parallel stitches the chunks with.
+    engine, text, stop, at_end = job
+    words = [match.span() for match in engine._word_re.finditer(text)]
+    lookahead = len(words)
+    # a single trailing character is not considered a "next word"
+    if at_end and words and words[-1][0] >= len(text) - 1:
+        lookahead -= 1
+    stop_index = bisect_left(words, stop, key=itemgetter(0))
+
+    spans, landed, visited = engine._scan(
+        text, words, lookahead, 0, stop_index, engine.max_next_words + 1
+    )
+    landed_offset = words[landed][0] if landed < len(words) else len(text)
+    return spans, landed_offset, [words[index][0] for index in visited]
+
+
+censor_engine = CensorEngine()
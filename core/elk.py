@@ -1,91 +1,365 @@
+import asyncio
+import json
 import logging
+import os
+import weakref
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections.abc import Iterable, Iterator
+from contextlib import contextmanager
+from itertools import chain
+from time import perf_counter
+from typing import NamedTuple
 
 from django.conf import settings
-from elasticsearch import AsyncElasticsearch
+from elasticsearch import (
+    ApiError,
+    AsyncElasticsearch,
+    BadRequestError,
+    Elasticsearch,
+    NotFoundError,
+    TransportError,
+)
+from elasticsearch.helpers import scan, streaming_bulk
 
-from core.schemas import SearchResponseSchema
+from core.censor import Span, mask
+from core.metrics import (
+    ES_BULK_DOCUMENTS,
+    ES_OPEN_CLIENTS,
+    ES_REQUEST_SECONDS,
+    ES_REQUESTS_IN_FLIGHT,
+)
+from core.schemas import SearchPageSchema, SearchResponseSchema
 
 logger = logging.getLogger(__name__)
 
+INDEX_MAPPING = {
+    'mappings': {
+        'properties': {
+            'text_hash': {'type': 'keyword'},
+            'original_text': {'type': 'text'},
+            # only stored to rebuild the processed text, never searched
+            'censor_spans': {'type': 'integer', 'index': False},
+        }
+    }
+}
+
+# from + size cannot go past index.max_result_window, deeper pages need a cursor
+MAX_RESULT_WINDOW = 10_000
+PIT_KEEP_ALIVE = '1m'
+# text_hash breaks ties between equal scores so search_after never skips a hit
+SEARCH_SORT = [{'_score': 'desc'}, {'text_hash': 'asc'}]
+# ES adds _shard_doc to every search in a point in time, it is spelled out so
+# the sort values a cursor page returns always match the sort of the next one
+CURSOR_SORT = [*SEARCH_SORT, {'_shard_doc': 'asc'}]
+SEARCH_SOURCE = ['text_hash', 'original_text', 'censor_spans', 'processed_text']
+
+
+class InvalidCursor(ValueError):
+    """Answered with 400, the cursor is malformed or its point in time expired."""
+
+
+class SearchUnavailable(Exception):
+    """Answered with 503, Elasticsearch failed to answer the search."""
+
+
+class SearchCursor(NamedTuple):
+    pit_id: str
+    search_after: list
+
+    def encode(self) -> str:
+        return urlsafe_b64encode(json.dumps(self._asdict()).encode()).decode()
+
+    @classmethod
+    def decode(cls, cursor: str) -> 'SearchCursor':
+        try:
+            data = json.loads(urlsafe_b64decode(cursor.encode()))
+            pit_id, search_after = data['pit_id'], list(data['search_after'])
+        except (ValueError, KeyError, TypeError):
+            raise InvalidCursor('Invalid cursor')
+        # cursors are only handed out with the sort values of a point in time
+        if not isinstance(pit_id, str) or len(search_after) != len(CURSOR_SORT):
+            raise InvalidCursor('Invalid cursor')
+        return cls(pit_id, search_after)
+
+
+@contextmanager
+def observe(operation: str):
+    ES_REQUESTS_IN_FLIGHT.inc()
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        ES_REQUESTS_IN_FLIGHT.dec()
+        ES_REQUEST_SECONDS.labels(operation).observe(perf_counter() - start)
+
 
 class ElasticsearchService:
     def __init__(self):
         self.index_name = settings.ELASTICSEARCH_INDEX_NAME
+        # Clients are long-lived and keep their connection pool alive between
+        # requests. An AsyncElasticsearch is bound to the event loop it runs in,
+        # so there is one per loop, the sync client is recreated after a fork.
+        self._async_clients: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+        # take the async clients out of ES_OPEN_CLIENTS, on aclose() or when
+        # their loop is garbage collected without it
+        self._async_finalizers: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+        self._sync_client: Elasticsearch | None = None
+        self._sync_client_pid: int | None = None
+        # set once the index is known to exist, reset when ES reports it missing
+        self.index_ready = False
 
-    async def create_index(self) -> bool:
-        client = AsyncElasticsearch([settings.ELASTICSEARCH['default']['hosts']])
-        try:
-            exists = await client.indices.exists(index=self.index_name)
-            if exists:
-                return True
-
-            mapping = {
-                'mappings': {
-                    'properties': {
-                        'text_hash': {'type': 'keyword'},
-                        'original_text': {'type': 'text'},
-                        'processed_text': {'type': 'text'},
-                    }
-                }
-            }
+    @staticmethod
+    def _client_options() -> dict:
+        return {
+            'hosts': [settings.ELASTICSEARCH['default']['hosts']],
+            'connections_per_node': settings.ES_CONNECTIONS_PER_NODE,
+            'request_timeout': settings.ES_REQUEST_TIMEOUT,
+            'max_retries': settings.ES_MAX_RETRIES,
+            'retry_on_timeout': True,
+        }
 
-            await client.indices.create(index=self.index_name, body=mapping)
-            return True
-        except Exception as e:
-            logger.error(f'Failed to create index: {e}')
-            return False
-        finally:
+    @property
+    def async_client(self) -> AsyncElasticsearch:
+        loop = asyncio.get_running_loop()
+        client = self._async_clients.get(loop)
+        if client is None:
+            client = AsyncElasticsearch(**self._client_options())
+            self._async_clients[loop] = client
+            self._async_finalizers[loop] = weakref.finalize(loop, ES_OPEN_CLIENTS.dec)
+            ES_OPEN_CLIENTS.inc()
+        return client
+
+    @property
+    def sync_client(self) -> Elasticsearch:
+        if self._sync_client is None or self._sync_client_pid != os.getpid():
+            # a client inherited from the parent was counted by the parent,
+            # multiprocess metrics start from zero in a forked child
+            self._sync_client = Elasticsearch(**self._client_options())
+            self._sync_client_pid = os.getpid()
+            ES_OPEN_CLIENTS.inc()
+        return self._sync_client
+
+    async def aclose(self):
+        # called on ASGI lifespan shutdown
+        loop = asyncio.get_running_loop()
+        client = self._async_clients.pop(loop, None)
+        if client is not None:
+            self._async_finalizers.pop(loop)()
             await client.close()
 
-    async def index_document(
-        self, text_hash: str, original_text: str, processed_text: str | None = None
-    ) -> bool:
-        client = AsyncElasticsearch([settings.ELASTICSEARCH['default']['hosts']])
+    def close(self):
+        # called on Celery worker process shutdown
+        if self._sync_client is not None and self._sync_client_pid == os.getpid():
+            self._sync_client.close()
+            ES_OPEN_CLIENTS.dec()
+        self._sync_client = None
+        self._sync_client_pid = None
+
+    async def create_index(self) -> bool:
+        client = self.async_client
         try:
-            document = {
-                'text_hash': text_hash,
-                'original_text': original_text,
-                'processed_text': processed_text,
-            }
-            await client.index(index=self.index_name, id=text_hash, body=document)
+            with observe('create_index'):
+                exists = await client.indices.exists(index=self.index_name)
+            if not exists:
+                with observe('create_index'):
+                    await client.indices.create(
+                        index=self.index_name, body=INDEX_MAPPING
+                    )
+            self.index_ready = True
             return True
         except Exception as e:
-            logger.error(f'Failed to index document: {e}')
+            logger.error('Failed to create index: %s', e)
             return False
-        finally:
-            await client.close()
 
-    async def search_text(self, query: str) -> list[SearchResponseSchema]:
-        client = AsyncElasticsearch([settings.ELASTICSEARCH['default']['hosts']])
+    async def ensure_index(self) -> bool:
+        # no round trip once the index is known to exist
+        return self.index_ready or await self.create_index()
+
+    @staticmethod
+    def build_document(
+        text_hash: str, original_text: str, spans: list[Span] | None = None
+    ) -> dict:
+        return {
+            'text_hash': text_hash,
+            'original_text': original_text,
+            # flattened [start, end, start, end, ...] offsets
+            'censor_spans': None if spans is None else list(chain(*spans)),
+        }
+
+    def bulk_index(self, documents: Iterable[dict]) -> set[str]:
+        # Synchronous on purpose: called from Celery workers, where spinning up
+        # an event loop per call costs more than the request itself.
+        # Documents are streamed in requests of at most ES_BULK_CHUNK_SIZE
+        # documents / ES_BULK_MAX_BYTES bytes, returns the hashes that were indexed.
+        actions = (
+            {'_index': self.index_name, '_id': doc['text_hash'], '_source': doc}
+            for doc in documents
+        )
+        indexed = set()
+        failed = 0
+        first_error = None
         try:
-            search_body = {
-                'query': {
-                    'match': {
-                        'original_text': {
-                            'query': query,
-                            'fuzziness': 'AUTO',
-                            'operator': 'or',
-                        }
+            with observe('bulk'):
+                for ok, item in streaming_bulk(
+                    self.sync_client,
+                    actions,
+                    chunk_size=settings.ES_BULK_CHUNK_SIZE,
+                    max_chunk_bytes=settings.ES_BULK_MAX_BYTES,
+                    raise_on_error=False,
+                    raise_on_exception=False,
+                ):
+                    if ok:
+                        indexed.add(item['index']['_id'])
+                    else:
+                        failed += 1
+                        first_error = first_error or item['index'].get('error')
+        except Exception as e:
+            logger.error('Bulk indexing failed: %s', e)
+
+        ES_BULK_DOCUMENTS.labels('indexed').inc(len(indexed))
+        if failed:
+            ES_BULK_DOCUMENTS.labels('failed').inc(failed)
+            logger.error(
+                'Failed to index %s documents, first error: %s', failed, first_error
+            )
+        return indexed
+
+    def document_ids(self) -> Iterator[str]:
+        # every document id in the index, read with a scroll
+        for hit in scan(
+            self.sync_client, index=self.index_name, query={'_source': False}
+        ):
+            yield hit['_id']
+
+    def bulk_delete(self, doc_ids: Iterable[str]) -> int:
+        # returns how many documents are gone, including ones already missing
+        actions = (
+            {'_op_type': 'delete', '_index': self.index_name, '_id': doc_id}
+            for doc_id in doc_ids
+        )
+        deleted = 0
+        with observe('bulk'):
+            for ok, item in streaming_bulk(
+                self.sync_client,
+                actions,
+                chunk_size=settings.ES_BULK_CHUNK_SIZE,
+                raise_on_error=False,
+            ):
+                if ok or item['delete'].get('status') == 404:
+                    deleted += 1
+        return deleted
+
+    async def search_text(
+        self,
+        query: str,
+        limit: int,
+        offset: int = 0,
+        cursor: SearchCursor | None = None,
+        start_cursor: bool = False,
+        include_original: bool = True,
+    ) -> SearchPageSchema:
+        # Offset pages use from/size, in one request. Cursor pages use
+        # search_after in a point in time, opened by the offset page asked
+        # for with start_cursor and closed by the last page. Raises
+        # InvalidCursor when ES rejects the cursor and SearchUnavailable when
+        # it fails, an empty page always means there are no more results.
+        client = self.async_client
+        search_body = {
+            'query': {
+                'match': {
+                    'original_text': {
+                        'query': query,
+                        'fuzziness': 'AUTO',
+                        'operator': 'or',
                     }
-                },
-            }
-            response = await client.search(index=self.index_name, body=search_body)
-            results = []
-            for hit in response['hits']['hits']:
-                src = hit['_source']
-                results.append(
-                    SearchResponseSchema(
-                        text_hash=src.get('text_hash', ''),
-                        original_text=src.get('original_text', ''),
-                        processed_text=src.get('processed_text'),
+                }
+            },
+            'size': limit,
+            'sort': SEARCH_SORT,
+            '_source': SEARCH_SOURCE,
+            'track_total_hits': True,
+        }
+        pit_id = None
+        try:
+            if cursor is None:
+                search_body['from'] = offset
+                if start_cursor:
+                    with observe('open_point_in_time'):
+                        pit = await client.open_point_in_time(
+                            index=self.index_name, keep_alive=PIT_KEEP_ALIVE
+                        )
+                    pit_id = pit['id']
+            else:
+                pit_id = cursor.pit_id
+                search_body['search_after'] = cursor.search_after
+
+            if pit_id is None:
+                with observe('search'):
+                    response = await client.search(
+                        index=self.index_name, body=search_body
                     )
+            else:
+                search_body['sort'] = CURSOR_SORT
+                search_body['pit'] = {'id': pit_id, 'keep_alive': PIT_KEEP_ALIVE}
+                with observe('search'):
+                    response = await client.search(body=search_body)
+                pit_id = response.get('pit_id', pit_id)
+        except NotFoundError as e:
+            if e.error == 'index_not_found_exception':
+                self.index_ready = False
+            elif cursor is not None:
+                # search_context_missing_exception, the point in time expired
+                raise InvalidCursor('Cursor expired, start the search again')
+            logger.error('Search failed: %s', e)
+            raise SearchUnavailable('Search failed') from e
+        except BadRequestError as e:
+            if cursor is not None:
+                # a point in time id or search_after values ES cannot parse
+                raise InvalidCursor('Invalid cursor')
+            logger.error('Search failed: %s', e)
+            raise SearchUnavailable('Search failed') from e
+        except (ApiError, TransportError) as e:
+            logger.error('Search failed: %s', e)
+            raise SearchUnavailable('Search failed') from e
+
+        hits = response['hits']['hits']
+        results = []
+        for hit in hits:
+            src = hit['_source']
+            original_text = src.get('original_text', '')
+            # documents indexed before spans were introduced keep processed_text
+            processed_text = src.get('processed_text')
+            if (offsets := src.get('censor_spans')) is not None:
+                spans = zip(offsets[::2], offsets[1::2])
+                processed_text = mask(original_text, spans)
+            results.append(
+                SearchResponseSchema(
+                    text_hash=src.get('text_hash', ''),
+                    original_text=original_text if include_original else None,
+                    processed_text=processed_text,
                 )
-            return results
-        except Exception as e:
-            logger.error(f'Search failed: {e}')
-            return []
-        finally:
-            await client.close()
+            )
+
+        next_cursor = None
+        if pit_id is not None:
+            if len(hits) == limit:
+                next_cursor = SearchCursor(pit_id, hits[-1]['sort']).encode()
+            else:
+                await self._close_point_in_time(pit_id)
+
+        return SearchPageSchema(
+            items=results,
+            count=response['hits']['total']['value'],
+            next_cursor=next_cursor,
+        )
+
+    async def _close_point_in_time(self, pit_id: str):
+        # the last page of a walk, expires after PIT_KEEP_ALIVE anyway
+        try:
+            with observe('close_point_in_time'):
+                await self.async_client.close_point_in_time(id=pit_id)
+        except (ApiError, TransportError) as e:
+            logger.error('Failed to close point in time: %s', e)
 
 
 es_service = ElasticsearchService()
@@ -0,0 +1,29 @@
+import asyncio
+import contextlib
+from time import perf_counter
+
+from core.cache import close_loop_redis_client, result_cache
+from core.censor import censor_engine
+from core.elk import es_service
+from core.metrics import STARTUP_SECONDS
+
+_background_tasks: set[asyncio.Task] = set()
+
+
+async def startup(started_at: float | None = None):
+    # keeps index creation out of the request path, search retries if ES is down
+    await es_service.ensure_index()
+    censor_engine.warm_up()
+    _background_tasks.add(asyncio.create_task(result_cache.listen_for_invalidations()))
+    if started_at is not None:
+        STARTUP_SECONDS.labels('web').observe(perf_counter() - started_at)
+
+
+async def shutdown():
+    for task in _background_tasks:
+        task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await task
+    _background_tasks.clear()
+    await es_service.aclose()
+    await close_loop_redis_client()
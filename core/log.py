@@ -0,0 +1,156 @@
+import copy
+import json
+import logging
+import os
+import queue
+import threading
+from datetime import datetime, UTC
+from logging.handlers import QueueHandler, QueueListener
+from time import monotonic
+
+from core.metrics import LOG_RECORDS_DROPPED
+
+# attributes every LogRecord has, anything else was passed in extra=
+RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {
+    'message',
+    'asctime',
+    'trace_id',
+}
+
+
+_formatter = logging.Formatter()
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, read by logstash with the json codec."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            '@timestamp': datetime.fromtimestamp(record.created, UTC).isoformat(
+                timespec='milliseconds'
+            ),
+            'level': record.levelname,
+            'logger': record.name,
+            'process': record.process,
+            'trace_id': getattr(record, 'trace_id', None),
+            'message': record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES:
+                entry[key] = value
+        return json.dumps(entry, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets through at most ``rate`` records per second of every message
+    template, in bursts of up to ``burst``. The next record let through
+    carries the number of records dropped since in ``suppressed``.
+    """
+
+    max_templates = 10_000
+
+    def __init__(self, rate: float, burst: int):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        # (logger, template) -> [tokens, updated_at, suppressed]
+        self._buckets: dict[tuple[str, str], list] = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not self.rate:
+            return True
+
+        key = (record.name, str(record.msg))
+        now = monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if len(self._buckets) >= self.max_templates:
+                    self._buckets.clear()
+                bucket = self._buckets[key] = [self.burst, now, 0]
+
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if tokens < 1:
+                bucket[0] = tokens
+                bucket[2] += 1
+                return False
+
+            bucket[0] = tokens - 1
+            if bucket[2]:
+                record.suppressed = bucket[2]
+                bucket[2] = 0
+        return True
+
+
+class BackgroundListener(QueueListener):
+    # writes the queued records from a thread started with the listener
+    def __init__(self, queue, *handlers, respect_handler_level=False):
+        super().__init__(queue, *handlers, respect_handler_level=respect_handler_level)
+        self.start()
+
+    def start(self):
+        if self._thread is None:
+            super().start()
+
+    def stop(self):
+        if self._thread is not None:
+            super().stop()
+
+    def restart(self, queue):
+        # the thread of the parent does not exist in a forked child
+        self.queue = queue
+        self._thread = None
+        self.start()
+
+
+class BackgroundHandler(QueueHandler):
+    """
+    Puts records in a bounded queue written by a BackgroundListener, so
+    logging never waits for a disk or a terminal. Records arriving while
+    the queue is full are dropped and counted. Configured through
+    LOGGING, which creates the listener from ``handlers``.
+    """
+
+    def __init__(self, queue):
+        super().__init__(queue)
+        # Celery forks its pool after configuring logging
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # like QueueHandler.prepare, but the traceback is kept apart from the
+        # message, the JSON formatter writes it to its own field
+        record = copy.copy(record)
+        record.message = record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = record.exc_text or _formatter.formatException(
+                record.exc_info
+            )
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc()
+
+    def close(self):
+        # writes out what is still queued, logging.shutdown closes this handler
+        # before the ones of the listener
+        if self.listener is not None:
+            self.listener.stop()
+        super().close()
+
+    def _after_fork(self):
+        # the queue lock may have been held by a thread that is gone
+        self.queue = queue.Queue(self.queue.maxsize)
+        if self.listener is not None:
+            self.listener.restart(self.queue)
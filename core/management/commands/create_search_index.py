@@ -0,0 +1,36 @@
+import asyncio
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.elk import es_service
+
+RETRY_DELAY = 2  # seconds
+
+
+class Command(BaseCommand):
+    help = 'Create the Elasticsearch index and its mapping if they do not exist'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--wait',
+            type=int,
+            default=0,
+            help='Seconds to keep retrying while Elasticsearch is starting up',
+        )
+
+    def handle(self, *args, **options):
+        if not asyncio.run(self._create_index(options['wait'])):
+            raise CommandError(f'Failed to create index {es_service.index_name}')
+        self.stdout.write(self.style.SUCCESS(f'Index {es_service.index_name} is ready'))
+
+    async def _create_index(self, wait: int) -> bool:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + wait
+        try:
+            while not await es_service.create_index():
+                if loop.time() >= deadline:
+                    return False
+                await asyncio.sleep(RETRY_DELAY)
+            return True
+        finally:
+            await es_service.aclose()
@@ -0,0 +1,32 @@
+from itertools import batched
+
+from django.core.management.base import BaseCommand
+
+from core.elk import es_service
+from core.models import TextSubmission
+
+BATCH_SIZE = 10_000
+
+
+class Command(BaseCommand):
+    help = (
+        'Delete the search documents of texts no longer stored under their id, '
+        'e.g. the raw hashes left behind by migration 0009'
+    )
+
+    def handle(self, *args, **options):
+        stale = []
+        try:
+            for doc_ids in batched(es_service.document_ids(), BATCH_SIZE):
+                stored = set(
+                    TextSubmission.objects.filter(text_hash__in=doc_ids).values_list(
+                        'text_hash', flat=True
+                    )
+                )
+                stale.extend(doc_id for doc_id in doc_ids if doc_id not in stored)
+            deleted = es_service.bulk_delete(stale)
+        finally:
+            es_service.close()
+        self.stdout.write(
+            self.style.SUCCESS(f'Deleted {deleted} of {len(stale)} stale documents')
+        )
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from core.cache import existence_filter
+from core.models import TextSubmission
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the existence filter of submitted texts from the database'
+
+    def handle(self, *args, **options):
+        text_hashes = TextSubmission.objects.values_list(
+            'text_hash', flat=True
+        ).iterator(chunk_size=10_000)
+        total = existence_filter.rebuild(text_hashes)
+        self.stdout.write(
+            self.style.SUCCESS(f'Existence filter rebuilt with {total} texts')
+        )
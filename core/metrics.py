@@ -0,0 +1,110 @@
+from prometheus_client import Counter, Gauge, Histogram
+
+ADMISSION_DECISIONS = Counter(
+    'blurifier_admission_decisions_total',
+    'Submit requests by admission decision',
+    ['decision'],
+)
+PIPELINE_QUEUE_DEPTH = Gauge(
+    'blurifier_pipeline_queue_depth',
+    'Messages waiting in the interactive Celery queue, as last seen by admission',
+)
+PIPELINE_UNPROCESSED_AGE = Gauge(
+    'blurifier_pipeline_unprocessed_age_seconds',
+    'Age of the oldest submission waiting for a worker, as last seen by admission',
+)
+BACKFILL_ROWS = Counter(
+    'blurifier_backfill_rows_total',
+    'Rows handled by the backfill tasks',
+    ['task'],
+)
+BACKFILL_CHUNKS = Counter(
+    'blurifier_backfill_chunks_total',
+    'Chunks committed by the backfill tasks',
+    ['task'],
+)
+PIPELINE_STAGE_SECONDS = Histogram(
+    'blurifier_pipeline_stage_seconds',
+    'Time spent in each stage of processing submissions, by the size bucket of '
+    'the text, or of all texts of the batch for stages handling a batch',
+    ['task', 'stage', 'size'],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+CELERY_QUEUE_WAIT_SECONDS = Histogram(
+    'blurifier_celery_queue_wait_seconds',
+    'Time tasks spent in the broker queue before a worker started them',
+    ['queue'],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600),
+)
+ES_BULK_DOCUMENTS = Counter(
+    'blurifier_es_bulk_documents_total',
+    'Documents sent to Elasticsearch bulk requests',
+    ['status'],
+)
+ES_REQUEST_SECONDS = Histogram(
+    'blurifier_es_request_seconds',
+    'Latency of Elasticsearch requests',
+    ['operation'],
+)
+ES_REQUESTS_IN_FLIGHT = Gauge(
+    'blurifier_es_requests_in_flight',
+    'Elasticsearch requests currently holding a pooled connection',
+)
+ES_OPEN_CLIENTS = Gauge(
+    'blurifier_es_open_clients',
+    'Long-lived Elasticsearch clients (one connection pool each)',
+    # summed over the live processes of a Celery service
+    multiprocess_mode='livesum',
+)
+RESULT_CACHE_LOOKUPS = Counter(
+    'blurifier_result_cache_lookups_total',
+    'Results looked up in the result cache',
+    ['result'],
+)
+CENSOR_ENGINE_LOOKUPS = Counter(
+    'blurifier_censor_engine_lookups_total',
+    'Compiled wordlist profile versions looked up in the engine cache',
+    ['result'],
+)
+
+CENSOR_CACHE_CHUNKS = Counter(
+    'blurifier_censor_cache_chunks_total',
+    'Sentence chunks looked up in the censor cache',
+    ['result'],
+)
+EXISTENCE_FILTER_LOOKUPS = Counter(
+    'blurifier_existence_filter_lookups_total',
+    'Submissions checked against the existence filter, by what the DB said',
+    ['result'],
+)
+SUBMIT_QUERIES_SAVED = Counter(
+    'blurifier_submit_queries_saved_total',
+    'Dedup SELECTs skipped because the existence filter reported a new text',
+)
+STARTUP_SECONDS = Histogram(
+    'blurifier_startup_seconds',
+    'Time a process takes to be ready to serve, from loading the app for web '
+    'processes and from the fork for Celery pool processes',
+    ['process'],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+LOG_RECORDS_DROPPED = Counter(
+    'blurifier_log_records_dropped_total',
+    'Log records dropped because the background writer fell behind',
+)
+
+# upper bounds in characters of the size label
+SIZE_BUCKETS = (
+    (1024, '1KB'),
+    (10 * 1024, '10KB'),
+    (100 * 1024, '100KB'),
+    (1024 * 1024, '1MB'),
+    (10 * 1024 * 1024, '10MB'),
+)
+
+
+def size_bucket(length: int) -> str:
+    for limit, label in SIZE_BUCKETS:
+        if length <= limit:
+            return label
+    return 'larger'
@@ -0,0 +1,193 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:44
+
+import re
+import struct
+
+from better_profanity.constants import ALLOWED_CHARACTERS
+from better_profanity.utils import get_complete_path_of_file, read_wordlist
+from django.db import migrations, models
+
+BATCH_SIZE = 1000
+
+# Frozen copies of core.censor as of this migration, so what it does does not
+# change with the app code. The censor is the default wordlist one.
+CHARS_MAPPING = {
+    'a': ('a', '@', '*', '4'),
+    'i': ('i', '*', 'l', '1'),
+    'o': ('o', '*', '0', '@'),
+    'u': ('u', '*', 'v'),
+    'v': ('v', '*', 'u'),
+    'l': ('l', '1'),
+    'e': ('e', '*', '3'),
+    's': ('s', '$', '5'),
+    't': ('t', '7'),
+}
+
+_TERMINAL = ''
+
+
+def _build_reverse_mapping() -> dict[str, tuple[str, ...]]:
+    reverse: dict[str, set[str]] = {}
+    for char, substitutes in CHARS_MAPPING.items():
+        for substitute in substitutes:
+            reverse.setdefault(substitute, {substitute}).add(char)
+    return {char: tuple(chars) for char, chars in reverse.items()}
+
+
+_REVERSE_MAPPING = _build_reverse_mapping()
+
+
+def mask(text: str, spans) -> str:
+    parts = []
+    position = 0
+    for start, end in spans:
+        parts.append(text[position:start])
+        parts.append('****')
+        position = end
+    parts.append(text[position:])
+    return ''.join(parts)
+
+
+def pack_spans(spans) -> bytes:
+    return struct.pack(
+        f'<{2 * len(spans)}I', *(offset for span in spans for offset in span)
+    )
+
+
+def unpack_spans(data) -> list[tuple[int, int]]:
+    offsets = struct.unpack(f'<{len(data) // 4}I', data)
+    return list(zip(offsets[::2], offsets[1::2]))
+
+
+class CensorEngine:
+    def __init__(self):
+        self.trie: dict = {}
+        self.max_next_words = 1
+        for word in set(
+            read_wordlist(get_complete_path_of_file('profanity_wordlist.txt'))
+        ):
+            word = word.lower()
+            separators = sum(char not in ALLOWED_CHARACTERS for char in word)
+            self.max_next_words = max(self.max_next_words, separators)
+            node = self.trie
+            for char in word:
+                node = node.setdefault(char, {})
+            node[_TERMINAL] = True
+
+        self._word_re = re.compile(
+            '[%s]+' % ''.join(re.escape(char) for char in sorted(ALLOWED_CHARACTERS))
+        )
+
+    def spans(self, text: str) -> list[tuple[int, int]]:
+        size = len(text)
+        words = [match.span() for match in self._word_re.finditer(text)]
+        if not words or words[0][0] >= size - 1:
+            return []
+
+        lookahead = len(words)
+        if words[-1][0] >= size - 1:
+            lookahead -= 1
+
+        spans = []
+        index = 0
+        while index < len(words):
+            start, end = words[index]
+            nodes = self._walk([self.trie], text[start:end].lower())
+
+            matched_until = None
+            if end < size:
+                joined, separated = nodes, nodes
+                last = min(index + self.max_next_words, lookahead - 1)
+                for next_index in range(index + 1, last + 1):
+                    previous_end = words[next_index - 1][1]
+                    next_start, next_end = words[next_index]
+                    joined = self._walk(joined, text[next_start:next_end].lower())
+                    separated = self._walk(
+                        separated, text[previous_end:next_end].lower()
+                    )
+                    if self._is_match(joined) or self._is_match(separated):
+                        matched_until = next_index
+                        break
+                    if not joined and not separated:
+                        break
+
+            if matched_until is not None:
+                spans.append((start, words[matched_until][1]))
+                index = matched_until + 1
+                continue
+
+            if self._is_match(nodes):
+                spans.append((start, end))
+            index += 1
+
+        return spans
+
+    def _walk(self, nodes: list[dict], chars: str) -> list[dict]:
+        for char in chars:
+            if not nodes:
+                break
+            nodes = [
+                child
+                for node in nodes
+                for key in _REVERSE_MAPPING.get(char, char)
+                if (child := node.get(key)) is not None
+            ]
+        return nodes
+
+    @staticmethod
+    def _is_match(nodes: list[dict]) -> bool:
+        return any(_TERMINAL in node for node in nodes)
+
+
+def processed_text_to_spans(apps, schema_editor):
+    TextSubmission = apps.get_model('core', 'TextSubmission')
+    # spans are recomputed from the original text, which gives the same masked
+    # output as the processed text stored by the previous censor
+    censor_engine = CensorEngine()
+    batch = []
+    for obj in (
+        TextSubmission.objects.filter(processed_text__isnull=False)
+        .only('id', 'original_text')
+        .iterator(chunk_size=BATCH_SIZE)
+    ):
+        obj.censor_spans = pack_spans(censor_engine.spans(obj.original_text))
+        batch.append(obj)
+        if len(batch) >= BATCH_SIZE:
+            TextSubmission.objects.bulk_update(batch, ['censor_spans'])
+            batch = []
+    TextSubmission.objects.bulk_update(batch, ['censor_spans'])
+
+
+def spans_to_processed_text(apps, schema_editor):
+    TextSubmission = apps.get_model('core', 'TextSubmission')
+    batch = []
+    for obj in (
+        TextSubmission.objects.filter(censor_spans__isnull=False)
+        .only('id', 'original_text', 'censor_spans')
+        .iterator(chunk_size=BATCH_SIZE)
+    ):
+        obj.processed_text = mask(obj.original_text, unpack_spans(obj.censor_spans))
+        batch.append(obj)
+        if len(batch) >= BATCH_SIZE:
+            TextSubmission.objects.bulk_update(batch, ['processed_text'])
+            batch = []
+    TextSubmission.objects.bulk_update(batch, ['processed_text'])
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('core', '0004_textsubmission_idx_unindexed'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='textsubmission',
+            name='censor_spans',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+        migrations.RunPython(processed_text_to_spans, spans_to_processed_text),
+        migrations.RemoveField(
+            model_name='textsubmission',
+            name='processed_text',
+        ),
+    ]
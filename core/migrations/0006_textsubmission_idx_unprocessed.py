@@ -0,0 +1,20 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('core', '0005_textsubmission_censor_spans'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='textsubmission',
+            index=models.Index(
+                condition=models.Q(('censor_spans__isnull', True)),
+                fields=['id'],
+                name='idx_unprocessed',
+            ),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('core', '0006_textsubmission_idx_unprocessed'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='textsubmission',
+            name='idx_unindexed',
+        ),
+        migrations.AddIndex(
+            model_name='textsubmission',
+            index=models.Index(
+                condition=models.Q(('indexed_at__isnull', True)),
+                fields=['id'],
+                name='idx_unindexed',
+            ),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:15
+
+from django.db import migrations, models
+
+
+def mark_processed_as_success(apps, schema_editor):
+    TextSubmission = apps.get_model('core', 'TextSubmission')
+    TextSubmission.objects.filter(censor_spans__isnull=False).update(status='SUCCESS')
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('core', '0007_alter_idx_unindexed'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='textsubmission',
+            name='status',
+            field=models.CharField(
+                choices=[
+                    ('PENDING', 'Pending'),
+                    ('STARTED', 'Started'),
+                    ('SUCCESS', 'Success'),
+                    ('FAILURE', 'Failure'),
+                ],
+                db_index=True,
+                default='PENDING',
+                max_length=16,
+            ),
+        ),
+        migrations.AddField(
+            model_name='textsubmission',
+            name='status_detail',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.RunPython(mark_processed_as_success, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,122 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:45
+
+import re
+import unicodedata
+from hashlib import sha256
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+BATCH_SIZE = 1000
+
+# Frozen copies of core.models.canonical_text and hash_text as of this
+# migration, so what it does does not change with the app code
+_HORIZONTAL_WHITESPACE = re.compile(r'[^\S\n]+')
+
+
+def canonical_text(text: str) -> str:
+    text = unicodedata.normalize('NFC', text)
+    text = text.replace('\r\n', '\n').replace('\r', '\n')
+    return '\n'.join(
+        _HORIZONTAL_WHITESPACE.sub(' ', line).strip() for line in text.split('\n')
+    ).strip()
+
+
+def hash_text(text: str) -> str:
+    return sha256(text.encode()).hexdigest()
+
+
+def canonicalize(apps, schema_editor):
+    # moves every submission to the hash of its canonical text, the raw
+    # text is kept as a variant. Rows whose canonical text is already
+    # stored are folded into that submission. The search documents stored
+    # under the raw hashes are left behind, prune_search_index deletes them.
+    if not settings.CANONICAL_TEXT_HASH:
+        return
+
+    TextSubmission = apps.get_model('core', 'TextSubmission')
+    TextVariant = apps.get_model('core', 'TextVariant')
+
+    after_id = 0
+    while objs := list(
+        TextSubmission.objects.filter(id__gt=after_id)
+        .order_by('id')
+        .only('id', 'text_hash', 'original_text')[:BATCH_SIZE]
+    ):
+        after_id = objs[-1].id
+        changed = [
+            (obj, text)
+            for obj in objs
+            if (text := canonical_text(obj.original_text)) != obj.original_text
+        ]
+        submission_ids = dict(
+            TextSubmission.objects.filter(
+                text_hash__in=[hash_text(text) for _, text in changed]
+            ).values_list('text_hash', 'id')
+        )
+
+        for obj, text in changed:
+            variant = TextVariant(
+                text_hash=obj.text_hash, original_text=obj.original_text
+            )
+            canonical_hash = hash_text(text)
+            if canonical_hash in submission_ids:
+                variant.submission_id = submission_ids[canonical_hash]
+                obj.delete()
+            else:
+                obj.original_text = text
+                obj.text_hash = canonical_hash
+                # the spans pointed into the raw text, the row is censored
+                # again by process_unprocessed_texts and then indexed under
+                # the canonical hash by index_unindexed_texts
+                obj.censor_spans = None
+                obj.status = 'PENDING'
+                obj.indexed_at = None
+                obj.save(
+                    update_fields=[
+                        'original_text',
+                        'text_hash',
+                        'censor_spans',
+                        'status',
+                        'indexed_at',
+                    ]
+                )
+                submission_ids[canonical_hash] = obj.id
+                variant.submission_id = obj.id
+            variant.save()
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('core', '0008_textsubmission_status'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TextVariant',
+            fields=[
+                (
+                    'id',
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name='ID',
+                    ),
+                ),
+                ('text_hash', models.CharField(max_length=64, unique=True)),
+                ('original_text', models.TextField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                (
+                    'submission',
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name='variants',
+                        to='core.textsubmission',
+                    ),
+                ),
+            ],
+        ),
+        migrations.RunPython(canonicalize, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,95 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:19
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('core', '0009_textvariant'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WordlistProfile',
+            fields=[
+                (
+                    'id',
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name='ID',
+                    ),
+                ),
+                ('name', models.SlugField(unique=True)),
+                (
+                    'words',
+                    models.TextField(
+                        blank=True, default='', help_text='Censored words, one per line'
+                    ),
+                ),
+                (
+                    'allowed',
+                    models.TextField(
+                        blank=True,
+                        default='',
+                        help_text='Words never censored, one per line',
+                    ),
+                ),
+                (
+                    'include_default',
+                    models.BooleanField(
+                        default=True, help_text='Censor the default wordlist as well'
+                    ),
+                ),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='WordlistVersion',
+            fields=[
+                (
+                    'id',
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name='ID',
+                    ),
+                ),
+                ('number', models.PositiveIntegerField()),
+                ('words', models.TextField(blank=True, default='')),
+                ('allowed', models.TextField(blank=True, default='')),
+                ('include_default', models.BooleanField(default=True)),
+                ('fingerprint', models.CharField(max_length=64)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                (
+                    'profile',
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name='versions',
+                        to='core.wordlistprofile',
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddField(
+            model_name='textsubmission',
+            name='wordlist',
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.PROTECT,
+                related_name='submissions',
+                to='core.wordlistversion',
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name='wordlistversion',
+            constraint=models.UniqueConstraint(
+                fields=('profile', 'number'), name='unique_wordlist_version'
+            ),
+        ),
+    ]
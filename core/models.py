@@ -1,28 +1,288 @@
+import re
+import unicodedata
+from collections.abc import Iterable
 from hashlib import sha256
 
-from django.db import models
+from better_profanity.utils import read_wordlist
+from django.conf import settings
+from django.db import models, transaction
 from django.db.models import Q
 
+from core.censor import (
+    DEFAULT_WORDLIST,
+    CensorEngine,
+    Span,
+    mask,
+    pack_spans,
+    unpack_spans,
+)
+
+_HORIZONTAL_WHITESPACE = re.compile(r'[^\S\n]+')
+
+
+def canonical_text(text: str) -> str:
+    # NFC, \n line endings, whitespace runs collapsed to one space and
+    # stripped around every line
+    text = unicodedata.normalize('NFC', text)
+    text = text.replace('\r\n', '\n').replace('\r', '\n')
+    return '\n'.join(
+        _HORIZONTAL_WHITESPACE.sub(' ', line).strip() for line in text.split('\n')
+    ).strip()
+
+
+def _nfc(text: str) -> str:
+    return unicodedata.normalize('NFC', text)
+
+
+def _normalized_runs(text: str) -> list[tuple[int, int]]:
+    # a starter and the combining marks after it, merged with the run before
+    # when NFC composes across them, so every run normalizes on its own
+    runs = []
+    for position, char in enumerate(text):
+        if runs:
+            start = runs[-1][0]
+            previous = text[start:position]
+            composes = _nfc(previous + char) != _nfc(previous) + _nfc(char)
+            if composes or unicodedata.combining(char):
+                runs[-1] = (start, position + 1)
+                continue
+        runs.append((position, position + 1))
+    return runs
+
+
+def variant_spans(text: str, spans: Iterable[Span]) -> list[Span]:
+    """
+    Spans found in canonical_text(text) mapped onto text itself, a span
+    covers the whitespace and the unnormalized characters its words were
+    canonicalized from.
+    """
+    if unicodedata.is_normalized('NFC', text):
+        normalized = text
+        starts, ends = range(len(text)), range(1, len(text) + 1)
+    else:
+        parts, starts, ends = [], [], []
+        for start, end in _normalized_runs(text):
+            run = unicodedata.normalize('NFC', text[start:end])
+            parts.append(run)
+            starts.extend([start] * len(run))
+            ends.extend([end] * len(run))
+        normalized = ''.join(parts)
+        if normalized != _nfc(text):
+            # cannot be split, every character comes from the whole text
+            normalized = _nfc(text)
+            starts, ends = [0] * len(normalized), [len(text)] * len(normalized)
+
+    # canonical_text only drops and collapses whitespace, every other
+    # character is found in order in the normalized text
+    canonical_starts, canonical_ends = [], []
+    position = 0
+    for char in canonical_text(text):
+        if char == '\n':
+            while normalized[position] not in '\r\n':
+                position += 1
+        elif char == ' ':
+            while not normalized[position].isspace() or normalized[position] in '\r\n':
+                position += 1
+        else:
+            while normalized[position] != char:
+                position += 1
+        canonical_starts.append(starts[position])
+        if normalized.startswith('\r\n', position):
+            position += 1
+        canonical_ends.append(ends[position])
+        position += 1
+
+    return [(canonical_starts[start], canonical_ends[end - 1]) for start, end in spans]
+
+
+def submission_text(text: str) -> str:
+    # the form a submitted text is stored, deduplicated and processed in
+    return canonical_text(text) if settings.CANONICAL_TEXT_HASH else text
+
+
+def hash_text(text: str, fingerprint: str | None = None) -> str:
+    # texts censored with a wordlist profile are stored and cached apart from
+    # the same text censored with the default wordlist, or another profile
+    if fingerprint is not None:
+        text = f'{fingerprint}\n{text}'
+    return sha256(text.encode()).hexdigest()
+
+
+def _lines(text: str) -> list[str]:
+    return [line.strip() for line in text.splitlines() if line.strip()]
+
+
+class ProcessingStatus(models.TextChoices):
+    PENDING = 'PENDING'
+    STARTED = 'STARTED'
+    SUCCESS = 'SUCCESS'
+    FAILURE = 'FAILURE'
+
+
+class WordlistProfile(models.Model):
+    """
+    A client's own wordlist, passed as ``profile`` on submit: words censored
+    on top of the default wordlist (or instead of it) and words never
+    censored. Every change is saved as a new WordlistVersion, submissions
+    keep the version they were censored with.
+    """
+
+    name = models.SlugField(unique=True)
+    words = models.TextField(
+        blank=True, default='', help_text='Censored words, one per line'
+    )
+    allowed = models.TextField(
+        blank=True, default='', help_text='Words never censored, one per line'
+    )
+    include_default = models.BooleanField(
+        default=True, help_text='Censor the default wordlist as well'
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.name
+
+    @transaction.atomic
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        latest = self.versions.order_by('-number').first()
+        lists = (self.words, self.allowed, self.include_default)
+        if (
+            latest is None
+            or (latest.words, latest.allowed, latest.include_default) != lists
+        ):
+            version = WordlistVersion(
+                profile=self,
+                number=latest.number + 1 if latest else 1,
+                words=self.words,
+                allowed=self.allowed,
+                include_default=self.include_default,
+            )
+            version.fingerprint = version.engine().fingerprint
+            version.save()
+
+
+class WordlistVersion(models.Model):
+    # what a WordlistProfile censored at some point, never changed once saved
+    profile = models.ForeignKey(
+        WordlistProfile, on_delete=models.CASCADE, related_name='versions'
+    )
+    number = models.PositiveIntegerField()
+    words = models.TextField(blank=True, default='')
+    allowed = models.TextField(blank=True, default='')
+    include_default = models.BooleanField(default=True)
+    # CensorEngine.fingerprint of the compiled wordlist, part of the text
+    # hashes of the submissions censored with it
+    fingerprint = models.CharField(max_length=64)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f'{self.profile_id} v{self.number}'
+
+    def engine(self) -> CensorEngine:
+        words = _lines(self.words)
+        if self.include_default:
+            words.extend(read_wordlist(DEFAULT_WORDLIST))
+        return CensorEngine(words, whitelist=_lines(self.allowed))
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['profile', 'number'], name='unique_wordlist_version'
+            ),
+        ]
+
 
 class TextSubmission(models.Model):
+    # Canonical form of the submitted text with CANONICAL_TEXT_HASH, what
+    # each caller sent is kept in TextVariant when it differs
     original_text = models.TextField()
-    processed_text = models.TextField(blank=True, null=True)
+    # Packed (start, end) offsets of the censored words, NULL until processed.
+    # The processed text is rebuilt from them on read instead of storing it twice.
+    censor_spans = models.BinaryField(blank=True, null=True)
     text_hash = models.CharField(max_length=64, unique=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     indexed_at = models.DateTimeField(null=True, blank=True)
+    # Kept on the row so a status poll is a single query, the Celery result
+    # backend is not used for the processing tasks
+    status = models.CharField(
+        max_length=16,
+        choices=ProcessingStatus.choices,
+        default=ProcessingStatus.PENDING,
+        db_index=True,
+    )
+    status_detail = models.TextField(blank=True, default='')
+    # NULL for the default wordlist
+    wordlist = models.ForeignKey(
+        WordlistVersion,
+        on_delete=models.PROTECT,
+        null=True,
+        blank=True,
+        related_name='submissions',
+    )
+
+    @property
+    def spans(self) -> list[Span] | None:
+        if self.censor_spans is None:
+            return None
+        return unpack_spans(self.censor_spans)
+
+    @spans.setter
+    def spans(self, spans: list[Span] | None):
+        self.censor_spans = None if spans is None else pack_spans(spans)
+
+    @property
+    def processed_text(self) -> str | None:
+        spans = self.spans
+        if spans is None:
+            return None
+        return mask(self.original_text, spans)
 
     def save(self, *args, **kwargs):
+        submitted = None
         if not self.text_hash:
-            self.text_hash = sha256(self.original_text.encode()).hexdigest()
+            fingerprint = self.wordlist.fingerprint if self.wordlist_id else None
+            text = submission_text(self.original_text)
+            if text != self.original_text:
+                submitted, self.original_text = self.original_text, text
+            self.text_hash = hash_text(text, fingerprint)
         super().save(*args, **kwargs)
 
+        if submitted is not None:
+            TextVariant.objects.get_or_create(
+                text_hash=hash_text(submitted, fingerprint),
+                defaults={'submission': self, 'original_text': submitted},
+            )
+
     class Meta:
         indexes = [
-            # Partial Index for quick lookup by indexed_at IS NULL
+            # Partial Index for keyset pagination over indexed_at IS NULL
             models.Index(
-                fields=['indexed_at'],
+                fields=['id'],
                 name='idx_unindexed',
                 condition=Q(indexed_at__isnull=True),
             ),
+            # Partial Index for keyset pagination over censor_spans IS NULL
+            models.Index(
+                fields=['id'],
+                name='idx_unprocessed',
+                condition=Q(censor_spans__isnull=True),
+            ),
         ]
+
+
+class TextVariant(models.Model):
+    """
+    A submitted text that differs from its submission's canonical text only
+    by whitespace, line endings or Unicode normalization. Keeps what the
+    caller sent, under the sha256 of the raw text it got back as text_id.
+    """
+
+    text_hash = models.CharField(max_length=64, unique=True)
+    submission = models.ForeignKey(
+        TextSubmission, on_delete=models.CASCADE, related_name='variants'
+    )
+    original_text = models.TextField()
+    created_at = models.DateTimeField(auto_now_add=True)
@@ -9,21 +9,55 @@ class ErrorResponseSchema(Schema):
 
 class SubmitTextSchema(Schema):
     text: str
+    # name of a wordlist profile to censor with instead of the default wordlist
+    profile: str | None = None
 
 
-class SubmitResponseSchema(Schema):
-    text_id: str
+class SubmitBatchResponseSchema(Schema):
+    text_ids: list[str]
 
 
 class ResultResponseSchema(Schema):
     status: str
     original: str
     processed: str | None = None
+    # (start, end) offsets of the censored words in the original text
+    spans: list[tuple[int, int]] | None = None
     processed_dt: datetime
     detail: str = ''
 
 
+class SubmitResponseSchema(Schema):
+    text_id: str
+    # set when the text was small enough to be censored right away
+    result: ResultResponseSchema | None = None
+
+
+class ResultsRequestSchema(Schema):
+    text_ids: list[str]
+
+
+class ResultItemSchema(Schema):
+    text_id: str
+    # processing status of the text, NOT_FOUND for unknown text_ids
+    status: str
+    result: ResultResponseSchema | None = None
+
+
+class ResultsResponseSchema(Schema):
+    # in the order of the requested text_ids
+    items: list[ResultItemSchema]
+
+
 class SearchResponseSchema(Schema):
     text_hash: str
-    original_text: str
+    original_text: str | None = None
     processed_text: str | None = None
+
+
+class SearchPageSchema(Schema):
+    items: list[SearchResponseSchema]
+    count: int
+    # set when paging with ?cursor=start, pass it back as ?cursor= to get the
+    # next page, works at any depth
+    next_cursor: str | None = None
@@ -1,91 +1,467 @@
+import gc
 import logging
+import os
+from collections import defaultdict
+from contextlib import contextmanager
 from datetime import datetime, UTC
+from time import perf_counter, time
+from uuid import uuid4
 
-from asgiref.sync import async_to_sync
-from better_profanity import profanity
-from celery import shared_task
+from celery import current_task, shared_task
+from celery.exceptions import SoftTimeLimitExceeded
+from celery.signals import (
+    before_task_publish,
+    task_postrun,
+    task_prerun,
+    worker_init,
+    worker_process_init,
+    worker_process_shutdown,
+)
+from django.conf import settings
+from django.core.cache import cache
+from prometheus_client import CollectorRegistry, multiprocess, start_http_server
 
+from core.cache import (
+    censor_chunk_cache,
+    censor_engines,
+    close_publisher,
+    publish_invalidations,
+)
+from core.censor import CensorEngine, Span, censor_engine, mask
 from core.elk import es_service
-from core.models import TextSubmission
+from core.metrics import (
+    BACKFILL_CHUNKS,
+    BACKFILL_ROWS,
+    CELERY_QUEUE_WAIT_SECONDS,
+    PIPELINE_STAGE_SECONDS,
+    STARTUP_SECONDS,
+    size_bucket,
+)
+from core.models import (
+    ProcessingStatus,
+    TextSubmission,
+    TextVariant,
+    WordlistVersion,
+)
+from core.tracing import new_trace_id, trace_id_var
 
 logger = logging.getLogger(__name__)
 
 
-def blur_text(text: str) -> str:
-    return profanity.censor(text)
+@before_task_publish.connect
+def stamp_published_at(headers=None, **kwargs):
+    headers.setdefault('published_at', time())
+    # tasks sent while handling a request or another task continue its trace
+    if (trace_id := trace_id_var.get()) is not None:
+        headers.setdefault('trace_id', trace_id)
 
 
-def index_document(doc: TextSubmission) -> bool:
-    return async_to_sync(es_service.index_document)(
-        doc.text_hash, doc.original_text, doc.processed_text
+@task_prerun.connect
+def observe_queue_wait(task=None, **kwargs):
+    # custom message headers end up on the request
+    published_at = getattr(task.request, 'published_at', None)
+    if published_at is None:
+        return
+    queue = (task.request.delivery_info or {}).get('routing_key') or 'unknown'
+    task.request.queue_wait = max(time() - published_at, 0)
+    CELERY_QUEUE_WAIT_SECONDS.labels(queue).observe(task.request.queue_wait)
+
+
+@task_prerun.connect
+def bind_trace_id(task=None, **kwargs):
+    # tasks run eagerly keep the trace of their caller, beat starts new ones
+    trace_id = (
+        getattr(task.request, 'trace_id', None) or trace_id_var.get() or new_trace_id()
+    )
+    task.request.trace_id_token = trace_id_var.set(trace_id)
+
+
+@task_postrun.connect
+def unbind_trace_id(task=None, **kwargs):
+    token = getattr(task.request, 'trace_id_token', None)
+    if token is not None:
+        trace_id_var.reset(token)
+
+
+@worker_init.connect
+def start_metrics_server(**kwargs):
+    # pool processes write their metrics to PROMETHEUS_MULTIPROC_DIR, the main
+    # worker process serves them together
+    if not os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        return
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    start_http_server(settings.CELERY_METRICS_PORT, registry=registry)
+
+
+@worker_init.connect
+def freeze_gc(**kwargs):
+    # Everything loaded so far, the censor trie included, is shared copy-on-
+    # write with the pool processes. Frozen objects are skipped by garbage
+    # collections, which would otherwise write to, and so copy, their pages.
+    gc.freeze()
+
+
+@worker_process_init.connect
+def warm_up_process(**kwargs):
+    start = perf_counter()
+    censor_engine.warm_up()
+    # the client of the parent is not reused after a fork, created here
+    # rather than in the first task
+    es_service.sync_client
+    STARTUP_SECONDS.labels('worker_process').observe(perf_counter() - start)
+
+
+@worker_process_shutdown.connect
+def mark_metrics_process_dead(pid=None, **kwargs):
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        multiprocess.mark_process_dead(pid or os.getpid())
+
+
+@worker_process_shutdown.connect
+def close_es_client(**kwargs):
+    es_service.close()
+
+
+@worker_process_shutdown.connect
+def close_invalidation_publisher(**kwargs):
+    close_publisher()
+
+
+class StageTimer:
+    """
+    Times the stages of a task into PIPELINE_STAGE_SECONDS. ``log_if_slow``
+    logs the breakdown, queue wait included, once the task took longer than
+    PIPELINE_SLOW_SECONDS, the log line carries the trace id of the request
+    that submitted the texts.
+    """
+
+    def __init__(self, task_name: str):
+        self.task_name = task_name
+        self.timings: dict[str, float] = defaultdict(float)
+
+    def observe(self, name: str, size: int, elapsed: float):
+        # size in characters, of the text or of the whole batch
+        self.timings[name] += elapsed
+        PIPELINE_STAGE_SECONDS.labels(self.task_name, name, size_bucket(size)).observe(
+            elapsed
+        )
+
+    @contextmanager
+    def stage(self, name: str, size: int):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, size, perf_counter() - start)
+
+    def log_if_slow(self, texts: int):
+        queue_wait = getattr(current_task.request, 'queue_wait', 0.0)
+        total = queue_wait + sum(self.timings.values())
+        if not settings.PIPELINE_SLOW_SECONDS or total < settings.PIPELINE_SLOW_SECONDS:
+            return
+        logger.warning(
+            'Slow %s of %s texts in %.3fs: queue_wait=%.3fs %s',
+            self.task_name,
+            texts,
+            total,
+            queue_wait,
+            ' '.join(
+                f'{name}={elapsed:.3f}s' for name, elapsed in self.timings.items()
+            ),
+        )
+
+
+def text_size(submissions: list[TextSubmission]) -> int:
+    return sum(len(submission.original_text) for submission in submissions)
+
+
+def blur_text(text: str, engine: CensorEngine = censor_engine) -> str:
+    return mask(text, blur_spans(text, engine))
+
+
+def blur_spans(text: str, engine: CensorEngine = censor_engine) -> list[Span]:
+    if settings.CENSOR_PROCESSES > 1 and len(text) > settings.CENSOR_CHUNK_SIZE:
+        return engine.spans_parallel(
+            text, settings.CENSOR_CHUNK_SIZE, settings.CENSOR_PROCESSES
+        )
+    if len(text) >= settings.CENSOR_CACHE_MIN_LENGTH:
+        # near-duplicates only pay for the sentences that changed, the chunk
+        # cache is keyed by the engine fingerprint
+        return engine.spans_chunked(
+            text, engine.sentence_cuts(text), censor_chunk_cache.scan
+        )
+    return engine.spans(text)
+
+
+def submission_engine(submission: TextSubmission) -> CensorEngine:
+    # the default engine, or the wordlist profile version it was submitted with
+    engine = censor_engines.get(submission.wordlist_id)
+    if engine is None:
+        engine = censor_engines.compile(
+            WordlistVersion.objects.get(pk=submission.wordlist_id)
+        )
+    return engine
+
+
+def result_hashes(submissions: list[TextSubmission]) -> list[str]:
+    # results are cached under the text_id each caller got, variants included
+    text_hashes = [submission.text_hash for submission in submissions]
+    text_hashes.extend(
+        TextVariant.objects.filter(
+            submission_id__in=[submission.id for submission in submissions]
+        ).values_list('text_hash', flat=True)
     )
+    return text_hashes
 
 
-@shared_task
+def censor_submissions(submissions: list[TextSubmission], timer: StageTimer) -> None:
+    # one ES bulk request and one UPDATE for the whole batch
+    documents = []
+    for submission in submissions:
+        with timer.stage('censor', len(submission.original_text)):
+            spans = blur_spans(submission.original_text, submission_engine(submission))
+        submission.spans = spans
+        documents.append(
+            es_service.build_document(
+                submission.text_hash, submission.original_text, spans
+            )
+        )
+
+    size = text_size(submissions)
+    with timer.stage('index', size):
+        indexed = es_service.bulk_index(documents)
+
+    now = datetime.now(UTC)
+    for submission in submissions:
+        submission.status = ProcessingStatus.SUCCESS
+        submission.status_detail = ''
+        submission.updated_at = now
+        if submission.text_hash in indexed:
+            submission.indexed_at = now
+
+    with timer.stage('save', size):
+        TextSubmission.objects.bulk_update(
+            submissions,
+            ['censor_spans', 'status', 'status_detail', 'indexed_at', 'updated_at'],
+        )
+        publish_invalidations(result_hashes(submissions))
+
+
+def process_submissions(submissions: list[TextSubmission], timer: StageTimer) -> None:
+    # STARTED / FAILURE are recorded on the rows for get_result, failed rows
+    # keep censor_spans NULL and are retried by process_unprocessed_texts
+    ids = [submission.id for submission in submissions]
+    with timer.stage('mark_started', text_size(submissions)):
+        TextSubmission.objects.filter(id__in=ids).update(
+            status=ProcessingStatus.STARTED
+        )
+    try:
+        censor_submissions(submissions, timer)
+    except Exception as e:
+        TextSubmission.objects.filter(id__in=ids).update(
+            status=ProcessingStatus.FAILURE, status_detail=str(e)
+        )
+        publish_invalidations(result_hashes(submissions))
+        raise
+
+
+@shared_task(ignore_result=True)
 def process_text(text_hash: str) -> str:
+    timer = StageTimer(process_text.name)
     # Get the unique submission by hash
+    start = perf_counter()
     try:
         submission = TextSubmission.objects.get(text_hash=text_hash)
     except TextSubmission.DoesNotExist:
         raise ValueError(f'No submission found for hash {text_hash}')
+    timer.observe('load', len(submission.original_text), perf_counter() - start)
 
-    if submission.processed_text:
+    if submission.censor_spans is not None:
         return submission.processed_text
 
-    result = blur_text(submission.original_text)
+    process_submissions([submission], timer)
+    timer.log_if_slow(1)
+
+    return submission.processed_text
 
-    submission.processed_text = result
 
-    if index_document(submission):
-        submission.indexed_at = datetime.now(UTC)
+@shared_task(ignore_result=True)
+def process_texts(text_hashes: list[str]) -> None:
+    timer = StageTimer(process_texts.name)
+    start = perf_counter()
+    submissions = list(
+        TextSubmission.objects.filter(
+            text_hash__in=text_hashes, censor_spans__isnull=True
+        ).only('id', 'text_hash', 'original_text', 'wordlist')
+    )
+    if submissions:
+        # the size is only known once the rows are loaded
+        timer.observe('load', text_size(submissions), perf_counter() - start)
+        process_submissions(submissions, timer)
+        timer.log_if_slow(len(submissions))
 
-    submission.save()
 
-    return result
+def acquire_backfill_lock(task_name: str, token: str | None = None) -> str | None:
+    # Only one walk per backfill task at a time. Beat keeps sending new runs
+    # while a continuation may be waiting in the queue, those are skipped and
+    # the continuation takes the lock over with the token it was sent with.
+    key = f'lock:{task_name}'
+    if token is not None:
+        if cache.get(key) != token:
+            return None
+        cache.touch(key, settings.CELERY_TASK_TIME_LIMIT)
+        return token
 
+    token = uuid4().hex
+    if cache.add(key, token, settings.CELERY_TASK_TIME_LIMIT):
+        return token
+    return None
 
-@shared_task
-def process_unprocessed_texts():
-    objs = list(TextSubmission.objects.filter(processed_text__isnull=True))
-    total = len(objs)
 
-    logger.info('Starting to process %s texts', total)
+def release_backfill_lock(task_name: str, token: str):
+    key = f'lock:{task_name}'
+    if cache.get(key) == token:
+        cache.delete(key)
 
-    for obj in objs:
-        obj.processed_text = blur_text(obj.original_text)
 
-    TextSubmission.objects.bulk_update(objs, ['processed_text'])
+@shared_task(bind=True)
+def process_unprocessed_texts(self, after_id: int = 0, lock_token: str | None = None):
+    lock_token = acquire_backfill_lock(self.name, lock_token)
+    if lock_token is None:
+        logger.info('%s is already running, skipping', self.name)
+        return
 
-    logger.info(
-        'Finished processing texts, total processed: %s, IDs: %s',
-        len(objs),
-        [obj.id for obj in objs],
-    )
+    # Keyset pagination over the idx_unprocessed partial index, every chunk
+    # is committed on its own so a killed run loses at most one chunk
+    chunk_size = settings.BACKFILL_CHUNK_SIZE
+    total = 0
+    timer = StageTimer(self.name)
 
+    try:
+        while True:
+            start = perf_counter()
+            objs = list(
+                TextSubmission.objects.filter(
+                    censor_spans__isnull=True, id__gt=after_id
+                )
+                .order_by('id')
+                .only('id', 'text_hash', 'original_text', 'wordlist')[:chunk_size]
+            )
+            if not objs:
+                break
+            size = text_size(objs)
+            timer.observe('load', size, perf_counter() - start)
 
-@shared_task
-def index_unindexed_texts():
-    texts_to_index = list(
-        TextSubmission.objects.filter(
-            processed_text__isnull=False,
-            indexed_at__isnull=True,
+            now = datetime.now(UTC)
+            for obj in objs:
+                with timer.stage('censor', len(obj.original_text)):
+                    obj.spans = blur_spans(obj.original_text, submission_engine(obj))
+                obj.status = ProcessingStatus.SUCCESS
+                obj.status_detail = ''
+                obj.updated_at = now
+
+            with timer.stage('save', size):
+                TextSubmission.objects.bulk_update(
+                    objs, ['censor_spans', 'status', 'status_detail', 'updated_at']
+                )
+                publish_invalidations(result_hashes(objs))
+
+            after_id = objs[-1].id
+            total += len(objs)
+            BACKFILL_ROWS.labels(self.name).inc(len(objs))
+            BACKFILL_CHUNKS.labels(self.name).inc()
+    except SoftTimeLimitExceeded:
+        # continue right away from the last committed chunk, still holding the lock
+        logger.warning(
+            'Soft time limit reached after %s texts, resuming after id %s',
+            total,
+            after_id,
         )
-    )
+        self.apply_async(kwargs={'after_id': after_id, 'lock_token': lock_token})
+        return
+    except BaseException:
+        release_backfill_lock(self.name, lock_token)
+        raise
 
-    updated_texts = []
-    current_time = datetime.now(UTC)
+    release_backfill_lock(self.name, lock_token)
+    logger.info('Finished processing texts, total processed: %s', total)
 
-    for text in texts_to_index:
-        if index_document(text):
-            text.indexed_at = current_time
-            text.updated_at = current_time
-            updated_texts.append(text)
 
-    if updated_texts:
-        TextSubmission.objects.bulk_update(updated_texts, ['indexed_at', 'updated_at'])
+@shared_task(bind=True)
+def index_unindexed_texts(self, after_id: int = 0, lock_token: str | None = None):
+    lock_token = acquire_backfill_lock(self.name, lock_token)
+    if lock_token is None:
+        logger.info('%s is already running, skipping', self.name)
+        return
+
+    # Same keyset walk as process_unprocessed_texts, over the idx_unindexed
+    # partial index. Documents ES rejects keep indexed_at NULL and are
+    # retried by the next run.
+    chunk_size = settings.BACKFILL_CHUNK_SIZE
+    total_indexed = 0
+    total_failed = 0
+    timer = StageTimer(self.name)
+
+    try:
+        while True:
+            start = perf_counter()
+            objs = list(
+                TextSubmission.objects.filter(
+                    indexed_at__isnull=True,
+                    censor_spans__isnull=False,
+                    id__gt=after_id,
+                )
+                .order_by('id')
+                .only('id', 'text_hash', 'original_text', 'censor_spans')[:chunk_size]
+            )
+            if not objs:
+                break
+            size = text_size(objs)
+            timer.observe('load', size, perf_counter() - start)
+
+            with timer.stage('index', size):
+                indexed = es_service.bulk_index(
+                    es_service.build_document(
+                        obj.text_hash, obj.original_text, obj.spans
+                    )
+                    for obj in objs
+                )
+
+            now = datetime.now(UTC)
+            updated_texts = []
+            for obj in objs:
+                if obj.text_hash in indexed:
+                    obj.indexed_at = now
+                    obj.updated_at = now
+                    updated_texts.append(obj)
+
+            if updated_texts:
+                with timer.stage('save', size):
+                    TextSubmission.objects.bulk_update(
+                        updated_texts, ['indexed_at', 'updated_at']
+                    )
+
+            after_id = objs[-1].id
+            total_indexed += len(updated_texts)
+            total_failed += len(objs) - len(updated_texts)
+            BACKFILL_ROWS.labels(self.name).inc(len(objs))
+            BACKFILL_CHUNKS.labels(self.name).inc()
+    except SoftTimeLimitExceeded:
+        logger.warning(
+            'Soft time limit reached after %s texts, resuming after id %s',
+            total_indexed + total_failed,
+            after_id,
+        )
+        self.apply_async(kwargs={'after_id': after_id, 'lock_token': lock_token})
+        return
+    except BaseException:
+        release_backfill_lock(self.name, lock_token)
+        raise
 
+    release_backfill_lock(self.name, lock_token)
     logger.info(
-        'Finished indexing texts, total indexed: %s, IDs: %s',
-        len(updated_texts),
-        [obj.id for obj in updated_texts],
+        'Finished indexing texts, total indexed: %s, failed: %s',
+        total_indexed,
+        total_failed,
     )
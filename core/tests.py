@@ -1,5 +1,85 @@
+import asyncio
+import io
+import json
+import logging
+import queue
+import sys
+import random
+from datetime import timedelta
+from ipaddress import ip_network
+from uuid import uuid4
+
 import pytest
-from core.models import TextSubmission
+import pytest_asyncio
+from better_profanity import profanity
+from better_profanity.utils import read_wordlist
+from django.core.management import call_command
+from elastic_transport import ApiResponseMeta, HttpHeaders
+from elasticsearch import BadRequestError, NotFoundError
+from django.db.models import F
+from prometheus_client import REGISTRY
+
+from blurifier.celery import app as celery_app
+from core.admission import RateLimiter, client_id, pipeline_lag
+from core.batcher import ProcessingBatcher, processing_batcher
+from core.cache import (
+    CensorEngineCache,
+    LocalLRUCache,
+    censor_chunk_cache,
+    close_loop_redis_client,
+    existence_filter,
+    redis_client,
+    result_cache,
+    wordlist_profiles,
+)
+from core.censor import (
+    CHARS_MAPPING,
+    DEFAULT_WORDLIST,
+    CensorEngine,
+    censor_engine,
+    mask,
+    pack_spans,
+    unpack_spans,
+)
+from core.elk import SearchCursor, es_service
+from core.log import BackgroundHandler, JsonFormatter, RateLimitFilter
+from core.metrics import (
+    CENSOR_CACHE_CHUNKS,
+    EXISTENCE_FILTER_LOOKUPS,
+    LOG_RECORDS_DROPPED,
+    RESULT_CACHE_LOOKUPS,
+)
+from core.models import (
+    ProcessingStatus,
+    TextSubmission,
+    TextVariant,
+    WordlistProfile,
+    canonical_text,
+    hash_text,
+    variant_spans,
+)
+from core.tasks import (
+    acquire_backfill_lock,
+    blur_spans,
+    blur_text,
+    index_unindexed_texts,
+    process_texts,
+    process_unprocessed_texts,
+    release_backfill_lock,
+    stamp_published_at,
+    warm_up_process,
+)
+from core.tracing import TRACE_HEADER, TraceIdFilter, trace_id_var
+
+
+@pytest_asyncio.fixture(autouse=True)
+async def close_redis_client():
+    # the result cache, the existence filter and the rate limiter share one
+    # Redis client per event loop, closed at the end of every test the way
+    # the ASGI lifespan does, or its connections keep the fake server's
+    # handler threads alive after the run
+    yield
+    await close_loop_redis_client()
 
 
 @pytest.mark.django_db
@@ -13,8 +93,323 @@ async def test_submit_text(async_client):
     data = response.json()
     assert 'text_id' in data
 
+    # small enough to be censored inline
+    assert data['result']['status'] == ProcessingStatus.SUCCESS
+    assert data['result']['processed'] == 'this is a **** test'
+
     submission = await TextSubmission.objects.aget(text_hash=data['text_id'])
     assert submission.original_text == 'this is a damn test'
+    assert submission.indexed_at is None
+
+
+@pytest.mark.django_db
+@pytest.mark.asyncio
+async def test_submit_text_large_goes_to_celery(async_client, settings, enqueue_only):
+    settings.INLINE_CENSOR_MAX_BYTES = 8
+    response = await async_client.post(
+        '/api/submit/', {'text': 'too long to inline'}, content_type='application/json'
+    )
+    data = response.json()
+    assert data['result'] is None
+
+    submission = await TextSubmission.objects.aget(text_hash=data['text_id'])
+    assert submission.status == ProcessingStatus.PENDING
+
+
+def lookups(result: str) -> float:
+    return EXISTENCE_FILTER_LOOKUPS.labels(result)._value.get()
+
+
+@pytest.mark.django_db
+@pytest.mark.asyncio
+async def test_submit_text_existence_filter(async_client, settings):
+    settings.EXISTENCE_FILTER = True
+    before = {result: lookups(result) for result in ('new', 'present')}
+    for _ in range(2):
+        await async_client.post(
+            '/api/submit/',
+            {'text': 'filtered text'},
+            content_type='application/json',
+        )
+    assert lookups('new') == before['new'] + 1
+    assert lookups('present') == before['present'] + 1
+
+    # stored behind the filter's back, the failed INSERT finds it
+    stored = await TextSubmission.objects.acreate(original_text='unfiltered text')
+    response = await async_client.post(
+        '/api/submit/', {'text': 'unfiltered text'}, content_type='application/json'
+    )
+    assert response.json()['text_id'] == stored.text_hash
+
+    assert await existence_filter.might_contain(stored.text_hash)
+    assert not await existence_filter.might_contain('0' * 64)
+
+
+def test_existence_filter_rebuild():
+    existence_filter.rebuild(['a' * 64, 'b' * 64])
+    client = redis_client()
+    bits = [
+        [client.getbit(existence_filter.key, offset) for offset in offsets]
+        for offsets in map(existence_filter.offsets, ('a' * 64, 'c' * 64))
+    ]
+    client.connection_pool.disconnect()
+    assert all(bits[0])
+    assert not all(bits[1])
+
+
+@pytest.mark.django_db
+def test_prune_search_index(monkeypatch):
+    stored = TextSubmission.objects.create(original_text='still here')
+    deleted = []
+    monkeypatch.setattr(
+        es_service, 'document_ids', lambda: iter([stored.text_hash, 'a' * 64])
+    )
+    monkeypatch.setattr(
+        es_service, 'bulk_delete', lambda doc_ids: deleted.extend(doc_ids) or 1
+    )
+
+    call_command('prune_search_index', stdout=io.StringIO())
+    assert deleted == ['a' * 64]
+
+
+def test_canonical_text():
+    assert (
+        canonical_text(' cafe\u0301  au\tlait \r\nnoir\r') == 'caf\u00e9 au lait\nnoir'
+    )
+
+
+def test_variant_spans():
+    text = ' cafe\u0301  damn\tit \r\n\r\nshit\r'
+    canonical = canonical_text(text)
+    spans = [(0, 4), (5, 9), (5, 12), (14, 18)]
+    assert [canonical[start:end] for start, end in spans] == [
+        'caf\u00e9',
+        'damn',
+        'damn it',
+        'shit',
+    ]
+    assert [text[start:end] for start, end in variant_spans(text, spans)] == [
+        'cafe\u0301',
+        'damn',
+        'damn\tit',
+        'shit',
+    ]
+
+
+@pytest.mark.django_db
+@pytest.mark.asyncio
+async def test_submit_text_variants_share_submission(async_client):
+    text_ids = []
+    for text in ('damn  it', 'damn it\r\n'):
+        response = await async_client.post(
+            '/api/submit/', {'text': text}, content_type='application/json'
+        )
+        text_ids.append(response.json()['text_id'])
+    assert text_ids[0] != text_ids[1]
+
+    submission = await TextSubmission.objects.aget(original_text='damn it')
+    assert await TextVariant.objects.filter(submission=submission).acount() == 2
+
+    # every caller gets back their own text, censored like the canonical one
+    for text_id, original in zip(text_ids, ('damn  it', 'damn it\r\n')):
+        data = (await async_client.get(f'/api/result/{text_id}/')).json()
+        assert data['original'] == original
+        assert data['processed'] == '**** it'
+
+
+@pytest.mark.django_db
+@pytest.mark.asyncio
+async def test_submit_text_variant_spans(async_client):
+    # spans point into what the caller sent, not into the canonical text
+    original = '  damn   it,\r\n  shit '
+    response = await async_client.post(
+        '/api/submit/', {'text': original}, content_type='application/json'
+    )
+    text_id = response.json()['text_id']
+    for result in (
+        response.json()['result'],
+        (await async_client.get(f'/api/result/{text_id}/')).json(),
+    ):
+        assert result['original'] == original
+        assert result['processed'] == '**** it,\n****'
+        assert [original[start:end] for start, end in result['spans']] == [
+            'damn',
+            'shit',
+        ]
+
+
+@pytest.mark.django_db
+@pytest.mark.asyncio
+async def test_submit_text_whitespace_variant(async_client):
+    # the canonical text of a whitespace-only text is empty
+    response = await async_client.post(
+        '/api/submit/', {'text': ' \t '}, content_type='application/json'
+    )
+    result = response.json()['result']
+    assert result['original'] == ' \t '
+    assert result['processed'] == ''
+    assert result['spans'] == []
+
+
+@pytest.mark.django_db
+@pytest.mark.asyncio
+async def test_submit_text_with_wordlist_profile(async_client):
+    async def submit(text, **payload):
+        response = await async_client.post(
+            '/api/submit/', {'text': text, **payload}, content_type='application/json'
+        )
+        return response.status_code, response.json()
+
+    _, default = await submit('damn dang')
+    assert default['result']['processed'] == '**** dang'
+
+    name = f'tenant-{uuid4().hex[:8]}'
+    profile = await WordlistProfile.objects.acreate(
+        name=name, words='dang', allowed='damn'
+    )
+    _, first = await submit('damn dang', profile=name)
+    assert first['text_id'] != default['text_id']
+    assert first['result']['processed'] == 'damn ****'
+    submission = await TextSubmission.objects.select_related('wordlist').aget(
+        text_hash=first['text_id']
+    )
+    assert submission.wordlist.number == 1
+
+    # a changed profile is a new version, texts censored with the old one
+    # keep their results
+    profile.allowed = ''
+    await profile.asave()
+    wordlist_profiles.clear()
+    _, second = await submit('damn dang', profile=name)
+    assert second['text_id'] != first['text_id']
+    assert second['result']['processed'] == '**** ****'
+    data = (await async_client.get(f'/api/result/{first["text_id"]}/')).json()
+    assert data['processed'] == 'damn ****'
+
+    # censoring like the default wordlist shares its results
+    same_name = f'tenant-{uuid4().hex[:8]}'
+    await WordlistProfile.objects.acreate(name=same_name)
+    _, same = await submit('damn dang', profile=same_name)
+    assert same['text_id'] == default['text_id']
+
+    status, _ = await submit('damn dang', profile='no-such-profile')
+    assert status == 400
+
+
+@pytest.fixture
+def fresh_pipeline_lag():
+    pipeline_lag.reset()
+    yield pipeline_lag
+    pipeline_lag.reset()
+
+
+@pytest.mark.django_db
+@pytest.mark.asyncio
+async def test_submit_text_defers_then_rejects_when_behind(
+    async_client, settings, fresh_pipeline_lag, monkeypatch
+):
+    sent = []
+    monkeypatch.setattr(processing_batcher, 'add', sent.append)
+    settings.INLINE_CENSOR_MAX_BYTES = 0
+    settings.ADMISSION_DEFER_LAG = 60
+    settings.ADMISSION_REJECT_LAG = 0
+    # the unprocessed submissions have been waiting for ten minutes
+    unprocessed = TextSubmission.objects.filter(censor_spans__isnull=True)
+    await unprocessed.aupdate(created_at=F('created_at') - timedelta(minutes=10))
+
+    try:
+        response = await async_client.post(
+            '/api/submit/', {'text': 'deferred text'}, content_type='application/json'
+        )
+        assert response.status_code == 200
+        # stored for process_unprocessed_texts, nothing sent to Celery
+        assert await TextSubmission.objects.filter(
+            text_hash=response.json()['text_id']
+        ).aexists()
+        assert sent == []
+
+        settings.ADMISSION_REJECT_LAG = 300
+        response = await async_client.post(
+            '/api/submit/', {'text': 'rejected text'}, content_type='application/json'
+        )
+        assert response.status_code == 429
+        assert response['Retry-After'] == '30'
+    finally:
+        await unprocessed.aupdate(created_at=F('created_at') + timedelta(minutes=10))
+
+
+@pytest.mark.django_db
+@pytest.mark.asyncio
+async def test_submit_text_inline_not_shed(async_client, settings, fresh_pipeline_lag):
+    settings.ADMISSION_REJECT_LAG = 1
+    unprocessed = await TextSubmission.objects.acreate(original_text='waiting text')
+    await TextSubmission.objects.filter(pk=unprocessed.pk).aupdate(
+        created_at=F('created_at') - timedelta(minutes=10)
+    )
+    try:
+        # censored right away, the workers' lag does not concern it
+        response = await async_client.post(
+            '/api/submit/', {'text': 'inline damn'}, content_type='application/json'
+        )
+        assert response.status_code == 200
+        assert response.json()['result']['processed'] == 'inline ****'
+    finally:
+        await unprocessed.adelete()
+
+
+@pytest.mark.django_db
+@pytest.mark.asyncio
+async def test_submit_text_censors_only_unprocessed_rows(async_client, monkeypatch):
+    censored = []
+
+    def counting_blur_spans(text, engine):
+        censored.append(text)
+        return blur_spans(text, engine)
+
+    monkeypatch.setattr('core.api.blur_spans', counting_blur_spans)
+    stored = await TextSubmission.objects.acreate(original_text='stored damn')
+
+    for _ in range(2):
+        response = await async_client.post(
+            '/api/submit/', {'text': 'stored damn'}, content_type='application/json'
+        )
+        assert response.json()['result']['processed'] == 'stored ****'
+    # the unprocessed row is censored once, the second submit reads it
+    assert censored == ['stored damn']
+    stored = await TextSubmission.objects.aget(pk=stored.pk)
+    assert stored.status == ProcessingStatus.SUCCESS
+
+
+@pytest.mark.asyncio
+async def test_rate_limiter(caplog):
+    # the token bucket is a Lua script, fakeredis runs it with lupa
+    pytest.importorskip('lupa')
+    limiter = RateLimiter(rate=0.01, burst=2)
+    assert await limiter.acquire('client') == 0
+    assert await limiter.acquire('client') == 0
+    assert 0 < await limiter.acquire('client') <= 100
+    assert await limiter.acquire('other client') == 0
+    # errors are logged and let the request through, none happened
+    assert not [r for r in caplog.records if r.name == 'core.admission']
+
+
+def test_client_id_trusts_real_ip_only_from_proxies(rf, settings):
+    settings.TRUSTED_PROXIES = [ip_network('172.28.0.0/24')]
+    proxied = rf.get('/', REMOTE_ADDR='172.28.0.10', HTTP_X_REAL_IP='203.0.113.7')
+    assert client_id(proxied) == '203.0.113.7'
+
+    direct = rf.get('/', REMOTE_ADDR='198.51.100.1', HTTP_X_REAL_IP='203.0.113.7')
+    assert client_id(direct) == '198.51.100.1'
+
+
+@pytest.mark.asyncio
+async def test_trace_id_header(async_client):
+    response = await async_client.get('/ping/', headers={TRACE_HEADER: 'abc-123'})
+    assert response[TRACE_HEADER] == 'abc-123'
+
+    # ids that do not look like one are replaced
+    response = await async_client.get('/ping/', headers={TRACE_HEADER: 'a b\nc'})
+    assert len(response[TRACE_HEADER]) == 32
 
 
 @pytest.mark.django_db
@@ -22,7 +417,8 @@ async def test_submit_text(async_client):
 async def test_get_result(async_client):
     submission = await TextSubmission.objects.acreate(
         original_text='fuck shit',
-        processed_text='f*** s***',
+        spans=[(0, 4), (5, 9)],
+        status=ProcessingStatus.SUCCESS,
     )
 
     url = f'/api/result/{submission.text_hash}/'
@@ -30,4 +426,744 @@ async def test_get_result(async_client):
     assert response.status_code == 200
     data = response.json()
     assert data['original'] == 'fuck shit'
-    assert data['processed'] == 'f*** s***'
+    assert data['processed'] == '**** ****'
+    assert data['spans'] == [[0, 4], [5, 9]]
+
+    # served from the cache, which only holds the packed spans
+    local_hits = RESULT_CACHE_LOOKUPS.labels('local_hit')._value.get()
+    response = await async_client.get(url)
+    assert response.json()['processed'] == '**** ****'
+    assert RESULT_CACHE_LOOKUPS.labels('local_hit')._value.get() == local_hits + 1
+
+
+@pytest.mark.django_db
+@pytest.mark.asyncio
+async def test_get_results(async_client):
+    done = await TextSubmission.objects.acreate(
+        original_text='bulk shit', spans=[(5, 9)], status=ProcessingStatus.SUCCESS
+    )
+    pending = await TextSubmission.objects.acreate(original_text='bulk pending')
+    text_ids = [pending.text_hash, 'unknown', done.text_hash, pending.text_hash]
+
+    for _ in range(2):  # from the DB, then from the cache
+        response = await async_client.post(
+            '/api/results/', {'text_ids': text_ids}, content_type='application/json'
+        )
+        assert response.status_code == 200
+        items = response.json()['items']
+        assert [item['text_id'] for item in items] == text_ids
+        assert [item['status'] for item in items] == [
+            'PENDING',
+            'NOT_FOUND',
+            'SUCCESS',
+            'PENDING',
+        ]
+        assert items[1]['result'] is None
+        assert items[2]['result']['processed'] == 'bulk ****'
+
+
+@pytest.mark.django_db
+@pytest.mark.asyncio
+async def test_get_result_pending_is_invalidated(async_client):
+    submission = await TextSubmission.objects.acreate(original_text='pending shit')
+    url = f'/api/result/{submission.text_hash}/'
+
+    response = await async_client.get(url)
+    assert response.json()['status'] == ProcessingStatus.PENDING
+    assert response.json()['processed'] is None
+
+    submission.spans = [(8, 12)]
+    submission.status = ProcessingStatus.SUCCESS
+    await submission.asave()
+    # still pending for the local cache until the worker publishes the hash
+    response = await async_client.get(url)
+    assert response.json()['processed'] is None
+
+    result_cache.invalidate([submission.text_hash])
+    response = await async_client.get(url)
+    assert response.json()['processed'] == 'pending ****'
+
+
+@pytest.mark.django_db
+@pytest.mark.asyncio
+async def test_get_result_wait_wakes_on_notification(async_client):
+    submission = await TextSubmission.objects.acreate(original_text='slow shit')
+
+    async def finish():
+        await asyncio.sleep(0.05)
+        submission.spans = [(5, 9)]
+        submission.status = ProcessingStatus.SUCCESS
+        await submission.asave()
+        result_cache.invalidate([submission.text_hash])
+
+    worker = asyncio.create_task(finish())
+    response = await async_client.get(
+        f'/api/result/{submission.text_hash}/', {'wait': 5}
+    )
+    await worker
+
+    data = response.json()
+    assert data['status'] == ProcessingStatus.SUCCESS
+    assert data['processed'] == 'slow ****'
+
+
+@pytest.mark.django_db
+@pytest.mark.asyncio
+async def test_stream_result_ends_with_final_status(async_client):
+    submission = await TextSubmission.objects.acreate(original_text='streamed shit')
+
+    response = await async_client.get(f'/api/result/{submission.text_hash}/events/')
+    assert response['Content-Type'] == 'text/event-stream'
+    stream = aiter(response.streaming_content)
+    events = [(await anext(stream)).decode()]
+
+    # saved by a worker while the stream waits for it
+    submission.spans = [(9, 13)]
+    submission.status = ProcessingStatus.SUCCESS
+    await submission.asave()
+    result_cache.invalidate([submission.text_hash])
+    events += [chunk.decode() async for chunk in stream]
+
+    assert len(events) == 2
+    assert '"status":"PENDING"' in events[0]
+    assert '"processed":"streamed ****"' in events[1]
+
+
+@pytest.mark.django_db
+@pytest.mark.asyncio
+async def test_stream_result_saved_before_streaming(async_client):
+    submission = await TextSubmission.objects.acreate(original_text='early shit')
+    response = await async_client.get(f'/api/result/{submission.text_hash}/events/')
+
+    # notified before the stream started waiting
+    submission.spans = [(6, 10)]
+    submission.status = ProcessingStatus.SUCCESS
+    await submission.asave()
+    result_cache.invalidate([submission.text_hash])
+
+    events = [chunk.decode() async for chunk in response.streaming_content]
+    assert len(events) == 1
+    assert '"processed":"early ****"' in events[0]
+
+
+def test_local_lru_cache():
+    lru = LocalLRUCache(max_bytes=10, ttl=60)
+    lru.set('a', 1, size=4)
+    lru.set('b', 2, size=4)
+    assert lru.get('a') == 1
+
+    # 'b' is the least recently used one
+    lru.set('c', 3, size=4)
+    assert lru.get('b') is None
+    assert lru.get('a') == 1
+    assert lru.size == 8
+
+    lru.set('d', 4, size=11)
+    assert lru.get('d') is None
+
+    lru.set('e', 5, size=1, ttl=0)
+    assert lru.get('e') is None
+    assert lru.size == 8
+
+
+@pytest.fixture
+def enqueue_only(monkeypatch):
+    # send tasks to the in-memory broker instead of running them eagerly
+    monkeypatch.setattr(celery_app.conf, 'CELERY_TASK_ALWAYS_EAGER', False)
+
+
+@pytest.mark.django_db
+@pytest.mark.asyncio
+async def test_submit_batch(async_client, enqueue_only):
+    existing = await TextSubmission.objects.acreate(original_text='already here')
+
+    response = await async_client.post(
+        '/api/submit/batch/',
+        [{'text': 'first'}, {'text': 'already here'}, {'text': 'first'}],
+        content_type='application/json',
+    )
+    assert response.status_code == 200
+    text_ids = response.json()['text_ids']
+    assert len(text_ids) == 3
+    assert text_ids[1] == existing.text_hash
+    assert text_ids[0] == text_ids[2]
+    first = await TextSubmission.objects.aget(text_hash=text_ids[0])
+    assert first.original_text == 'first'
+
+    response = await async_client.post(
+        '/api/submit/batch/',
+        b'{"text": "second"}\n{"text": "first"}\n',
+        content_type='application/x-ndjson',
+    )
+    assert response.status_code == 200
+    second_id, first_id = response.json()['text_ids']
+    assert first_id == text_ids[0]
+    assert await TextSubmission.objects.filter(text_hash=second_id).aexists()
+
+    response = await async_client.post(
+        '/api/submit/batch/', [{'text': ' first '}], content_type='application/json'
+    )
+    (variant_id,) = response.json()['text_ids']
+    variant = await TextVariant.objects.select_related('submission').aget(
+        text_hash=variant_id
+    )
+    assert variant.submission.text_hash == text_ids[0]
+
+    response = await async_client.post(
+        '/api/submit/batch/', [], content_type='application/json'
+    )
+    assert response.status_code == 400
+
+
+@pytest.mark.parametrize(
+    'task, queue',
+    [
+        (process_texts, 'interactive'),
+        (process_unprocessed_texts, 'backfill'),
+        (index_unindexed_texts, 'backfill'),
+    ],
+)
+def test_task_queues(task, queue):
+    route = celery_app.amqp.router.route({}, task.name)
+    assert route['queue'].name == queue
+
+
+@pytest.mark.django_db
+def test_process_texts():
+    submissions = [
+        TextSubmission.objects.create(original_text=text)
+        for text in ('shit happens', 'all good')
+    ]
+
+    process_texts([submission.text_hash for submission in submissions])
+
+    first, second = (
+        TextSubmission.objects.get(pk=submission.pk) for submission in submissions
+    )
+    assert first.processed_text == '**** happens'
+    assert first.status == ProcessingStatus.SUCCESS
+    assert second.spans == []
+
+
+@pytest.mark.django_db
+def test_process_texts_with_wordlist_profile():
+    profile = WordlistProfile.objects.create(
+        name=f'tenant-{uuid4().hex[:8]}', words='happens', include_default=False
+    )
+    wordlist = profile.versions.get()
+    submission = TextSubmission.objects.create(
+        original_text='shit happens', wordlist=wordlist
+    )
+
+    process_texts([submission.text_hash])
+
+    submission.refresh_from_db()
+    assert submission.processed_text == 'shit ****'
+    assert submission.text_hash != hash_text('shit happens')
+
+
+@pytest.mark.django_db
+def test_submission_resave_skips_wordlist(django_assert_num_queries):
+    profile = WordlistProfile.objects.create(name=f'tenant-{uuid4().hex[:8]}')
+    submission = TextSubmission.objects.create(
+        original_text='all good', wordlist=profile.versions.get()
+    )
+    submission = TextSubmission.objects.get(pk=submission.pk)
+
+    # the hash is already set, only the UPDATE runs
+    with django_assert_num_queries(1):
+        submission.save(update_fields=['status'])
+
+
+@pytest.mark.django_db
+def test_censor_engine_cache():
+    engines = CensorEngineCache(max_size=1)
+    assert engines.get(None) is censor_engine
+
+    profile = WordlistProfile.objects.create(name=f'tenant-{uuid4().hex[:8]}')
+    first = profile.versions.get()
+    profile.words = 'happens'
+    profile.save()
+    second = profile.versions.get(number=2)
+    # saving unchanged lists does not add a version
+    profile.save()
+    assert profile.versions.count() == 2
+
+    assert engines.get(first.id) is None
+    engine = engines.compile(first)
+    assert engines.get(first.id) is engine
+
+    engines.compile(second)
+    assert engines.get(first.id) is None
+    assert engines.get(second.id).censor('it happens') == 'it ****'
+
+
+def stage_count(task: str, stage: str, size: str) -> float:
+    return (
+        REGISTRY.get_sample_value(
+            'blurifier_pipeline_stage_seconds_count',
+            {'task': task, 'stage': stage, 'size': size},
+        )
+        or 0.0
+    )
+
+
+@pytest.mark.django_db
+def test_process_texts_stages(settings, caplog):
+    settings.PIPELINE_SLOW_SECONDS = 1e-9
+    submissions = [
+        TextSubmission.objects.create(original_text=text)
+        for text in ('shit happens', 'x' * 2000)
+    ]
+    task = process_texts.name
+    before = {
+        (stage, size): stage_count(task, stage, size)
+        for stage, size in [
+            ('load', '10KB'),
+            ('censor', '1KB'),
+            ('censor', '10KB'),
+            ('index', '10KB'),
+            ('save', '10KB'),
+        ]
+    }
+
+    caplog.handler.addFilter(TraceIdFilter())
+    token = trace_id_var.set('submit-trace')
+    try:
+        process_texts.apply(args=[[s.text_hash for s in submissions]])
+    finally:
+        trace_id_var.reset(token)
+
+    # one observation per text for censor, per batch for the others
+    for (stage, size), count in before.items():
+        assert stage_count(task, stage, size) == count + 1, (stage, size)
+
+    # eager tasks continue the trace of their caller
+    [record] = [r for r in caplog.records if r.getMessage().startswith('Slow')]
+    assert record.trace_id == 'submit-trace'
+    assert 'censor=' in record.getMessage()
+
+
+def test_warm_up_process():
+    def cold_starts():
+        return (
+            REGISTRY.get_sample_value(
+                'blurifier_startup_seconds_count', {'process': 'worker_process'}
+            )
+            or 0.0
+        )
+
+    before = cold_starts()
+    warm_up_process()
+    assert cold_starts() == before + 1
+
+
+def test_task_messages_carry_trace_id():
+    headers = {}
+    stamp_published_at(headers=headers)
+    assert 'trace_id' not in headers
+
+    token = trace_id_var.set('submit-trace')
+    try:
+        stamp_published_at(headers=headers)
+    finally:
+        trace_id_var.reset(token)
+    assert headers['trace_id'] == 'submit-trace'
+
+
+@pytest.mark.django_db
+def test_process_texts_records_failure(monkeypatch):
+    submission = TextSubmission.objects.create(original_text='doomed shit')
+
+    def fail(documents):
+        raise RuntimeError('cluster on fire')
+
+    monkeypatch.setattr(es_service, 'bulk_index', fail)
+    with pytest.raises(RuntimeError):
+        process_texts([submission.text_hash])
+
+    submission.refresh_from_db()
+    assert submission.status == ProcessingStatus.FAILURE
+    assert submission.status_detail == 'cluster on fire'
+    assert submission.censor_spans is None
+
+
+@pytest.mark.django_db
+def test_process_unprocessed_texts_in_chunks(settings):
+    settings.BACKFILL_CHUNK_SIZE = 2
+    submissions = [
+        TextSubmission.objects.create(original_text=f'backlog shit {i}')
+        for i in range(5)
+    ]
+
+    process_unprocessed_texts()
+
+    assert not TextSubmission.objects.filter(
+        pk__in=[submission.pk for submission in submissions],
+        censor_spans__isnull=True,
+    ).exists()
+    assert TextSubmission.objects.get(pk=submissions[-1].pk).processed_text == (
+        'backlog **** 4'
+    )
+
+
+@pytest.mark.django_db
+def test_process_unprocessed_texts_skips_while_locked():
+    submission = TextSubmission.objects.create(original_text='locked shit')
+    lock_token = acquire_backfill_lock(process_unprocessed_texts.name)
+
+    # a beat run while a continuation is pending
+    process_unprocessed_texts()
+    submission.refresh_from_db()
+    assert submission.censor_spans is None
+
+    # the continuation takes the lock over and releases it when done
+    process_unprocessed_texts(lock_token=lock_token)
+    submission.refresh_from_db()
+    assert submission.processed_text == 'locked ****'
+    lock_token = acquire_backfill_lock(process_unprocessed_texts.name)
+    assert lock_token is not None
+    release_backfill_lock(process_unprocessed_texts.name, lock_token)
+
+
+@pytest.mark.django_db
+def test_index_unindexed_texts_keeps_failed_documents(settings):
+    # the test settings point at an Elasticsearch that is not running
+    settings.BACKFILL_CHUNK_SIZE = 2
+    submissions = [
+        TextSubmission.objects.create(original_text=f'index me {i}', spans=[])
+        for i in range(3)
+    ]
+
+    index_unindexed_texts()
+
+    assert TextSubmission.objects.filter(
+        pk__in=[submission.pk for submission in submissions],
+        indexed_at__isnull=True,
+    ).count() == len(submissions)
+
+
+@pytest.mark.django_db
+@pytest.mark.asyncio
+async def test_processing_batcher_flushes_by_size_and_window():
+    batcher = ProcessingBatcher(max_size=2, max_delay=0.01)
+
+    batcher.add('a' * 64)
+    assert batcher._pending == ['a' * 64]
+    batcher.add('b' * 64)
+    assert batcher._pending == []
+
+    batcher.add('c' * 64)
+    await asyncio.sleep(0.05)
+    assert batcher._pending == []
+
+
+@pytest.mark.asyncio
+async def test_es_client_is_reused_per_event_loop():
+    def open_clients():
+        return REGISTRY.get_sample_value('blurifier_es_open_clients')
+
+    await es_service.aclose()
+    before = open_clients()
+    client = es_service.async_client
+    assert es_service.async_client is client
+    assert open_clients() == before + 1
+
+    await es_service.aclose()
+    assert open_clients() == before
+    assert es_service.async_client is not client
+    await es_service.aclose()
+    assert open_clients() == before
+
+
+@pytest.mark.asyncio
+async def test_search_checks_index_only_until_ready(async_client, monkeypatch):
+    response = await async_client.get('/api/search/', {'query': ' '})
+    assert response.status_code == 400
+
+    response = await async_client.get('/api/search/', {'query': 'damn'})
+    assert response.status_code == 503
+
+    # the test settings point at an Elasticsearch that is not running, which
+    # is not an empty result
+    monkeypatch.setattr(es_service, 'index_ready', True)
+    response = await async_client.get('/api/search/', {'query': 'damn'})
+    assert response.status_code == 503
+
+
+@pytest.mark.asyncio
+async def test_search_rejects_expired_cursor(async_client, monkeypatch):
+    class ExpiredPointInTime:
+        async def search(self, body):
+            meta = ApiResponseMeta(404, '1.1', HttpHeaders(), 0.0, None)
+            raise NotFoundError('search_context_missing_exception', meta, {})
+
+    monkeypatch.setattr(type(es_service), 'async_client', ExpiredPointInTime())
+    monkeypatch.setattr(es_service, 'index_ready', True)
+    cursor = SearchCursor('pit', [1.5, 'abc', 7]).encode()
+    response = await async_client.get(
+        '/api/search/', {'query': 'damn', 'cursor': cursor}
+    )
+    assert response.status_code == 400
+    assert response.json()['detail'] == 'Cursor expired, start the search again'
+
+
+class PointInTimeSearch:
+    # the rules ES applies to search_after in a point in time
+    def __init__(self, total):
+        self.total = total
+        self.bodies = []
+        self.open_pits = set()
+
+    async def open_point_in_time(self, index, keep_alive):
+        self.open_pits.add('pit')
+        return {'id': 'pit'}
+
+    async def close_point_in_time(self, id):
+        self.open_pits.remove(id)
+
+    async def search(self, body, index=None):
+        self.bodies.append(body)
+        sort = list(body['sort'])
+        if 'pit' in body and not any('_shard_doc' in key for key in sort):
+            sort.append({'_shard_doc': 'asc'})
+        start = body.get('from', 0)
+        if 'search_after' in body:
+            if len(body['search_after']) != len(sort):
+                meta = ApiResponseMeta(400, '1.1', HttpHeaders(), 0.0, None)
+                raise BadRequestError('search_after does not match the sort', meta, {})
+            start = body['search_after'][-1] + 1
+        hits = [
+            {
+                '_source': {'text_hash': f'{position:064}', 'original_text': 'damn'},
+                'sort': [1.0, f'{position:064}', position][: len(sort)],
+            }
+            for position in range(start, min(start + body['size'], self.total))
+        ]
+        return {
+            'pit_id': body.get('pit', {}).get('id'),
+            'hits': {'total': {'value': self.total}, 'hits': hits},
+        }
+
+
+@pytest.mark.asyncio
+async def test_search_offset_and_cursor_pages(async_client, monkeypatch):
+    client = PointInTimeSearch(total=5)
+    monkeypatch.setattr(type(es_service), 'async_client', client)
+    monkeypatch.setattr(es_service, 'index_ready', True)
+
+    def text_hashes(page):
+        return [int(item['text_hash']) for item in page['items']]
+
+    # plain offset pages are a single search, without a point in time
+    page = (
+        await async_client.get(
+            '/api/search/', {'query': 'damn', 'offset': 1, 'limit': 2}
+        )
+    ).json()
+    assert text_hashes(page) == [1, 2]
+    assert page['next_cursor'] is None
+    assert 'pit' not in client.bodies[-1] and not client.open_pits
+
+    params = {'query': 'damn', 'offset': 1, 'limit': 2, 'cursor': 'start'}
+    page = (await async_client.get('/api/search/', params)).json()
+    assert text_hashes(page) == [1, 2]
+
+    response = await async_client.get(
+        '/api/search/', {'query': 'damn', 'limit': 2, 'cursor': page['next_cursor']}
+    )
+    assert response.status_code == 200
+    page = response.json()
+    assert text_hashes(page) == [3, 4]
+    body = client.bodies[-1]
+    assert len(body['search_after']) == len(body['sort'])
+
+    # the last page is short and closes the point in time
+    page = (
+        await async_client.get(
+            '/api/search/', {'query': 'damn', 'limit': 2, 'cursor': page['next_cursor']}
+        )
+    ).json()
+    assert text_hashes(page) == []
+    assert page['next_cursor'] is None
+    assert not client.open_pits
+
+
+@pytest.mark.asyncio
+async def test_search_paging_validation(async_client):
+    response = await async_client.get(
+        '/api/search/', {'query': 'damn', 'offset': 9_995, 'limit': 10}
+    )
+    assert response.status_code == 400
+
+    response = await async_client.get(
+        '/api/search/', {'query': 'damn', 'cursor': 'not a cursor'}
+    )
+    assert response.status_code == 400
+
+    # sort values of a search outside of a point in time
+    cursor = SearchCursor(None, [1.5, 'abc']).encode()
+    response = await async_client.get(
+        '/api/search/', {'query': 'damn', 'cursor': cursor}
+    )
+    assert response.status_code == 400
+
+    cursor = SearchCursor('pit', [1.5, 'abc', 7])
+    assert SearchCursor.decode(cursor.encode()) == cursor
+
+
+PARITY_TEXTS = [
+    '',
+    'a',
+    ' a',
+    '!!',
+    'shit',
+    'sh*t happens',
+    'This is a DAMN test!',
+    '  leading separators fuck',
+    '2 girls 1 cup',
+    'blow job, blow  job and Blow-Job',
+    'ass-fucker',
+    'classic assessment in Scunthorpe',
+    'f*ck $h1t @ss b1tch',
+    'naïve ΣΑΣ İstanbul shit',
+    'fuck s',
+]
+
+
+@pytest.mark.parametrize('text', PARITY_TEXTS)
+def test_censor_parity(text):
+    assert censor_engine.censor(text) == profanity.censor(text)
+
+
+def test_censor_parity_random_texts():
+    rnd = random.Random(0)
+    words = list(read_wordlist(DEFAULT_WORDLIST))
+    clean = ['hello', 'the', 'I', 'x', 'assess', 'ÄÖü', 'ok']
+    separators = [' ', '  ', ', ', '-', '_', '.', '!', '\n', '?!', ' - ']
+
+    def variant(word):
+        chars = []
+        for char in word:
+            if char in CHARS_MAPPING and rnd.random() < 0.3:
+                char = rnd.choice(CHARS_MAPPING[char])
+            if rnd.random() < 0.1:
+                char = char.upper()
+            chars.append(char)
+        return ''.join(chars)
+
+    for _ in range(300):
+        parts = []
+        for _ in range(rnd.randint(1, 8)):
+            if rnd.random() < 0.5:
+                parts.append(variant(rnd.choice(words)))
+            else:
+                parts.append(rnd.choice(clean))
+            parts.append(rnd.choice(separators))
+        text = ''.join(parts[: rnd.randint(1, len(parts))])
+        assert censor_engine.censor(text) == profanity.censor(text), text
+
+
+def test_spans_round_trip():
+    text = 'what the fuck, sh1t happens'
+    spans = censor_engine.spans(text)
+    assert spans == [(9, 13), (15, 19)]
+    assert unpack_spans(pack_spans(spans)) == spans
+    assert mask(text, spans) == censor_engine.censor(text)
+
+
+def test_censor_custom_words_and_whitelist():
+    engine = CensorEngine(words=['darn', 'heck'], whitelist=['heck'])
+    assert engine.censor('darn it, what the heck') == '**** it, what the heck'
+    assert blur_text('what the fuck') == 'what the ****'
+
+
+def test_spans_parallel_matches_serial(settings):
+    settings.CENSOR_CHUNK_SIZE = 16
+    settings.CENSOR_PROCESSES = 2
+    rnd = random.Random(1)
+    # multi-word entries straddle the chunk boundaries
+    pieces = ['2 girls 1 cup', 'blow job', 'sh1t', 'hello', 'the', 'a', 'x']
+    separators = [' ', ', ', '-', '\n', '  ']
+
+    for _ in range(50):
+        text = ''.join(
+            rnd.choice(pieces) + rnd.choice(separators)
+            for _ in range(rnd.randint(1, 60))
+        )
+        text = text[: rnd.randint(1, len(text))]
+        assert blur_spans(text) == censor_engine.spans(text), text
+
+
+def test_blur_spans_reuses_cached_sentences(settings):
+    settings.CENSOR_CACHE_MIN_LENGTH = 0
+    censor_chunk_cache.local.clear()
+    template = 'Dear {}, what the fuck happened. The blow\njob report is shit! Regards.'
+    first = template.format('Alice')
+    second = template.format('Bob')
+
+    assert blur_spans(first) == censor_engine.spans(first)
+
+    misses = CENSOR_CACHE_CHUNKS.labels('miss')._value.get()
+    assert blur_spans(second) == censor_engine.spans(second)
+    # only the first sentence differs
+    assert CENSOR_CACHE_CHUNKS.labels('miss')._value.get() == misses + 1
+
+
+def test_censor_cache_redis_slots(settings):
+    settings.CENSOR_CACHE_MIN_LENGTH = 0
+    settings.CENSOR_CACHE_REDIS_SLOTS = 1
+    client = redis_client()
+    if slots := client.keys('*censor:slot:*'):
+        client.delete(*slots)
+
+    texts = ['What the fuck happened. Regards.', 'The report is shit! Thanks.']
+    for text in texts + texts:
+        censor_chunk_cache.local.clear()
+        # sentences taking each other's slot are scanned again, never mixed up
+        assert blur_spans(text) == censor_engine.spans(text)
+    assert len(client.keys('*censor:slot:*')) == 1
+
+
+def test_rate_limited_logging():
+    rate_limit = RateLimitFilter(rate=0.01, burst=2)
+    records = [
+        logging.LogRecord('core', logging.INFO, '', 0, 'hit %s', (i,), None)
+        for i in range(5)
+    ]
+    assert [rate_limit.filter(record) for record in records] == [True] * 2 + [False] * 3
+
+    # other messages have their own budget
+    other = logging.LogRecord('core', logging.INFO, '', 0, 'miss', None, None)
+    assert rate_limit.filter(other)
+
+    rate_limit._buckets[('core', 'hit %s')][0] = 1
+    assert rate_limit.filter(records[0])
+    assert records[0].suppressed == 3
+
+
+def test_background_logging():
+    handler = BackgroundHandler(queue.Queue(maxsize=1))
+    handler.addFilter(TraceIdFilter())
+    try:
+        1 / 0
+    except ZeroDivisionError:
+        record = logging.LogRecord(
+            'core', logging.ERROR, '', 0, 'failed %s', ('twice',), sys.exc_info()
+        )
+
+    token = trace_id_var.set('submit-trace')
+    try:
+        handler.handle(record)
+    finally:
+        trace_id_var.reset(token)
+
+    # nothing writes the queue, the next record does not fit
+    dropped = LOG_RECORDS_DROPPED._value.get()
+    handler.handle(logging.LogRecord('core', logging.INFO, '', 0, 'lost', None, None))
+    assert LOG_RECORDS_DROPPED._value.get() == dropped + 1
+
+    entry = json.loads(JsonFormatter().format(handler.queue.get_nowait()))
+    assert entry['message'] == 'failed twice'
+    assert entry['trace_id'] == 'submit-trace'
+    assert entry['exception'].endswith('ZeroDivisionError: division by zero')
@@ -0,0 +1,69 @@
+import logging
+import re
+from contextvars import ContextVar
+from uuid import uuid4
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+TRACE_HEADER = 'X-Request-ID'
+# nginx sends its $request_id, anything else that does not look like an id
+# is replaced with a new one
+TRACE_ID_PATTERN = re.compile(r'[0-9A-Za-z-]{1,64}')
+
+# trace id of the request or Celery task being handled
+trace_id_var: ContextVar[str | None] = ContextVar('trace_id', default=None)
+
+
+def new_trace_id() -> str:
+    return uuid4().hex
+
+
+def request_trace_id(request) -> str:
+    trace_id = request.headers.get(TRACE_HEADER, '')
+    return trace_id if TRACE_ID_PATTERN.fullmatch(trace_id) else new_trace_id()
+
+
+class TraceIdMiddleware:
+    """
+    Binds a trace id to every request and returns it in X-Request-ID. Celery
+    messages published while handling the request carry it to the workers
+    (see core.tasks), so the log lines of a slow task lead back to it.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        trace_id = request_trace_id(request)
+        token = trace_id_var.set(trace_id)
+        try:
+            response = self.get_response(request)
+        finally:
+            trace_id_var.reset(token)
+        response[TRACE_HEADER] = trace_id
+        return response
+
+    async def __acall__(self, request):
+        trace_id = request_trace_id(request)
+        token = trace_id_var.set(trace_id)
+        try:
+            response = await self.get_response(request)
+        finally:
+            trace_id_var.reset(token)
+        response[TRACE_HEADER] = trace_id
+        return response
+
+
+class TraceIdFilter(logging.Filter):
+    # makes %(trace_id)s available to the log format
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.trace_id = trace_id_var.get() or '-'
+        return True